@@ -1,11 +1,27 @@
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, request, render_template, jsonify, Response, stream_with_context
+import json
+import os
 import re
-import pandas as pd
-from pymongo import MongoClient
 from werkzeug.utils import secure_filename
-from datetime import datetime, timedelta
 import random
+import time
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from itertools import islice
 from flask_cors import CORS
+from ingest import INGEST_CHUNK_SIZE, INTERNAL_PREFIX, collection_name_for, is_internal_collection
+from schema import ID_FIELD_PATTERN, SchemaRegistry
+from collection_stats import CollectionStatsCache
+from query_exec import (
+    EXECUTE_DEFAULTS, ListCursor, MongoQuery, QueryParseError, UnsupportedQuery, decode_page_token, encode_page_token,
+    json_default, keyset_page_query, open_cursor, parse_shell_query, query_fingerprint, run_faceted, sort_values,
+    stream_ndjson,
+)
+from index_advisor import IndexAdvisor
+from metrics import REGISTRY, STAGE_SECONDS
+from rollups import DAILY_ROLLUPS, GROUP_ROLLUPS, ROLLUP_CATALOG, RollupCatalog, rebuild_group_rollups, time_field, window_totals
+from result_cache import RecordingCursor, ResultCache, cached_documents, query_collections, result_key
 
 
 app = Flask(__name__)
@@ -13,62 +29,84 @@ CORS(app)
 
 # Configure file upload settings
 DB_TYPE=0
-UPLOAD_FOLDER = 'uploads/'
+UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 ALLOWED_EXTENSIONS = {'csv', 'json'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['INGEST_CHUNK_SIZE'] = INGEST_CHUNK_SIZE
+
+# Query execution limits (cursor batch size, row cap, server-side time limit)
+app.config['EXECUTE_BATCH_SIZE'] = EXECUTE_DEFAULTS['batch_size']
+app.config['EXECUTE_ROW_CAP'] = EXECUTE_DEFAULTS['row_cap']
+app.config['EXECUTE_MAX_TIME_MS'] = EXECUTE_DEFAULTS['max_time_ms']
+# 'mongo' runs every query on MongoDB, 'local' on the embedded engine over the uploaded
+# files, 'auto' locally when the collection has an upload and the query shape is supported
+app.config['EXECUTE_BACKEND'] = os.environ.get('CHATDB_EXECUTE_BACKEND', 'mongo')
+# Sampled previews (/api/preview_query): documents in the first round, and the default
+# latency budget for the rounds that follow
+app.config['PREVIEW_SAMPLE_SIZE'] = int(os.environ.get('CHATDB_PREVIEW_SAMPLE_SIZE', '1000'))
+app.config['PREVIEW_BUDGET_MS'] = int(os.environ.get('CHATDB_PREVIEW_BUDGET_MS', '1000'))
+# Database of the "MySQL" database type: the uploaded CSV files as SQLite tables (see
+# sql_backend)
+app.config['SQL_DATABASE'] = os.environ.get('CHATDB_SQL_DATABASE', os.path.join(UPLOAD_FOLDER, '.chatdb.sqlite'))
 
 # Function to check allowed file extensions
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# MongoDB connection function
-def get_mongo_connection():
-    client = MongoClient("mongodb://localhost:27017/")
-    db = client["chatdb"]
-    return db
-
+# pymongo, pandas and NumPy are imported by the first request that needs them (upload,
+# query execution, admin), never by the chat path, so a worker boots without them
 
-
-# Test MongoDB connection
-def test_mongo_connection():
-    try:
-        db = get_mongo_connection()
-        db.list_collection_names()  # Test connection by listing collections
-        print("MongoDB connection successful")
-    except Exception as err:
-        print(f"MongoDB connection error: {err}")
+# MongoDB connection function: shared, pooled database handle for this process
+def get_mongo_connection():
+    from mongo_pool import MONGO
+    return MONGO.get_database()
 
 # Route to serve the main page
 @app.route('/')
 def index():
     return render_template('index.html')
 
-DATABASES = {
-    "chatDB": {
-        "products": {
-            "fields": ["_id", "name", "description", "category", "price", "stock", "brand", "createdAt", "ratings"]
-        },
-        "orders": {
-            "fields": ["_id", "userId", "items", "totalAmount", "orderDate", "status", "shippingAddress", "itemCount"]
-        },
-        "reviews": {
-            "fields": ["_id", "userId", "productId", "rating", "review", "createdAt"]
-        }
-    }
-}
+# Collection schemas, inferred from a sample of each uploaded file (or of the MongoDB
+# collection) on first use and cached until the collection is written again
+SCHEMAS = SchemaRegistry(get_mongo_connection)
+# The collections chatDB shipped with keep their precedence when a message names several
+SCHEMAS.discover_files(UPLOAD_FOLDER, ALLOWED_EXTENSIONS, first=("products", "orders", "reviews"))
+SCHEMAS.warm()
 
-# Quantitative and Qualitative Attributes
-QUANTITATIVE_ATTRIBUTES = {
-    "products": ["price", "stock", "ratings.rating"],
-    "orders": ["totalAmount", "itemCount"],
-    "reviews": ["rating"]
-}
+# Embedded columnar engine over the uploaded files, created on first use
+LOCAL_ENGINE = None
 
-QUALITATIVE_ATTRIBUTES = {
-    "products": ["brand", "category", "name"],
-    "orders": ["status", "userId", "shippingAddress.city", "shippingAddress.country", "orderDate"],
-    "reviews": ["userId", "productId", "review", "createdAt"]
-}
+def get_local_engine():
+    global LOCAL_ENGINE
+    if LOCAL_ENGINE is None:
+        from local_engine import LocalEngine
+        LOCAL_ENGINE = LocalEngine(SCHEMAS.source)
+    return LOCAL_ENGINE
+
+# SQLite store of the "MySQL" database type, created on first use
+SQL_STORE = None
+
+def get_sql_store():
+    global SQL_STORE
+    if SQL_STORE is None:
+        from sql_backend import SqlStore
+        SQL_STORE = SqlStore(app.config['SQL_DATABASE'])
+    return SQL_STORE
+
+# Collection statistics for /api/explore, refreshed by a background thread
+STATS = CollectionStatsCache(get_mongo_connection, SCHEMAS)
+
+# Filter / sort usage of executed queries, and the indexes built for it; only the
+# collections of the schema are tracked, never internal ones or names typed in a query
+INDEX_ADVISOR = IndexAdvisor(
+    get_mongo_connection, accepts=lambda name: name in SCHEMAS and not is_internal_collection(name),
+)
+
+# Which group rollups (see rollups.py) are complete, for query generation
+ROLLUPS = RollupCatalog(get_mongo_connection)
+
+# Rows of executed queries, invalidated per collection when it is written
+RESULT_CACHE = ResultCache()
 
 # Construct Keywords and Their Query Patterns
 CONSTRUCT_KEYWORDS = {
@@ -82,10 +120,12 @@ CONSTRUCT_KEYWORDS = {
     "having": "having construct"
 }
 
-# Generate MongoDB Query Based on Construct and Collection
-def generate_mongo_query(template, collection):
-    quantitative_attrs = QUANTITATIVE_ATTRIBUTES.get(collection, [])
-    qualitative_attrs = QUALITATIVE_ATTRIBUTES.get(collection, [])
+# Generate MongoDB Query Based on Construct and Collection; rollups=False always reads
+# the collection itself
+def generate_mongo_query(template, collection, rollups=True):
+    schema = SCHEMAS.get(collection)
+    quantitative_attrs = schema.quantitative if schema else []
+    qualitative_attrs = schema.qualitative if schema else []
 
     if not quantitative_attrs or not qualitative_attrs:
         return "Error: Invalid dataset or attributes."
@@ -93,96 +133,112 @@ def generate_mongo_query(template, collection):
     quantitative_attr = random.choice(quantitative_attrs)
     qualitative_attr = random.choice(qualitative_attrs)
 
-    # Query templates
+    if rollups and template in ROLLUP_TEMPLATES:
+        measure = None if template == "count of <B>" else quantitative_attr
+        if ROLLUPS.covers(collection, qualitative_attr, measure):
+            return rollup_query(template, collection, qualitative_attr, quantitative_attr)
+    return template_query(template, collection, quantitative_attr, qualitative_attr)
+
+# Query templates. The queries are cached, so a recurring query is rendered for the chat
+# UI once; they are shared and must not be modified.
+@lru_cache(maxsize=1024)
+def template_query(template, collection, quantitative_attr, qualitative_attr):
+    # Output field names may not contain dots ("ratings.rating" -> "total_ratings_rating")
+    output_attr = quantitative_attr.replace(".", "_")
     if template == "total <A> by <B>":
-        return f'''
-db.{collection}.aggregate([
-    {{
-        "$group": {{
-            "_id": "${qualitative_attr}",
-            "total_{quantitative_attr}": {{
-                "$sum": "${quantitative_attr}"
-            }}
-        }}
-    }}
-])
-'''
+        return MongoQuery.aggregate(collection, [
+            {"$group": {"_id": f"${qualitative_attr}", f"total_{output_attr}": {"$sum": f"${quantitative_attr}"}}},
+        ])
     elif template == "average <A> by <B>":
-        return f'''
-db.{collection}.aggregate([
-    {{
-        "$group": {{
-            "_id": "${qualitative_attr}",
-            "average_{quantitative_attr}": {{
-                "$avg": "${quantitative_attr}"
-            }}
-        }}
-    }}
-])
-'''
+        return MongoQuery.aggregate(collection, [
+            {"$group": {"_id": f"${qualitative_attr}", f"average_{output_attr}": {"$avg": f"${quantitative_attr}"}}},
+        ])
     elif template == "count of <B>":
-        return f'''
-db.{collection}.aggregate([
-    {{
-        "$group": {{
-            "_id": "${qualitative_attr}",
-            "count": {{
-                "$sum": 1
-            }}
-        }}
-    }}
-])
-'''
+        return MongoQuery.aggregate(collection, [
+            {"$group": {"_id": f"${qualitative_attr}", "count": {"$sum": 1}}},
+        ])
     elif template == "find <A> greater than a threshold":
-        return f'''
-db.{collection}.find({{
-    "{quantitative_attr}": {{
-        "$gt": 100
-    }}
-}})
-'''
+        return MongoQuery.find(collection, {quantitative_attr: {"$gt": 100}})
     elif template == "list all <B> sorted by <A>":
-        return f'''
-db.{collection}.find().sort({{
-    "{quantitative_attr}": 1
-}})
-'''
+        return MongoQuery.find(collection, sort=[(quantitative_attr, 1)])
+    elif template == "top <N> <B> by <A>":
+        return top_n_query(collection, 10, None, quantitative_attr)
     else:
         return "Error: Invalid query template."
 
+# Group templates the rollups can answer: each group is read from its rollup document
+# (O(groups)) instead of grouping every document of the collection
+ROLLUP_TEMPLATES = ("total <A> by <B>", "average <A> by <B>", "count of <B>")
+
+@lru_cache(maxsize=1024)
+def rollup_query(template, collection, qualitative_attr, quantitative_attr):
+    if template == "total <A> by <B>":
+        output = {f"total_{quantitative_attr}": {"$ifNull": [f"$sum.{quantitative_attr}", 0]}}
+    elif template == "average <A> by <B>":
+        output = {f"average_{quantitative_attr}": {"$cond": [
+            {"$gt": [f"$n.{quantitative_attr}", 0]},
+            {"$divide": [f"$sum.{quantitative_attr}", f"$n.{quantitative_attr}"]},
+            None,
+        ]}}
+    else:
+        output = {"count": "$count"}
+    return MongoQuery.aggregate(GROUP_ROLLUPS, [
+        {"$match": {"collection": collection, "attr": qualitative_attr}},
+        {"$project": {"_id": "$value", **output}},
+    ])
+
 # Explore Databases Functionality
 def explore_databases():
-    response = "Available Databases and Collections:\n"
-    for db_name, collections in DATABASES.items():
-        response += f"- {db_name}:\n"
-        for collection, details in collections.items():
-            fields = ", ".join(details["fields"])
-            response += f"  - Collection: {collection}\n"
-            response += f"    Fields: {fields}\n"
-    return response
-
-# Generate Sample Queries for Collections
+    lines = ["Available Databases and Collections:", "- chatDB:"]
+    for collection in SCHEMAS.collections():
+        schema = SCHEMAS.get(collection)
+        fields = ", ".join(schema.fields) if schema else "(unavailable)"
+        lines.append(f"  - Collection: {collection}")
+        lines.append(f"    Fields: {fields}")
+    return "\n".join(lines) + "\n"
+
+# Hand-written sample queries of the collections chatDB shipped with
+CURATED_SAMPLE_QUERIES = {
+    "products": [
+        '''db.products.aggregate([{"$group": {"_id": "$brand", "total_stock": {"$sum": "$stock"}}}])''',
+        '''db.products.find({"price": {"$gt": 100}}).sort({"price": -1})''',
+        '''db.products.distinct("category")'''
+    ],
+    "orders": [
+        '''db.orders.aggregate([{"$group": {"_id": "$status", "total_amount": {"$sum": "$totalAmount"}}}])''',
+        '''db.orders.find({"totalAmount": {"$gte": 500}}).sort({"totalAmount": -1})''',
+        '''db.orders.distinct("status")'''
+    ],
+    "reviews": [
+        '''db.reviews.aggregate([{"$group": {"_id": "$productId", "average_rating": {"$avg": "$rating"}}}])''',
+        '''db.reviews.find({"rating": {"$gt": 4}})''',
+        '''db.reviews.distinct("productId")'''
+    ],
+}
+
+# Generate Sample Queries for Collections: the curated ones, else a group, a sorted find
+# and a distinct over fields of the inferred schema (a text field that is not an
+# identifier is grouped on when there is one)
 def generate_sample_queries(collection):
-    if collection == "products":
-        return [
-            '''db.products.aggregate([{"$group": {"_id": "$brand", "total_stock": {"$sum": "$stock"}}}])''',
-            '''db.products.find({"price": {"$gt": 100}}).sort({"price": -1})''',
-            '''db.products.distinct("category")'''
-        ]
-    elif collection == "orders":
-        return [
-            '''db.orders.aggregate([{"$group": {"_id": "$status", "total_amount": {"$sum": "$totalAmount"}}}])''',
-            '''db.orders.find({"totalAmount": {"$gte": 500}}).sort({"totalAmount": -1})''',
-            '''db.orders.distinct("status")'''
-        ]
-    elif collection == "reviews":
-        return [
-            '''db.reviews.aggregate([{"$group": {"_id": "$productId", "average_rating": {"$avg": "$rating"}}}])''',
-            '''db.reviews.find({"rating": {"$gt": 4}})''',
-            '''db.reviews.distinct("productId")'''
-        ]
-    else:
+    if collection in CURATED_SAMPLE_QUERIES:
+        return CURATED_SAMPLE_QUERIES[collection]
+    schema = SCHEMAS.get(collection)
+    if schema is None or not schema.qualitative:
         return ["Invalid collection specified."]
+    labels = [path for path in schema.qualitative if schema.types.get(path) == "string" and not ID_FIELD_PATTERN.search(path)]
+    label = (labels or schema.qualitative)[0]
+    if schema.quantitative:
+        measure = schema.quantitative[0]
+        output = {f"total_{measure.replace('.', '_')}": {"$sum": f"${measure}"}}
+        find = f"db.{collection}.find().sort({json.dumps({measure: -1})}).limit(10)"
+    else:
+        output = {"count": {"$sum": 1}}
+        find = f"db.{collection}.find().limit(10)"
+    return [
+        f"db.{collection}.aggregate([{json.dumps({'$group': {'_id': f'${label}', **output}})}])",
+        find,
+        f"db.{collection}.distinct({json.dumps(label)})",
+    ]
 
 QUERY_PATTERNS = [
     (re.compile(r"(find|show|list)\s+total\s+(\w+)\s+by\s+(\w+)\s+in\s+(\w+)"), "total <A> by <B>"),
@@ -190,83 +246,947 @@ QUERY_PATTERNS = [
     (re.compile(r"(find|show|list)\s+count\s+of\s+(\w+)\s+in\s+(\w+)"), "count of <B>"),
     (re.compile(r"(find|list)\s+(\w+)\s+greater\s+than\s+(\d+)\s+in\s+(\w+)"), "find <A> greater than a threshold"),
     (re.compile(r"(list|show)\s+all\s+(\w+)\s+sorted\s+by\s+(\w+)\s+in\s+(\w+)"), "list all <B> sorted by <A>"),
-    (re.compile(r"top\s+(\d+)\s+(\w+)\s+by\s+(\w+)\s+in\s+(\w+)"), "top <N> <B> by <A>")
+    (re.compile(r"top\s+(\d+)\s+(\w+)\s+by\s+(\w+)\s+in\s+(\w+)"), "top <N> <B> by <A>"),
+    (re.compile(r"(find|show|list)\s+records\s+from\s+the\s+last\s+(\d+)\s+days?\s+in\s+(\w+)"), "records from the last <N> days"),
+    (re.compile(r"(find|show|list)\s+(\w+)\s+per\s+(day|week|month)\s+in\s+(\w+)"), "<A> per <period>"),
+    (re.compile(r"(?:how\s+many|number\s+of)\s+distinct\s+(\w+)\s+in\s+(\w+)"), "distinct count of <B>"),
+    (re.compile(r"median\s+(?:of\s+)?(\w+)\s+in\s+(\w+)"), "median <A>"),
+    (re.compile(r"(\d{1,2}(?:st|nd|rd|th))\s+percentile\s+of\s+(\w+)\s+in\s+(\w+)"), "<P>th percentile of <A>"),
+    (re.compile(r"minimum\s+and\s+maximum\s+(?:of\s+)?(\w+)\s+in\s+(\w+)"), "minimum and maximum <A>")
 ]
 
-# Parse natural language and generate MongoDB query
-def generate_mongo_query_from_natural_language(message):
+# Single-pass intent matcher, compiled once at startup.
+# Every trigger keyword (explore/sample, construct keywords, collection names) and one
+# required literal per query pattern ("total", "top", ...) are folded into a single
+# prefix-trie alternation, so a message is scanned once however many constructs,
+# collections and templates exist. Keyword hits keep the substring semantics of the old
+# `keyword in message` checks, including overlapping occurrences. Query patterns are only
+# run when the keywords alone do not settle the intent, and then only those whose
+# required literal occurred in the message.
+Intent = namedtuple("Intent", ["kind", "template", "collection", "groups"])
+
+# Regex alternation of the given words, factored by common prefix
+def keyword_trie_regex(words):
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def emit(node):
+        branches = [re.escape(char) + emit(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return f"(?:{body})?" if "" in node else body
+
+    return emit(trie)
+
+# Longest keyword a query pattern always matches, or None if it has none: the plain
+# words between its \s+ separators that are outside every group
+def required_literal(pattern):
+    words, depth = [], 0
+    for part in re.split(r"\\s[+*]", pattern.pattern):
+        if depth == 0 and re.fullmatch(r"[a-z]+", part):
+            words.append(part)
+        depth += part.count("(") - part.count(")")
+    return max(words, key=len, default=None)
+
+class IntentMatcher:
+    def __init__(self, collections, constructs, patterns):
+        self.collections = list(collections)
+        self.constructs = dict(constructs)
+        self.patterns = list(patterns)
+        self._collection_set = set(self.collections)
+        self._collection_rank = {c: i for i, c in enumerate(self.collections)}
+        self._construct_rank = {c: i for i, c in enumerate(self.constructs)}
+
+        # Patterns without a required literal are tried on every fallback
+        self._pattern_literals = [required_literal(pattern) for pattern, template in self.patterns]
+        self._unanchored = [i for i, literal in enumerate(self._pattern_literals) if literal is None]
+
+        # The trie match is greedy and consuming, so two kinds of occurrence are hidden by a
+        # hit: keywords contained in it (implied by the hit) and keywords that start inside
+        # it but run past its end (checked with a substring test)
+        keywords = set(["explore", "sample"]) | set(self.constructs) | self._collection_set
+        keywords |= set(literal for literal in self._pattern_literals if literal)
+        self._implied = {kw: frozenset(other for other in keywords if other in kw) for kw in keywords}
+        self._overlap_words = {
+            kw: frozenset(
+                other
+                for offset in range(1, len(kw))
+                for other in keywords
+                if other.startswith(kw[offset:]) and len(other) > len(kw) - offset
+            )
+            for kw in keywords
+        }
+        self._keyword_scanner = re.compile(keyword_trie_regex(keywords))
+
+    # Set of keywords present in the (lowercased) message
+    def scan_keywords(self, message):
+        found = set()
+        for keyword in self._keyword_scanner.findall(message):
+            found |= self._implied[keyword]
+            for other in self._overlap_words[keyword]:
+                if other not in found and other in message:
+                    found |= self._implied[other]
+        return found
+
+    # First query pattern (in QUERY_PATTERNS order) whose collection is known
+    def resolve_pattern(self, message, found):
+        for i, (pattern, template) in enumerate(self.patterns):
+            literal = self._pattern_literals[i]
+            if literal is not None and literal not in found:
+                continue
+            match = pattern.search(message)
+            if match:
+                groups = match.groups()
+                if groups[-1] in self._collection_set:
+                    return Intent("query", template, groups[-1], groups)
+        return Intent("miss", None, None, ())
+
+    def match_pattern(self, message):
+        message = message.lower()
+        return self.resolve_pattern(message, self.scan_keywords(message))
+
+    def match(self, message):
+        message = message.lower()
+        found = self.scan_keywords(message)
+
+        if "explore" in found:
+            return Intent("explore", None, None, ())
+
+        collection = construct = None
+        for keyword in found:
+            rank = self._collection_rank.get(keyword)
+            if rank is not None and (collection is None or rank < self._collection_rank[collection]):
+                collection = keyword
+            rank = self._construct_rank.get(keyword)
+            if rank is not None and (construct is None or rank < self._construct_rank[construct]):
+                construct = keyword
+
+        if "sample" in found:
+            return Intent("sample", None, collection, ())
+
+        if construct is not None and collection is not None:
+            return Intent("construct", self.constructs[construct], collection, ())
+
+        # Every query pattern ends in a collection name, so none can resolve without one
+        if collection is None:
+            return Intent("miss", None, None, ())
+        return self.resolve_pattern(message, found)
+
+INTENT_MATCHER = IntentMatcher(SCHEMAS.collections(), CONSTRUCT_KEYWORDS, QUERY_PATTERNS)
+INTENT_MATCHER_VERSION = SCHEMAS.version
+
+# The matcher is rebuilt only when the set of known collections changes
+def get_intent_matcher():
+    global INTENT_MATCHER, INTENT_MATCHER_VERSION
+    if INTENT_MATCHER_VERSION != SCHEMAS.version:
+        version = SCHEMAS.version
+        INTENT_MATCHER = IntentMatcher(SCHEMAS.collections(), CONSTRUCT_KEYWORDS, QUERY_PATTERNS)
+        INTENT_MATCHER_VERSION = version
+    return INTENT_MATCHER
+
+# Build the MongoDB query text for a query pattern hit
+# Top-N as $sort immediately followed by $limit, which MongoDB (and the local engine)
+# runs as a bounded top-k selection instead of sorting every document. When <B> is a
+# qualitative field the totals per <B> are ranked, otherwise the documents themselves.
+@lru_cache(maxsize=1024)
+def top_n_query(collection, n, group_attr, quantitative_attr):
+    if group_attr is None:
+        return MongoQuery.aggregate(collection, [
+            {"$sort": {quantitative_attr: -1}},
+            {"$limit": n},
+        ])
+    output_attr = quantitative_attr.replace(".", "_")
+    return MongoQuery.aggregate(collection, [
+        {"$group": {"_id": f"${group_attr}", f"total_{output_attr}": {"$sum": f"${quantitative_attr}"}}},
+        {"$sort": {f"total_{output_attr}": -1}},
+        {"$limit": n},
+    ])
+
+# Time windows are answered from the day buckets kept by rollups.py, one document per
+# day with data, instead of from the raw documents. "Last N days" are the calendar days
+# from N days before today on; days are ISO strings, so they compare in date order.
+def time_window_query(collection, template, groups):
+    schema = SCHEMAS.get(collection)
+    field = time_field(schema)
+    if field is None:
+        return f"Error: {collection} has no timestamp field."
+    if template == "records from the last <N> days":
+        cutoff = (date.today() - timedelta(days=int(groups[1]))).isoformat()
+        return MongoQuery.aggregate(DAILY_ROLLUPS, [
+            {"$match": {"collection": collection, "field": field, "day": {"$gte": cutoff}}},
+            {"$sort": {"day": 1}},
+            {"$project": {"_id": 0, "day": 1, "count": 1, "sum": 1}},
+        ])
+    measure, period = schema_field(collection, groups[1]), groups[2]
+    totals = {"count": {"$sum": "$count"}}
+    if measure in schema.quantitative:
+        totals[f"total_{measure}"] = {"$sum": f"$sum.{measure}"}
+    return MongoQuery.aggregate(DAILY_ROLLUPS, [
+        {"$match": {"collection": collection, "field": field}},
+        {"$group": {"_id": f"${period}", **totals}},
+        {"$sort": {"_id": 1}},
+    ])
+
+SKETCH_TEMPLATES = ("distinct count of <B>", "median <A>", "<P>th percentile of <A>", "minimum and maximum <A>")
+
+# Approximate mode is opt-in: the request sets "approximate": true or the message says
+# "approximately" / "estimate" / "roughly". "exact" in the message always runs the query.
+APPROXIMATE_WORDS = re.compile(r"\b(?:approx\w*|estimated?|roughly)\b")
+EXACT_WORDS = re.compile(r"\bexact(?:ly)?\b")
+
+def wants_approximate(message, requested=False):
     message = message.lower()
+    if EXACT_WORDS.search(message):
+        return False
+    return bool(requested) or APPROXIMATE_WORDS.search(message) is not None
 
-    for pattern, template in QUERY_PATTERNS:
-        match = pattern.search(message)
-        if match:
-            groups = match.groups()
-            if template in ["total <A> by <B>", "average <A> by <B>", "count of <B>"]:
-                collection = groups[-1]
-                if collection in DATABASES["chatDB"]:
-                    return generate_mongo_query(template, collection)
-            elif template == "find <A> greater than a threshold":
-                collection = groups[-1]
-                if collection in DATABASES["chatDB"]:
-                    threshold = int(groups[-2])
-                    return f'''
-db.{collection}.find({{
-    "{groups[1]}": {{
-        "$gt": {threshold}
-    }}
-}})
-'''
-            elif template in ["list all <B> sorted by <A>", "top <N> <B> by <A>"]:
-                collection = groups[-1]
-                if collection in DATABASES["chatDB"]:
-                    return generate_mongo_query(template, collection)
-    return "Error: Could not interpret the request."
+# Field name as stored (messages are matched lowercased)
+def schema_field(collection, name):
+    schema = SCHEMAS.get(collection)
+    if schema is not None:
+        for field in schema.fields:
+            if field.lower() == name:
+                return field
+    return name
+
+# Field, sketch kind, quantile and label of a sketch template
+def sketch_target(template, groups):
+    if template == "distinct count of <B>":
+        return groups[0], "distinct", None, None
+    if template == "median <A>":
+        return groups[0], "quantile", 0.5, "median"
+    if template == "<P>th percentile of <A>":
+        p = int(groups[0][:-2])
+        return groups[1], "quantile", p / 100, f"{groups[0]} percentile"
+    return groups[0], "range", None, None
 
-# Modified Response Determination
+# Exact query for a sketch template. Percentiles are nearest-rank, the same definition
+# the KLL sketch estimates: the value at rank ceil(n * p / 100) of the n numeric values.
+# $setWindowFields numbers the sorted values and counts them in one pass, so the query
+# needs no count up front and never gathers the values into one document.
+def sketch_query(collection, template, groups):
+    field, kind, q, label = sketch_target(template, groups)
+    field = schema_field(collection, field)
+    if kind == "distinct":
+        return MongoQuery.aggregate(collection, [
+            {"$match": {field: {"$ne": None}}},
+            {"$group": {"_id": f"${field}"}},
+            {"$count": f"distinct_{field}"},
+        ])
+    if kind == "range":
+        return MongoQuery.aggregate(collection, [
+            {"$group": {"_id": None, f"min_{field}": {"$min": f"${field}"}, f"max_{field}": {"$max": f"${field}"}}},
+        ])
+    if not 0 < q < 1:
+        return "Error: Percentile must be between 1 and 99."
+    # n * p is an integer, so the rank is exact where n * q would round
+    rank = {"$max": [1, {"$ceil": {"$divide": [{"$multiply": ["$n", round(q * 100)]}, 100]}}]}
+    return MongoQuery.aggregate(collection, [
+        {"$match": {field: {"$type": "number"}}},
+        {"$setWindowFields": {
+            "sortBy": {field: 1},
+            "output": {
+                "rank": {"$documentNumber": {}},
+                "n": {"$count": {}, "window": {"documents": ["unbounded", "unbounded"]}},
+            },
+        }},
+        {"$match": {"$expr": {"$eq": ["$rank", rank]}}},
+        {"$project": {"_id": 0, f"{label.replace(' ', '_')}_{field}": f"${field}"}},
+    ])
+
+# Answer a sketch template from the sketches kept by ingestion, with its error bound;
+# None when the field has no sketch (the exact query is returned instead)
+def approximate_answer(collection, template, groups):
+    from sketches import sketch_answer
+
+    field, kind, q, label = sketch_target(template, groups)
+    field = schema_field(collection, field)
+    if q is not None and not 0 < q < 1:
+        return None
+    try:
+        answer = sketch_answer(get_mongo_connection(), collection, field, kind, q)
+    except Exception:
+        app.logger.warning("Sketch lookup failed for %s.%s", collection, field, exc_info=True)
+        return None
+    if answer is None:
+        return None
+    if kind == "distinct":
+        return (f"About {answer['estimate']:,} distinct {field} in {collection} "
+                f"(HyperLogLog estimate, within ±{2 * answer['relative_error']:.1%} at 95% confidence). "
+                f"Ask for the exact count to run the query.")
+    if kind == "quantile":
+        return (f"The {label} of {field} in {collection} is about {answer['estimate']:g} "
+                f"(KLL sketch of {answer['values']:,} values, within ±{answer['rank_error']:.1%} "
+                f"of the true rank at 99% confidence). Ask for the exact {label} to run the query.")
+    return (f"{field} in {collection} ranges from {answer['min']:g} to {answer['max']:g} "
+            f"(tracked exactly during ingestion over {answer['values']:,} values).")
+
+@lru_cache(maxsize=1024)
+def threshold_query(collection, field, threshold):
+    return MongoQuery.find(collection, {field: {"$gt": threshold}})
+
+def generate_query_for_intent(intent, approximate=False):
+    if intent.template in SKETCH_TEMPLATES:
+        if approximate:
+            answer = approximate_answer(intent.collection, intent.template, intent.groups)
+            if answer is not None:
+                return answer
+        return sketch_query(intent.collection, intent.template, intent.groups)
+    if intent.template in ("records from the last <N> days", "<A> per <period>"):
+        return time_window_query(intent.collection, intent.template, intent.groups)
+    if intent.template == "top <N> <B> by <A>":
+        n = int(intent.groups[0])
+        schema = SCHEMAS.get(intent.collection)
+        if schema is None or n <= 0:
+            return "Error: Invalid dataset or attributes."
+        # <B> is a field to group on, or names the documents themselves ("top 5 products by price")
+        group_attr = schema_field(intent.collection, intent.groups[1])
+        quantitative_attr = schema_field(intent.collection, intent.groups[2])
+        if quantitative_attr not in schema.quantitative:
+            return f"Error: {intent.collection} has no numeric field {intent.groups[2]}."
+        return top_n_query(intent.collection, n, group_attr if group_attr in schema.qualitative else None, quantitative_attr)
+    if intent.template == "find <A> greater than a threshold":
+        return threshold_query(intent.collection, intent.groups[1], int(intent.groups[-2]))
+    return generate_mongo_query(intent.template, intent.collection)
+
+# Parse natural language and generate MongoDB query
+def generate_mongo_query_from_natural_language(message):
+    intent = get_intent_matcher().match_pattern(message)
+    if intent.kind == "miss":
+        return "Error: Could not interpret the request."
+    return generate_query_for_intent(intent)
+
+# Modified Response Determination; the reply as the chat UI shows it
 def determine_response(message):
-    message = message.lower()
+    return str(respond_to_intent(get_intent_matcher().match(message)))
+
+# The UI's database type: "mysql" answers and executes SQL over the uploaded CSV files
+def wants_sql(data):
+    return isinstance(data, dict) and data.get('db_type') == 'mysql'
+
+# Chat templates as SQL for the MySQL database type. Time windows, sketches and the
+# rollups have no SQL form; group templates read the table itself.
+def sql_response(intent):
+    from sql_backend import translate
 
+    if intent.collection in SCHEMAS and not (SCHEMAS.source(intent.collection) or "").lower().endswith(".csv"):
+        return f"Error: {intent.collection} has no SQL table; only CSV uploads are loaded for MySQL."
+    if intent.kind == "construct" or intent.template in ROLLUP_TEMPLATES + ("list all <B> sorted by <A>",):
+        query = generate_mongo_query(intent.template, intent.collection, rollups=False)
+    elif intent.template in ("top <N> <B> by <A>", "find <A> greater than a threshold"):
+        query = generate_query_for_intent(intent)
+    else:
+        return f"Error: '{intent.template}' queries are not available for MySQL."
+    if not isinstance(query, MongoQuery):
+        return query
+    try:
+        return translate(query)
+    except UnsupportedQuery as e:
+        return f"Error: {str(e)}"
+
+def respond_to_intent(intent, approximate=False, sql=False):
     # Handle explore request
-    if "explore" in message:
+    if intent.kind == "explore":
         return explore_databases()
 
     # Handle sample queries request
-    if "sample" in message:
-        for collection in DATABASES["chatDB"].keys():
-            if collection in message:
-                return "\n".join(generate_sample_queries(collection))
-        return "Please specify a valid collection: 'products', 'orders', or 'reviews'."
+    if intent.kind == "sample":
+        if intent.collection is not None:
+            return "\n".join(generate_sample_queries(intent.collection))
+        names = ", ".join(f"'{collection}'" for collection in SCHEMAS.collections())
+        return f"Please specify a valid collection: {names}."
+
+    # Handle construct keywords and natural language queries for MySQL
+    if sql and intent.kind in ("construct", "query"):
+        return sql_response(intent)
 
     # Handle construct keywords and specific collections
-    for construct in CONSTRUCT_KEYWORDS.keys():
-        if construct in message:
-            for collection in DATABASES["chatDB"].keys():
-                if collection in message:
-                    return generate_mongo_query(CONSTRUCT_KEYWORDS[construct], collection)
+    if intent.kind == "construct":
+        return generate_mongo_query(intent.template, intent.collection)
 
     # Handle natural language query
-    return generate_mongo_query_from_natural_language(message)
+    if intent.kind == "query":
+        return generate_query_for_intent(intent, approximate)
+    return "Error: Could not interpret the request."
+
+# Reply and status code for a decoded /api/chat body; shared with the ASGI server.
+# Returns the intent too, so the caller can label its own stage timings.
+def answer_chat(data):
+    if not data or 'message' not in data:
+        return {'error': 'Invalid request, message key missing'}, 400, None
+
+    started = time.perf_counter()
+    intent = get_intent_matcher().match(data['message'])
+    STAGE_SECONDS.observe(time.perf_counter() - started, 'intent', intent.kind, intent.collection or '')
+
+    with STAGE_SECONDS.time('generate', intent.kind, intent.collection or ''):
+        response = respond_to_intent(intent, wants_approximate(data['message'], data.get('approximate')), wants_sql(data))
+    return {'response': str(response)}, 200, intent
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
     try:
-        data = request.get_json()
-        print("Received JSON payload:", data)
+        with STAGE_SECONDS.time('decode', 'none', ''):
+            data = request.get_json()
+        app.logger.debug("Received JSON payload: %s", data)
+
+        reply, status, intent = answer_chat(data)
+        if intent is None:
+            return jsonify(reply), status
+        with STAGE_SECONDS.time('respond', intent.kind, intent.collection or ''):
+            return jsonify(reply), status
+    except Exception as e:
+        app.logger.exception("Chat request failed")
+        return jsonify({'error': f"Internal Server Error: {str(e)}"}), 500
+
+
+# Most messages one /api/chat/batch request may carry, and the rows returned per
+# executed query (every query's rows of one collection come back in one $facet document,
+# which MongoDB caps at 16 MB)
+app.config['CHAT_BATCH_MAX_MESSAGES'] = int(os.environ.get('CHATDB_CHAT_BATCH_MAX_MESSAGES', '1000'))
+app.config['CHAT_BATCH_ROW_CAP'] = int(os.environ.get('CHATDB_CHAT_BATCH_ROW_CAP', '100'))
+
+# Answer many chat messages in one request. Identical messages are resolved once and
+# share their response. With "execute": true the generated queries are run as well:
+# locally when the backend allows it, otherwise as one $facet aggregation per collection.
+@app.route('/api/chat/batch', methods=['POST'])
+def chat_batch():
+    data = request.get_json(silent=True)
+    messages = data.get('messages') if isinstance(data, dict) else None
+    if not isinstance(messages, list) or not all(isinstance(m, str) for m in messages):
+        return jsonify({'error': 'Invalid request, messages must be a list of strings'}), 400
+    if len(messages) > app.config['CHAT_BATCH_MAX_MESSAGES']:
+        return jsonify({'error': f"At most {app.config['CHAT_BATCH_MAX_MESSAGES']} messages per batch"}), 400
+
+    matcher = get_intent_matcher()
+    unique = list(dict.fromkeys(messages))
+    with STAGE_SECONDS.time('generate', 'batch', ''):
+        responses = {
+            message: respond_to_intent(
+                matcher.match(message), wants_approximate(message, data.get('approximate')), wants_sql(data),
+            )
+            for message in unique
+        }
+
+    results = {}
+    if data.get('execute'):
+        with STAGE_SECONDS.time('execute', 'batch', ''):
+            results = execute_batch(list(dict.fromkeys(responses.values())), app.config['CHAT_BATCH_ROW_CAP'])
+
+    replies = []
+    for message in messages:
+        reply = {'message': message, 'response': str(responses[message])}
+        reply.update(results.get(responses[message], {}))
+        replies.append(reply)
+    body = json.dumps({'responses': replies, 'unique_messages': len(unique)}, default=json_default)
+    return Response(body, mimetype='application/json')
+
+
+# Run the executable queries among `responses` (generated MongoQuery and SqlQuery objects,
+# or shell texts, which are parsed); returns {response: {'rows', 'truncated'} or {'error'}}.
+# Responses that are not queries (explore output, errors) are skipped.
+def execute_batch(responses, row_cap):
+    from sql_backend import SqlError, SqlQuery
+
+    parsed, results = {}, {}
+    for response in responses:
+        if isinstance(response, SqlQuery):
+            try:
+                cursor = open_sql_cursor(response.text, response.params, row_cap + 1)
+                try:
+                    rows = list(islice(cursor, row_cap + 1))
+                finally:
+                    cursor.close()
+                results[response] = {'rows': rows[:row_cap], 'truncated': len(rows) > row_cap}
+            except SqlError as e:
+                results[response] = {'error': f"Query failed: {str(e)}"}
+            continue
+        if isinstance(response, MongoQuery):
+            parsed[response] = response.as_dict()
+            continue
+        try:
+            parsed[response] = parse_shell_query(response)
+        except QueryParseError:
+            continue
+
+    remote, pending = [], {}
+    for response, query in parsed.items():
+        key, collections = result_key(query, row_cap), query_collections(query)
+        cached = RESULT_CACHE.get(key)
+        if cached is not None:
+            results[response] = {'rows': cached[0], 'truncated': cached[1]}
+            continue
+        pending[response] = (key, collections, RESULT_CACHE.versions(collections))
+        try:
+            rows = run_locally(query, row_cap)
+        except UnsupportedQuery as e:
+            results[response] = {'error': str(e)}
+            continue
+        if rows is None:
+            remote.append(response)
+        else:
+            results[response] = {'rows': rows[:row_cap], 'truncated': len(rows) > row_cap}
+
+    if remote:
+        for response in remote:
+            INDEX_ADVISOR.record(parsed[response])
+        try:
+            outcome = run_faceted(get_mongo_connection(), [parsed[response] for response in remote], row_cap, app.config['EXECUTE_MAX_TIME_MS'])
+        except Exception as e:
+            outcome = {i: e for i in range(len(remote))}
+        for i, response in enumerate(remote):
+            result = outcome[i]
+            if isinstance(result, Exception):
+                results[response] = {'error': f"Query failed: {str(result)}"}
+            else:
+                results[response] = {'rows': result[0], 'truncated': result[1]}
+
+    for response, (key, collections, versions) in pending.items():
+        if 'rows' in results[response]:
+            RESULT_CACHE.put(key, collections, versions, results[response]['rows'], results[response]['truncated'])
+    return results
 
-        if not data or 'message' not in data:
-            return jsonify({'error': 'Invalid request, message key missing'}), 400
 
-        message = data['message']
-        response = determine_response(message)
+# Upload a CSV / Extended JSON file and bulk-load it into the collection of the same name
+@app.route('/api/upload', methods=['POST'])
+def upload_file():
+    if 'file' not in request.files:
+        return jsonify({'message': 'No file part in the request'}), 400
 
-        return jsonify({'response': response}), 200
+    file = request.files['file']
+    if file.filename == '' or not allowed_file(file.filename):
+        return jsonify({'message': 'Please upload a .csv or .json file'}), 400
+
+    # FileStorage.save copies the (spooled) upload to disk in small blocks
+    filename = secure_filename(file.filename)
+    if is_internal_collection(collection_name_for(filename)):
+        return jsonify({'message': f"File names starting with {INTERNAL_PREFIX} are reserved"}), 400
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    file.save(path)
+
+    from ingest import ingest_file
+    try:
+        report = ingest_file(path, get_mongo_connection(), app.config['INGEST_CHUNK_SIZE'])
     except Exception as e:
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': f"Internal Server Error: {str(e)}"}), 500
+        return jsonify({'message': f"Ingestion failed: {str(e)}"}), 500
+
+    # The collection was written: its cached schema is re-inferred from the new file, and
+    # cached results read from it or from its rollups and sketches are dropped
+    from sketches import SKETCHES
+    for written in (report.collection, DAILY_ROLLUPS, GROUP_ROLLUPS, ROLLUP_CATALOG, SKETCHES):
+        RESULT_CACHE.bump(written)
+    SCHEMAS.register_file(report.collection, path)
+    STATS.request_refresh()
+    ROLLUPS.refresh()
+
+    # Convert CSV uploads to the columnar cache now rather than on the first local query;
+    # the file is read in chunks, as ingestion read it. A failure only costs the first
+    # local query the conversion.
+    get_local_engine().invalidate(report.collection)
+    if path.lower().endswith('.csv'):
+        from columnar_cache import open_store
+        try:
+            open_store(path)
+        except Exception:
+            app.logger.warning("Columnar conversion of %s failed", filename, exc_info=True)
+
+    return jsonify({'filename': filename, **report.as_dict()}), 200
+
+
+# Rows for a parsed query when the configured backend (see EXECUTE_BACKEND) runs it on
+# the embedded engine, or None when it goes to MongoDB
+def run_locally(query, row_cap):
+    backend = app.config['EXECUTE_BACKEND']
+    if backend != 'mongo' and SCHEMAS.source(query['collection']) is not None:
+        try:
+            return get_local_engine().execute(query)[:row_cap + 1]
+        except UnsupportedQuery:
+            if backend == 'local':
+                raise
+    elif backend == 'local':
+        raise UnsupportedQuery(f"No local data for collection {query['collection']}")
+    return None
+
+
+# Cursor for a parsed query on the configured backend
+def open_query_cursor(query, batch_size, row_cap):
+    rows = run_locally(query, row_cap)
+    if rows is not None:
+        return ListCursor(rows)
+    INDEX_ADVISOR.record(query)
+    return open_cursor(get_mongo_connection(), query, batch_size, row_cap, app.config['EXECUTE_MAX_TIME_MS'])
+
+
+# (batch size, row cap) of an /api/execute_query body; a request may lower the configured
+# limits but never raise them
+def execute_limits(data):
+    batch_size = max(min(int(data.get('batch_size', app.config['EXECUTE_BATCH_SIZE'])), app.config['EXECUTE_BATCH_SIZE']), 1)
+    row_cap = max(min(int(data.get('limit', app.config['EXECUTE_ROW_CAP'])), app.config['EXECUTE_ROW_CAP']), 0)
+    return batch_size, row_cap
+
+
+# Parsed query and (batch size, row cap) of an /api/execute_query body
+def parse_execute_request(data):
+    query = parse_shell_query(data['query'])
+    return (query, *execute_limits(data))
+
+
+# The embedded SQL database, after (re)loading the CSV uploads that changed since they
+# were last loaded
+def synced_sql_store():
+    store = get_sql_store()
+    sources = {}
+    for collection in SCHEMAS.collections():
+        source = SCHEMAS.source(collection)
+        if source is not None and source.lower().endswith('.csv'):
+            sources[collection] = source
+    store.sync(sources, sql_index_columns)
+    return store
+
+
+def open_sql_cursor(text, params, batch_size):
+    return synced_sql_store().cursor(text, params, batch_size, app.config['EXECUTE_MAX_TIME_MS'])
+
+
+# Columns indexed when a CSV file is loaded: the fields the templates group, filter and
+# sort on
+def sql_index_columns(table):
+    schema = SCHEMAS.get(table)
+    return schema.quantitative + schema.qualitative if schema else []
+
+
+# SQL cursor and row cap of an /api/execute_query body for the MySQL database type
+def open_sql_request(data):
+    if data.get('page_size') is not None:
+        raise QueryParseError("Pagination is only supported for MongoDB queries")
+    if not isinstance(data['query'], str):
+        raise QueryParseError("The query must be SQL text")
+    batch_size, row_cap = execute_limits(data)
+    return open_sql_cursor(data['query'], (), batch_size), row_cap
+
+
+# Metrics label for a queried collection; unknown names share one label so /metrics
+# cannot grow without bound
+def collection_label(name):
+    return name if name in SCHEMAS else 'other'
+
+
+# Execute a mongo-shell query and stream the rows back as NDJSON while the cursor fetches.
+# With "page_size" only one page of a find() is returned; the trailer then carries a
+# next_page_token to send back as "page_token" for the page after it.
+@app.route('/api/execute_query', methods=['POST'])
+def execute_query():
+    data = request.get_json(silent=True)
+    if not data or 'query' not in data:
+        return jsonify({'message': 'Invalid request, query key missing'}), 400
+    if wants_sql(data):
+        return execute_sql(data)
+
+    try:
+        query, batch_size, row_cap = parse_execute_request(data)
+    except (QueryParseError, ValueError, TypeError) as e:
+        return jsonify({'message': str(e)}), 400
+
+    if data.get('page_size') is not None:
+        return execute_page(query, batch_size, row_cap, data)
+
+    collection = collection_label(query['collection'])
+    key, collections = result_key(query, row_cap), query_collections(query)
+    cached = RESULT_CACHE.get(key)
+    if cached is not None:
+        return stream_rows(ListCursor(cached_documents(*cached)), row_cap, query)
+
+    versions = RESULT_CACHE.versions(collections)
+    try:
+        with STAGE_SECONDS.time('open', query['operation'], collection):
+            cursor = open_query_cursor(query, batch_size, row_cap)
+    except UnsupportedQuery as e:
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        return jsonify({'message': f"Query failed: {str(e)}"}), 500
+    return stream_rows(RecordingCursor(cursor, RESULT_CACHE, key, collections, versions, row_cap), row_cap, query)
+
+
+# Execute SQL on the embedded database (database type MySQL); rows stream back like those
+# of a MongoDB query
+def execute_sql(data):
+    from sql_backend import SqlError
+
+    try:
+        with STAGE_SECONDS.time('open', 'sql', 'other'):
+            cursor, row_cap = open_sql_request(data)
+    except (QueryParseError, ValueError, TypeError) as e:
+        return jsonify({'message': str(e)}), 400
+    except SqlError as e:
+        return jsonify({'message': f"Query failed: {str(e)}"}), 400
+    except Exception as e:
+        return jsonify({'message': f"Query failed: {str(e)}"}), 500
+    return stream_rows(cursor, row_cap, {'collection': '', 'operation': 'sql'})
+
+
+# NDJSON response for an open cursor, recording fetch / serialize time
+def stream_rows(cursor, row_cap, query, page_token_for=None, hide=()):
+    collection = collection_label(query['collection'])
+
+    def record_stream(fetch_seconds, serialize_seconds):
+        STAGE_SECONDS.observe(fetch_seconds, 'fetch', query['operation'], collection)
+        STAGE_SECONDS.observe(serialize_seconds, 'serialize', query['operation'], collection)
+
+    stream = stream_ndjson(cursor, row_cap, on_complete=record_stream, page_token_for=page_token_for, hide=hide)
+    return Response(stream_with_context(stream), mimetype='application/x-ndjson')
+
+
+# (page size, decoded page token or None, query fingerprint) of an /api/execute_query
+# body with "page_size"
+def parse_page_request(query, row_cap, data):
+    page_size = max(min(int(data['page_size']), row_cap), 1)
+    state = decode_page_token(data['page_token']) if data.get('page_token') else None
+    if query['operation'] != 'find':
+        raise QueryParseError("Pagination is only supported for find() queries")
+    fingerprint = query_fingerprint(query)
+    if state is not None and state.get('query') != fingerprint:
+        raise QueryParseError("Page token belongs to a different query")
+    return page_size, state, fingerprint
+
+
+# Where one page of a find() comes from, as (rows, page, page size, token builder, hidden
+# fields): the rows when the embedded engine serves it, else the find() to run on MongoDB.
+# MongoDB pages seek past the (sort keys, _id) of the previous page's last row, so with
+# an index on them page N costs what page 1 does; the embedded engine slices its cached
+# sort order at an offset.
+def plan_page(query, page_size, state, fingerprint):
+    if state is None or 'offset' in state:
+        offset = state['offset'] if state else query.get('skip') or 0
+        remaining = state['remaining'] if state else query['limit']
+        this_page = min(page_size, remaining) if remaining else page_size
+        more = remaining is None or remaining > this_page
+        rows = run_locally(dict(query, skip=offset, limit=this_page + (1 if more else 0)), this_page)
+        if rows is not None:
+            def local_token(last):
+                return encode_page_token({
+                    'query': fingerprint,
+                    'offset': offset + this_page,
+                    'remaining': remaining - this_page if remaining else None,
+                })
+            return rows, None, this_page, local_token, ()
+        if state is not None:
+            raise QueryParseError("Page token was issued by the embedded engine, which no longer serves this query")
+
+    page, this_page, remaining, hidden = keyset_page_query(query, page_size, state)
+    INDEX_ADVISOR.record(page)
+
+    def keyset_token(last):
+        return encode_page_token({
+            'query': fingerprint,
+            'after': sort_values(last, page['sort']),
+            'remaining': remaining - this_page if remaining else None,
+        })
+    return None, page, this_page, keyset_token, hidden
+
+
+# One page of a find(), see plan_page
+def execute_page(query, batch_size, row_cap, data):
+    try:
+        page_size, state, fingerprint = parse_page_request(query, row_cap, data)
+    except (QueryParseError, ValueError, TypeError) as e:
+        return jsonify({'message': str(e)}), 400
+
+    collection = collection_label(query['collection'])
+    try:
+        with STAGE_SECONDS.time('open', 'page', collection):
+            rows, page, this_page, token_for, hidden = plan_page(query, page_size, state, fingerprint)
+            if rows is not None:
+                return stream_rows(ListCursor(rows), this_page, query, token_for)
+            cursor = open_cursor(get_mongo_connection(), page, batch_size, this_page, app.config['EXECUTE_MAX_TIME_MS'])
+    except (QueryParseError, UnsupportedQuery) as e:
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        return jsonify({'message': f"Query failed: {str(e)}"}), 500
+    return stream_rows(cursor, this_page, query, token_for, hidden)
+
+
+# Sampled preview of a $group aggregation (see preview.py): estimated groups with
+# confidence intervals, within a latency budget ("budget_ms"). With "progressive": true
+# every round is streamed as an NDJSON line, the last one holding the exact rows.
+@app.route('/api/preview_query', methods=['POST'])
+def preview_query():
+    from preview import preview_plan, preview_rounds
+
+    data = request.get_json(silent=True)
+    if not data or 'query' not in data:
+        return jsonify({'message': 'Invalid request, query key missing'}), 400
+    try:
+        query, batch_size, row_cap = parse_execute_request(data)
+        plan = preview_plan(query)
+        budget_ms = max(int(data.get('budget_ms', app.config['PREVIEW_BUDGET_MS'])), 1)
+        confidence = float(data.get('confidence', 0.95))
+        if not 0 < confidence < 1:
+            raise ValueError("confidence must be between 0 and 1")
+    except (QueryParseError, UnsupportedQuery, ValueError, TypeError) as e:
+        return jsonify({'message': str(e)}), 400
+
+    collection = collection_label(query['collection'])
+    try:
+        with STAGE_SECONDS.time('open', 'preview', collection):
+            sampler = preview_sampler(query, plan)
+    except UnsupportedQuery as e:
+        return jsonify({'message': str(e)}), 400
+    except Exception as e:
+        return jsonify({'message': f"Query failed: {str(e)}"}), 500
+
+    def exact():
+        return list(open_query_cursor(query, batch_size, row_cap))
+
+    rounds = preview_rounds(sampler, plan, exact, budget_ms, confidence,
+                            app.config['PREVIEW_SAMPLE_SIZE'], bool(data.get('progressive')))
+
+    def capped(result):
+        result['truncated'] = len(result['rows']) > row_cap
+        result['rows'] = result['rows'][:row_cap]
+        if 'intervals' in result:
+            result['intervals'] = result['intervals'][:row_cap]
+        return json.dumps(result, default=json_default) + "\n"
+
+    if data.get('progressive'):
+        def stream():
+            try:
+                for result in rounds:
+                    yield capped(result)
+            except Exception as e:
+                yield json.dumps({'$error': str(e)}) + "\n"
+        return Response(stream_with_context(stream()), mimetype='application/x-ndjson')
+
+    try:
+        with STAGE_SECONDS.time('fetch', 'preview', collection):
+            result = None
+            for result in rounds:
+                pass
+    except Exception as e:
+        return jsonify({'message': f"Query failed: {str(e)}"}), 500
+    return Response(capped(result), mimetype='application/json')
+
+
+# Sampler for a preview: the embedded engine's frame when the backend would run the query
+# locally, otherwise $sample rounds against MongoDB
+def preview_sampler(query, plan):
+    from preview import FrameSampler, MongoSampler
+
+    key, accumulators, _ = plan
+    paths = list(dict.fromkeys(path for _, kind, path, _ in accumulators if kind != 'count'))
+    backend = app.config['EXECUTE_BACKEND']
+    if backend != 'mongo' and SCHEMAS.source(query['collection']) is not None:
+        return FrameSampler(get_local_engine().frame(query['collection']), key, paths)
+    if backend == 'local':
+        raise UnsupportedQuery(f"No local data for collection {query['collection']}")
+    return MongoSampler(get_mongo_connection(), query['collection'], key, paths, app.config['EXECUTE_MAX_TIME_MS'])
+
+
+# Count and sums per day / week / month of a collection's records in [start, end), from
+# the day rollups plus a scan of the partial days at the edges of the window
+@app.route('/api/time_window', methods=['POST'])
+def time_window():
+    data = request.get_json(silent=True) or {}
+    collection = data.get('collection')
+    field = data.get('field') or time_field(SCHEMAS.get(collection))
+    if field is None:
+        return jsonify({'message': f"No timestamp field known for collection {collection}"}), 400
+    try:
+        start = datetime.fromisoformat(data['start'])
+        end = datetime.fromisoformat(data['end'])
+        return jsonify(window_totals(get_mongo_connection(), collection, field, start, end, data.get('period', 'day'))), 200
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'message': f"Invalid time window: {str(e)}"}), 400
+    except Exception as e:
+        return jsonify({'message': f"Query failed: {str(e)}"}), 500
+
+
+# Tables of the MySQL database type (rows, columns, indexes), loading changed CSV uploads
+def explore_sql():
+    return {'db_type': 'mysql', 'tables': synced_sql_store().tables()}
+
+
+# Per-collection statistics (counts, sizes, indexes, inferred fields) from the stats cache
+@app.route('/api/explore', methods=['POST'])
+def explore():
+    data = request.get_json(silent=True) or {}
+    if wants_sql(data):
+        try:
+            return jsonify(explore_sql()), 200
+        except Exception as e:
+            return jsonify({'error': f"Failed to load the SQL tables: {str(e)}"}), 500
+    if data.get('db_type', 'mongodb') != 'mongodb':
+        return jsonify({'error': f"Exploring {data.get('db_type')} databases is not supported"}), 400
+    # The first request under a WSGI server starts the refresher; it waits for the first
+    # snapshot rather than answering with an empty collection list
+    STATS.start()
+    STATS.wait_ready()
+    return Response(STATS.payload, mimetype='application/json')
+
+
+# Stage latency histograms in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Connection pool statistics and the latest background health check
+@app.route('/api/admin/mongo', methods=['GET'])
+def mongo_pool_stats():
+    from mongo_pool import MONGO
+    return jsonify(MONGO.pool_stats()), 200
+
+
+# Observed filter / sort usage and index proposals; POST builds the proposals that have
+# crossed the usage threshold right away instead of waiting for the background builder
+@app.route('/api/admin/indexes', methods=['GET', 'POST'])
+def index_advisor_report():
+    if request.method == 'POST':
+        INDEX_ADVISOR.build_pending()
+    return jsonify(INDEX_ADVISOR.report()), 200
+
+
+# Group rollups per collection; POST {"collection": ...} recomputes that collection's
+# rollups from its documents, replacing them, and reports the groups that were wrong
+@app.route('/api/admin/rollups', methods=['GET', 'POST'])
+def rollups_report():
+    if request.method == 'GET':
+        ROLLUPS.refresh()
+        return jsonify(ROLLUPS.report()), 200
+    data = request.get_json(silent=True) or {}
+    collection = data.get('collection')
+    schema = SCHEMAS.get(collection)
+    if schema is None:
+        return jsonify({'message': f"Unknown collection {collection}"}), 400
+    # Rollups cover top-level fields only
+    attrs = [field for field in schema.qualitative if field in schema.fields and field != '_id' and schema.types.get(field) != 'date']
+    measures = [field for field in schema.quantitative if field in schema.fields]
+    try:
+        result = rebuild_group_rollups(get_mongo_connection(), collection, attrs, measures)
+    except Exception as e:
+        return jsonify({'message': f"Rebuild failed: {str(e)}"}), 500
+    RESULT_CACHE.bump(GROUP_ROLLUPS)
+    RESULT_CACHE.bump(ROLLUP_CATALOG)
+    ROLLUPS.refresh()
+    return jsonify({'collection': collection, 'attrs': result}), 200
 
 
+# Result cache size and hit / miss / eviction counters; DELETE empties the cache
+@app.route('/api/admin/result_cache', methods=['GET', 'DELETE'])
+def result_cache_report():
+    if request.method == 'DELETE':
+        RESULT_CACHE.clear()
+    return jsonify(RESULT_CACHE.stats()), 200
 
 
 if __name__ == '__main__':
+    from mongo_pool import MONGO
+    MONGO.start_health_check()
+    STATS.start()
+    ROLLUPS.start()
     app.run(debug=True)
\ No newline at end of file
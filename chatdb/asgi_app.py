@@ -0,0 +1,333 @@
+# Asynchronous serving mode. A plain ASGI application (no framework needed) exposing the
+# chat and query endpoints on one event loop, with MongoDB I/O on pymongo's native async
+# driver, so a slow aggregation waits on its socket instead of holding a worker thread.
+# Intent matching, query templates, request limits and metrics are the ones in app.py.
+# Every other endpoint (uploads, batches, previews, time windows, admin, the UI) is the
+# Flask view itself, run on a worker thread.
+#
+#   uvicorn asgi_app:application            (or any other ASGI server)
+import asyncio
+import json
+import sys
+import tempfile
+
+import app as sync_app
+from metrics import REGISTRY, STAGE_SECONDS
+from mongo_pool import ASYNC_MONGO, MONGO
+from query_exec import (
+    ListCursor, QueryParseError, UnsupportedQuery, end_line, ndjson_line, open_async_cursor, stream_ndjson,
+    stream_ndjson_async,
+)
+from result_cache import AsyncRecordingCursor, query_collections, result_key
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def send_body(send, status, body, content_type):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, status, payload):
+    await send_body(send, status, json.dumps(payload).encode(), "application/json")
+
+
+# JSON request body, or None when it is missing or malformed
+def decode_json(body):
+    try:
+        return json.loads(body) if body else None
+    except ValueError:
+        return None
+
+
+async def chat(scope, receive, send):
+    body = await read_body(receive)
+    try:
+        with STAGE_SECONDS.time("decode", "none", ""):
+            data = decode_json(body)
+        # Answering can block on pymongo (schema inference, sketch lookups): keep it off the loop
+        reply, status, intent = await asyncio.to_thread(sync_app.answer_chat, data)
+        kind, collection = (intent.kind, intent.collection or "") if intent else ("none", "")
+        with STAGE_SECONDS.time("respond", kind, collection):
+            await send_json(send, status, reply)
+    except Exception as e:
+        sync_app.app.logger.exception("Chat request failed")
+        await send_json(send, 500, {"error": f"Internal Server Error: {str(e)}"})
+
+
+async def execute_query(scope, receive, send):
+    data = decode_json(await read_body(receive))
+    if not data or "query" not in data:
+        return await send_json(send, 400, {"message": "Invalid request, query key missing"})
+    if sync_app.wants_sql(data):
+        return await execute_sql(data, send)
+    try:
+        query, batch_size, row_cap = sync_app.parse_execute_request(data)
+    except (QueryParseError, ValueError, TypeError) as e:
+        return await send_json(send, 400, {"message": str(e)})
+    if data.get("page_size") is not None:
+        return await execute_page(query, batch_size, row_cap, data, send)
+
+    collection = sync_app.collection_label(query["collection"])
+    key, collections = result_key(query, row_cap), query_collections(query)
+    cached = sync_app.RESULT_CACHE.get(key)
+    if cached is not None:
+        lines = [ndjson_line(row) for row in cached[0]]
+        lines.append(end_line(len(cached[0]), cached[1]))
+        return await send_body(send, 200, "".join(lines).encode(), "application/x-ndjson")
+
+    versions = sync_app.RESULT_CACHE.versions(collections)
+    try:
+        with STAGE_SECONDS.time("open", query["operation"], collection):
+            # The embedded engine is CPU-bound: run it off the event loop
+            rows = await asyncio.to_thread(sync_app.run_locally, query, row_cap)
+            if rows is None:
+                sync_app.INDEX_ADVISOR.record(query)
+                db = ASYNC_MONGO.get_database()
+                cursor = await open_async_cursor(db, query, batch_size, row_cap, sync_app.app.config["EXECUTE_MAX_TIME_MS"])
+    except UnsupportedQuery as e:
+        return await send_json(send, 400, {"message": str(e)})
+    except Exception as e:
+        return await send_json(send, 500, {"message": f"Query failed: {str(e)}"})
+
+    if rows is not None:
+        sync_app.RESULT_CACHE.put(key, collections, versions, rows[:row_cap], len(rows) > row_cap)
+        lines = [ndjson_line(row) for row in rows[:row_cap]]
+        lines.append(end_line(min(len(rows), row_cap), len(rows) > row_cap))
+        return await send_body(send, 200, "".join(lines).encode(), "application/x-ndjson")
+    cursor = AsyncRecordingCursor(cursor, sync_app.RESULT_CACHE, key, collections, versions, row_cap)
+    await stream_rows(send, cursor, row_cap, query)
+
+
+# NDJSON response streamed from an open async cursor, recording fetch / serialize time
+async def stream_rows(send, cursor, row_cap, query, page_token_for=None, hide=()):
+    collection = sync_app.collection_label(query["collection"])
+
+    def record_stream(fetch_seconds, serialize_seconds):
+        STAGE_SECONDS.observe(fetch_seconds, "fetch", query["operation"], collection)
+        STAGE_SECONDS.observe(serialize_seconds, "serialize", query["operation"], collection)
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"application/x-ndjson")],
+    })
+    stream = stream_ndjson_async(cursor, row_cap, on_complete=record_stream, page_token_for=page_token_for, hide=hide)
+    async for line in stream:
+        await send({"type": "http.response.body", "body": line.encode(), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+# One page of a find(), planned as on the Flask path (app.plan_page), so tokens from
+# either server are valid on the other
+async def execute_page(query, batch_size, row_cap, data, send):
+    try:
+        page_size, state, fingerprint = sync_app.parse_page_request(query, row_cap, data)
+    except (QueryParseError, ValueError, TypeError) as e:
+        return await send_json(send, 400, {"message": str(e)})
+
+    collection = sync_app.collection_label(query["collection"])
+    try:
+        with STAGE_SECONDS.time("open", "page", collection):
+            # A page the embedded engine serves is computed there: run it off the event loop
+            rows, page, this_page, token_for, hidden = await asyncio.to_thread(
+                sync_app.plan_page, query, page_size, state, fingerprint,
+            )
+            if rows is None:
+                db = ASYNC_MONGO.get_database()
+                cursor = await open_async_cursor(db, page, batch_size, this_page, sync_app.app.config["EXECUTE_MAX_TIME_MS"])
+    except (QueryParseError, UnsupportedQuery) as e:
+        return await send_json(send, 400, {"message": str(e)})
+    except Exception as e:
+        return await send_json(send, 500, {"message": f"Query failed: {str(e)}"})
+
+    if rows is not None:
+        body = "".join(stream_ndjson(ListCursor(rows), this_page, page_token_for=token_for))
+        return await send_body(send, 200, body.encode(), "application/x-ndjson")
+    await stream_rows(send, cursor, this_page, query, token_for, hidden)
+
+
+# SQL of the MySQL database type: SQLite connections belong to one thread, so the query
+# is opened and read to its end on one worker thread and sent as one body
+async def execute_sql(data, send):
+    from sql_backend import SqlError
+
+    def run():
+        cursor, row_cap = sync_app.open_sql_request(data)
+        return "".join(stream_ndjson(cursor, row_cap))
+
+    try:
+        with STAGE_SECONDS.time("open", "sql", "other"):
+            body = await asyncio.to_thread(run)
+    except (QueryParseError, ValueError, TypeError) as e:
+        return await send_json(send, 400, {"message": str(e)})
+    except SqlError as e:
+        return await send_json(send, 400, {"message": f"Query failed: {str(e)}"})
+    except Exception as e:
+        return await send_json(send, 500, {"message": f"Query failed: {str(e)}"})
+    await send_body(send, 200, body.encode(), "application/x-ndjson")
+
+
+async def explore(scope, receive, send):
+    data = decode_json(await read_body(receive)) or {}
+    if sync_app.wants_sql(data):
+        try:
+            tables = await asyncio.to_thread(sync_app.explore_sql)
+        except Exception as e:
+            return await send_json(send, 500, {"error": f"Failed to load the SQL tables: {str(e)}"})
+        return await send_json(send, 200, tables)
+    if data.get("db_type", "mongodb") != "mongodb":
+        return await send_json(send, 400, {"error": f"Exploring {data.get('db_type')} databases is not supported"})
+    sync_app.STATS.start()
+    await asyncio.to_thread(sync_app.STATS.wait_ready)
+    await send_body(send, 200, sync_app.STATS.payload.encode(), "application/json")
+
+
+async def metrics(scope, receive, send):
+    await send_body(send, 200, REGISTRY.render().encode(), "text/plain; version=0.0.4; charset=utf-8")
+
+
+async def mongo_pool_stats(scope, receive, send):
+    await send_json(send, 200, MONGO.pool_stats())
+
+
+# Request bodies handed to a Flask view are spooled to disk past this size (uploads)
+SPOOL_MAX_BYTES = 1024 * 1024
+
+# Response chunks of a Flask view buffered ahead of a slow client
+RELAY_QUEUE_SIZE = 16
+
+
+# WSGI environ of an ASGI HTTP scope with `body` (a file) as its input
+def wsgi_environ(scope, body, length):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "CONTENT_LENGTH": str(length),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name, value = name.decode("latin-1").upper().replace("-", "_"), value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            environ[name] = value
+        elif name != "CONTENT_LENGTH":
+            key = f"HTTP_{name}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+# Serve a request with the Flask app. The view runs, and its response is iterated, on
+# one worker thread (a streamed response keeps its request context there); chunks are
+# relayed through a bounded queue, so a slow client also slows the view down.
+async def flask_view(scope, receive, send):
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        while True:
+            message = await receive()
+            body.write(message.get("body", b""))
+            if not message.get("more_body"):
+                break
+        length = body.tell()
+        body.seek(0)
+        environ = wsgi_environ(scope, body, length)
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(RELAY_QUEUE_SIZE)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+        def relay(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def run():
+            try:
+                result = sync_app.app.wsgi_app(environ, start_response)
+                try:
+                    for chunk in result:
+                        if chunk:
+                            relay(chunk)
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+            except Exception as e:
+                relay(e)
+            relay(None)
+
+        worker = loop.run_in_executor(None, run)
+        item = await queue.get()
+        if isinstance(item, Exception) and "status" not in started:
+            sync_app.app.logger.error("Request to %s failed", scope["path"], exc_info=item)
+            await send_json(send, 500, {"error": f"Internal Server Error: {str(item)}"})
+        else:
+            await send({"type": "http.response.start", "status": started["status"], "headers": started["headers"]})
+            while item is not None:
+                if isinstance(item, Exception):
+                    # Headers are out: end the body, the client sees a truncated stream
+                    sync_app.app.logger.error("Response of %s failed", scope["path"], exc_info=item)
+                else:
+                    await send({"type": "http.response.body", "body": item, "more_body": True})
+                item = await queue.get()
+            await send({"type": "http.response.body", "body": b""})
+        # Drain what the worker still relays so it is never left blocked on a full queue
+        while item is not None:
+            item = await queue.get()
+        await worker
+    finally:
+        body.close()
+
+
+ROUTES = {
+    ("POST", "/api/chat"): chat,
+    ("POST", "/api/execute_query"): execute_query,
+    ("POST", "/api/explore"): explore,
+    ("GET", "/metrics"): metrics,
+    ("GET", "/api/admin/mongo"): mongo_pool_stats,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            sync_app.STATS.start()
+            sync_app.ROLLUPS.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await ASYNC_MONGO.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    handler = ROUTES.get((scope["method"], scope["path"]), flask_view)
+    await handler(scope, receive, send)
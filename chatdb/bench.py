@@ -0,0 +1,534 @@
+# Offline benchmarks for ChatDB hot paths. Run from the chatdb/ directory:
+#   python bench.py                      run every suite, compare with bench_baseline.json
+#   python bench.py --only chat,ingest   run some suites
+#   python bench.py --update-baseline    store this run as the new baseline
+# Results are written as JSON (--output); the run exits non-zero when any metric is worse
+# than the baseline by more than --tolerance. MongoDB is replaced by mongomock, so the
+# suite needs no server. The serve suite starts the Flask and the ASGI server (uvicorn)
+# as subprocesses on local ports and compares them under the same closed-loop load.
+#
+# Timings and rates depend on the machine, so the gate compares them relative to a fixed
+# reference workload timed before every suite (the fastest of those runs, which is steady
+# where a single one is not): a duration is stored as a multiple of the reference time, a
+# rate as work per reference time. Memory peaks and ratios are compared as they are. A
+# baseline recorded on one machine then holds on another.
+import argparse
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from bson import json_util
+
+from ingest import iter_json_array
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+UPLOADS = os.path.join(HERE, "uploads")
+BASELINE = os.path.join(HERE, "bench_baseline.json")
+TOLERANCE = 0.25
+
+
+# Best wall time over `repeat` runs, and peak traced memory of one extra run
+def measure(fn, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"seconds": best, "peak_bytes": peak}
+
+
+# Units of metrics that do not depend on the speed of the machine
+ABSOLUTE_UNITS = ("bytes", "ratio")
+
+
+# Fixed pure-Python workload (JSON, regex, dicts, sorting) the suites are measured against
+def reference_workload():
+    pattern = re.compile(r"(\w+)\s+by\s+(\w+)")
+    documents = [{"name": f"item{i}", "value": i * 1.5, "tags": ["a", "b", str(i)]} for i in range(2000)]
+    decoded = json.loads(json.dumps(documents))
+    total = 0
+    for document in decoded:
+        total += len(pattern.findall(f"total {document['name']} by value")) + int(document["value"])
+    decoded.sort(key=lambda document: -document["value"])
+    return total
+
+
+# Best time of the reference workload, in seconds
+def reference_seconds(repeat=9):
+    reference_workload()
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        reference_workload()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# Add the machine-independent "relative" value to the timing and rate metrics of a suite
+def normalize(metrics, reference):
+    for metric in metrics.values():
+        if metric.get("unit") in ABSOLUTE_UNITS:
+            continue
+        seconds = metric["value"] / {"us": 1e6, "ms": 1e3}.get(metric.get("unit"), 1.0)
+        if metric["better"] == "higher":
+            metric["relative"] = metric["value"] * reference
+        else:
+            metric["relative"] = seconds / reference
+    return metrics
+
+
+# Write `copies` repetitions of an uploads/*.json array into one larger array file;
+# drop_ids removes _id so the copies can be inserted into one collection
+def build_json_fixture(name, copies, drop_ids=False):
+    with open(os.path.join(UPLOADS, name), encoding="utf-8") as handle:
+        documents = json.load(handle)
+    if drop_ids:
+        documents = [{k: v for k, v in d.items() if k != "_id"} for d in documents]
+    fd, path = tempfile.mkstemp(suffix=".json")
+    with os.fdopen(fd, "w", encoding="utf-8") as out:
+        out.write("[\n")
+        for i in range(copies):
+            for j, document in enumerate(documents):
+                if i or j:
+                    out.write(",\n")
+                json.dump(document, out)
+        out.write("\n]\n")
+    return path
+
+
+# The naive path: parse the whole file, then walk the tree converting $oid / $date
+def load_then_convert(path):
+    def convert(value):
+        if isinstance(value, list):
+            return [convert(item) for item in value]
+        if isinstance(value, dict):
+            return json_util.object_hook({key: convert(item) for key, item in value.items()})
+        return value
+
+    with open(path, encoding="utf-8") as handle:
+        return convert(json.load(handle))
+
+
+# Streaming path: one element at a time, converted while parsing
+def stream_documents(path):
+    count = 0
+    with open(path, encoding="utf-8") as handle:
+        for _ in iter_json_array(handle):
+            count += 1
+    return count
+
+
+def bench_json_decode(copies=2000):
+    results = {}
+    for name in ("orders.json", "products.json", "reviews.json", "users.json"):
+        path = build_json_fixture(name, copies)
+        try:
+            size = os.path.getsize(path)
+            documents = stream_documents(path)
+            naive = measure(lambda: load_then_convert(path))
+            streaming = measure(lambda: stream_documents(path))
+        finally:
+            os.remove(path)
+        results[name] = {
+            "bytes": size,
+            "documents": documents,
+            "naive": naive,
+            "streaming": streaming,
+        }
+    return results
+
+
+def print_json_decode(results):
+    print(f"{'file':<15}{'docs':>8}{'naive s':>10}{'stream s':>10}{'naive MB':>10}{'stream MB':>11}")
+    for name, row in results.items():
+        print(
+            f"{name:<15}{row['documents']:>8}"
+            f"{row['naive']['seconds']:>10.3f}{row['streaming']['seconds']:>10.3f}"
+            f"{row['naive']['peak_bytes'] / 2**20:>10.1f}{row['streaming']['peak_bytes'] / 2**20:>11.2f}"
+        )
+
+
+# Chat messages covering every construct keyword and query pattern for each collection,
+# explore / sample requests, misses, and long messages that mention many keywords
+def chat_corpus(app, size=2000, seed=1):
+    rng = random.Random(seed)
+    collections = app.SCHEMAS.collections()
+    shapes = [
+        "total {a} by {b} in {c}",
+        "average {a} by {b} for {c}",
+        "count of {b} in {c}",
+        "{c} with {a} greater than 100",
+        "{c} sorted by {a}",
+        "group by {b} in {c}",
+        "find total {a} by {b} in {c}",
+        "show average {a} by {b} in {c}",
+        "list count of {b} in {c}",
+        "find {a} greater than {n} in {c}",
+        "list all {b} sorted by {a} in {c}",
+        "top {n} {b} by {a} in {c}",
+        "sample queries for {c}",
+        "explore the database",
+        "sample queries",
+        "what is the weather like today",
+        "please tell me something interesting about the data you have",
+    ]
+    filler = "could you please help me understand what is going on with the numbers here and "
+    messages = []
+    for i in range(size):
+        c = rng.choice(collections)
+        schema = app.SCHEMAS.get(c)
+        a = rng.choice(schema.quantitative or ["value"])
+        b = rng.choice(schema.qualitative or ["name"])
+        message = rng.choice(shapes).format(a=a, b=b, c=c, n=rng.randint(1, 500))
+        if i % 10 == 0:
+            message = filler * rng.randint(5, 20) + message
+        messages.append(message)
+    return messages
+
+
+def bench_chat(app, size=2000):
+    messages = chat_corpus(app, size)
+    app.determine_response(messages[0])
+    timing = measure(lambda: [app.determine_response(m) for m in messages])
+    return {"messages_per_sec": {"value": len(messages) / timing["seconds"], "better": "higher"}}
+
+
+# Mean cost of one generate_mongo_query call per template, over every collection
+def bench_generate(app, repeat=5000):
+    results = {}
+    collections = [c for c in app.SCHEMAS.collections() if not str(app.generate_mongo_query("count of <B>", c)).startswith("Error")]
+    for template in sorted(set(app.CONSTRUCT_KEYWORDS.values())):
+        if str(app.generate_mongo_query(template, collections[0])).startswith("Error"):
+            continue
+
+        def run():
+            random.seed(0)
+            for collection in collections:
+                for _ in range(repeat):
+                    app.generate_mongo_query(template, collection)
+
+        timing = measure(run, repeat=9)
+        results[template] = {"value": timing["seconds"] / (repeat * len(collections)) * 1e6, "better": "lower", "unit": "us"}
+    return results
+
+
+# Shell texts typed into the execute box: the sample queries and rendered chat templates
+# of every collection, plus cursor chains, projections and distinct()
+def shell_corpus(app):
+    texts = []
+    for collection in app.SCHEMAS.collections():
+        texts.extend(text for text in app.generate_sample_queries(collection) if text.lstrip().startswith("db."))
+        for template in sorted(set(app.CONSTRUCT_KEYWORDS.values())):
+            query = app.generate_mongo_query(template, collection)
+            if isinstance(query, app.MongoQuery):
+                texts.append(str(query))
+        schema = app.SCHEMAS.get(collection)
+        for field in (schema.quantitative + schema.qualitative)[:3]:
+            texts.append(f'db.{collection}.find({{"{field}": {{"$exists": true}}}}, {{"{field}": 1, "_id": 0}})'
+                         f'.sort({{"{field}": -1}}).skip(10).limit(5)')
+            texts.append(f'db.getCollection("{collection}").distinct("{field}")')
+    return texts
+
+
+# Per-query cost of parsing the shell corpus without and with the parse cache, next to
+# one find_one() from mongomock (which stands in for the server here; a real round trip
+# costs more)
+def bench_parse(app, repeat=200):
+    import mongomock
+    from query_exec import parse_shell_query, parse_shell_text
+
+    texts = shell_corpus(app)
+    per_query = repeat * len(texts)
+
+    def run(parse):
+        for _ in range(repeat):
+            for text in texts:
+                parse(text)
+
+    parse_shell_query(texts[0])
+    cold = measure(lambda: run(parse_shell_text))
+    cached = measure(lambda: run(parse_shell_query))
+
+    collection = mongomock.MongoClient().db.products
+    with open(os.path.join(UPLOADS, "products.json"), encoding="utf-8") as handle:
+        collection.insert_many([document for document in iter_json_array(handle)])
+    fetch_repeat = 2000
+    fetch = measure(lambda: [collection.find_one({"price": {"$gt": 0}}) for _ in range(fetch_repeat)])
+
+    cold_us = cold["seconds"] / per_query * 1e6
+    fetch_us = fetch["seconds"] / fetch_repeat * 1e6
+    return {
+        "parse_us": {"value": cold_us, "better": "lower", "unit": "us"},
+        "cached_parse_us": {"value": cached["seconds"] / per_query * 1e6, "better": "lower", "unit": "us"},
+        "find_one_us": {"value": fetch_us, "better": "lower", "unit": "us"},
+        "parse_to_find_one": {"value": cold_us / fetch_us, "better": "lower", "unit": "ratio"},
+    }
+
+
+# mongomock's bulk_write predates the write models of current pymongo releases; apply
+# the upserts of the rollups one by one instead
+def mongomock_bulk_write(collection, requests, ordered=True):
+    upserted = {}
+    for i, request in enumerate(requests):
+        result = collection.update_one(request._filter, request._doc, upsert=request._upsert)
+        if result.upserted_id is not None:
+            upserted[i] = result.upserted_id
+    return SimpleNamespace(upserted_ids=upserted)
+
+
+# Best rows/s of ingesting uploads/sales.csv and the Extended JSON files (repeated
+# `copies` times, since they hold only a handful of documents) into mongomock
+def bench_ingest(copies=200):
+    import mongomock
+    from ingest import INGEST_CHUNK_SIZE, ingest_file
+
+    mongomock.collection.Collection.bulk_write = mongomock_bulk_write
+
+    results = {}
+    for name in ("sales.csv", "orders.json", "products.json", "reviews.json", "users.json"):
+        path = os.path.join(UPLOADS, name) if name.endswith(".csv") else build_json_fixture(name, copies, drop_ids=True)
+        try:
+            best = 0.0
+            for _ in range(3):
+                report = ingest_file(path, mongomock.MongoClient().db, INGEST_CHUNK_SIZE)
+                best = max(best, report.inserted / report.seconds if report.seconds else 0.0)
+        finally:
+            if path.startswith(tempfile.gettempdir()):
+                os.remove(path)
+        results[f"{name} rows_per_sec"] = {"value": best, "better": "higher"}
+    return results
+
+
+def json_decode_metrics(decode):
+    results = {}
+    for name, row in decode.items():
+        results[f"{name} streaming_seconds"] = {"value": row["streaming"]["seconds"], "better": "lower"}
+        results[f"{name} streaming_peak_bytes"] = {"value": row["streaming"]["peak_bytes"], "better": "lower", "unit": "bytes"}
+    return results
+
+
+# (module, self us, cumulative us) rows of a -X importtime report
+def parse_importtime(report):
+    rows = []
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((name.rstrip(), int(own), int(cumulative)))
+    return rows
+
+
+# Cold start of a worker: `import app` in a fresh interpreter, best of `runs`, with the
+# -X importtime breakdown of the fastest run
+def bench_startup(runs=5):
+    best = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import app"],
+            cwd=HERE, capture_output=True, text=True, check=True,
+        )
+        wall = time.perf_counter() - started
+        if best is None or wall < best[0]:
+            best = (wall, parse_importtime(proc.stderr))
+    wall, rows = best
+    app_row = next(row for row in rows if row[0].strip() == "app")
+    return {
+        "cold_start_ms": {"value": wall * 1000, "better": "lower", "unit": "ms"},
+        "app_import_ms": {"value": app_row[2] / 1000, "better": "lower", "unit": "ms"},
+    }, rows
+
+
+def print_importtime(rows, top=15):
+    print(f"{'module':<45}{'self ms':>10}{'cumul ms':>10}")
+    for name, own, cumulative in sorted(rows, key=lambda row: -row[2])[:top]:
+        print(f"{name:<45}{own / 1000:>10.1f}{cumulative / 1000:>10.1f}")
+
+
+# The servers the serve suite compares: command lines taking the port to listen on
+SERVERS = {
+    "flask": lambda port: [
+        sys.executable, "-c",
+        "import sys, app; from werkzeug.serving import make_server; "
+        "make_server('127.0.0.1', int(sys.argv[1]), app.app, threaded=True).serve_forever()",
+        str(port),
+    ],
+    "asgi": lambda port: [
+        sys.executable, "-m", "uvicorn", "asgi_app:application", "--port", str(port), "--log-level", "warning",
+    ],
+}
+
+# (path, body) of the serve workloads: a chat message, and a $group the embedded engine
+# answers with the result cache off, so neither needs a MongoDB server
+SERVE_WORKLOADS = {
+    "chat": ("/api/chat", {"message": "find total transaction_qty by store_location in sales"}),
+    "execute": ("/api/execute_query", {"query": 'db.sales.aggregate([{"$group": {"_id": "$store_location", "total": {"$sum": "$transaction_qty"}}}])'}),
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server on port {port} did not start")
+
+
+# Throughput and p99 latency of the threaded Flask server and the ASGI server under the
+# load test's closed loop of `concurrency` clients, and the ASGI/Flask throughput ratio
+def bench_serve(concurrency=50, duration=5.0):
+    import asyncio
+
+    from loadtest import request, run
+
+    env = dict(os.environ, CHATDB_EXECUTE_BACKEND="local", CHATDB_RESULT_CACHE_SIZE="0")
+    results, throughput = {}, {}
+    for server, command in SERVERS.items():
+        port = free_port()
+        proc = subprocess.Popen(command(port), cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            for workload, (path, body) in SERVE_WORKLOADS.items():
+                # One request first, so the loads of the schemas and the embedded engine are
+                # not part of the measurement
+                asyncio.run(request("127.0.0.1", port, path, json.dumps(body).encode()))
+                row = asyncio.run(run(f"http://127.0.0.1:{port}", path, json.dumps(body).encode(), concurrency, duration))
+                if row["errors"] or not row["requests"]:
+                    raise RuntimeError(f"{server} {workload}: {row['errors']} failed requests")
+                throughput[server, workload] = row["requests_per_sec"]
+                results[f"{server} {workload} requests_per_sec"] = {"value": row["requests_per_sec"], "better": "higher"}
+                results[f"{server} {workload} p99_ms"] = {"value": row["p99_ms"], "better": "lower", "unit": "ms"}
+        finally:
+            proc.terminate()
+            proc.wait()
+    for workload in SERVE_WORKLOADS:
+        ratio = throughput["asgi", workload] / throughput["flask", workload]
+        results[f"asgi/flask {workload} throughput"] = {"value": ratio, "better": "higher", "unit": "ratio"}
+    return results
+
+
+# Metrics worse than the baseline by more than `tolerance` (a fraction of the baseline),
+# compared by their relative values where they have one
+def regressions(results, baseline, tolerance):
+    found = []
+    for suite, metrics in results.items():
+        for name, metric in metrics.items():
+            previous = baseline.get(suite, {}).get(name)
+            key = "relative" if "relative" in metric else "value"
+            if previous is None or not previous.get(key):
+                continue
+            change = (metric[key] - previous[key]) / previous[key]
+            if metric["better"] == "higher":
+                change = -change
+            if change > tolerance:
+                found.append(f"{suite}: {name}: {key} {previous[key]:.6g} -> {metric[key]:.6g} ({change:+.0%} worse)")
+    return found
+
+
+SUITES = ("startup", "chat", "generate", "parse", "ingest", "json", "serve")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline ChatDB benchmarks")
+    parser.add_argument("--only", default=",".join(SUITES), help="comma-separated suites: " + ", ".join(SUITES))
+    parser.add_argument("--output", default="bench_results.json", help="where to write this run's results")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="allowed slowdown as a fraction of the baseline")
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    suites = [name.strip() for name in args.only.split(",") if name.strip()]
+    results = {}
+    references = []
+    if "startup" in suites:
+        references.append(reference_seconds())
+        results["startup"], importtime = bench_startup()
+        print_importtime(importtime)
+    if "chat" in suites or "generate" in suites or "parse" in suites:
+        import app
+        import mongomock
+        # Rollup lookups read an (empty) catalog rather than waiting on a server
+        app.ROLLUPS.get_database = mongomock.MongoClient().get_database
+        app.ROLLUPS.refresh()
+        if "chat" in suites:
+            references.append(reference_seconds())
+            results["chat"] = bench_chat(app)
+        if "generate" in suites:
+            references.append(reference_seconds())
+            results["generate"] = bench_generate(app)
+        if "parse" in suites:
+            references.append(reference_seconds())
+            results["parse"] = bench_parse(app)
+    if "ingest" in suites:
+        references.append(reference_seconds())
+        results["ingest"] = bench_ingest()
+    if "json" in suites:
+        references.append(reference_seconds())
+        decode = bench_json_decode()
+        print_json_decode(decode)
+        results["json"] = json_decode_metrics(decode)
+    if "serve" in suites:
+        references.append(reference_seconds())
+        results["serve"] = bench_serve()
+
+    reference = min(references, default=None)
+    if reference is not None:
+        print(f"reference workload {reference * 1e3:.2f} ms")
+    for suite, metrics in results.items():
+        normalize(metrics, reference)
+        print(f"[{suite}]")
+        for name, metric in metrics.items():
+            relative = f"{metric['relative']:>14.6g} relative" if "relative" in metric else ""
+            print(f"  {name:<55}{metric['value']:>14.6g} {metric.get('unit', ''):<3}{relative}")
+
+    with open(args.output, "w", encoding="utf-8") as handle:
+        json.dump(results, handle, indent=2)
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding="utf-8") as handle:
+                baseline = json.load(handle)
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as handle:
+            json.dump(baseline, handle, indent=2)
+        print(f"baseline updated: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}; run with --update-baseline to create one")
+        return 0
+    with open(args.baseline, encoding="utf-8") as handle:
+        baseline = json.load(handle)
+    found = regressions(results, baseline, args.tolerance)
+    for line in found:
+        print("REGRESSION " + line)
+    return 1 if found else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
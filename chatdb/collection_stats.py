@@ -0,0 +1,106 @@
+import json
+import os
+import threading
+import time
+
+from ingest import is_internal_collection
+
+
+# Seconds between background refreshes of the explore statistics
+STATS_REFRESH_INTERVAL = float(os.environ.get("CHATDB_STATS_REFRESH_INTERVAL", "300"))
+
+# Seconds a request waits for the first snapshot before serving the empty one
+STATS_FIRST_REFRESH_TIMEOUT = float(os.environ.get("CHATDB_STATS_FIRST_REFRESH_TIMEOUT", "30"))
+
+
+# Per-collection statistics for /api/explore. A daemon thread rebuilds the snapshot on an
+# interval (or right after an upload asks for it) and stores it already serialized, so
+# serving it is a constant-time read whatever the number of collections.
+class CollectionStatsCache:
+    def __init__(self, get_database, schemas, interval=STATS_REFRESH_INTERVAL):
+        self.get_database = get_database
+        self.schemas = schemas
+        self.interval = interval
+        self._wake = threading.Event()
+        self._ready = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.snapshot = {"database": "chatdb", "refreshed_at": None, "collections": {}, "error": None}
+        self.payload = json.dumps(self.snapshot)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name="collection-stats", daemon=True)
+            self._thread.start()
+
+    # Wait until the first refresh has stored a snapshot; False if it timed out
+    def wait_ready(self, timeout=STATS_FIRST_REFRESH_TIMEOUT):
+        return self._ready.wait(timeout)
+
+    # Ask the background thread to refresh now, e.g. after an upload
+    def request_refresh(self):
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            self.refresh()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def refresh(self):
+        collections = {}
+        error = None
+        try:
+            db = self.get_database()
+            for name in db.list_collection_names():
+                if not is_internal_collection(name):
+                    self.schemas.register_collection(name)
+            for name in self.schemas.collections():
+                collections[name] = self._collection_stats(db, name)
+        except Exception as err:
+            error = str(err)
+            for name in self.schemas.collections():
+                collections[name] = self._schema_entry(name)
+
+        snapshot = {
+            "database": "chatdb",
+            "refreshed_at": time.time(),
+            "collections": collections,
+            "error": error,
+        }
+        payload = json.dumps(snapshot, default=str)
+        self.snapshot, self.payload = snapshot, payload
+        self._ready.set()
+        return snapshot
+
+    def _schema_entry(self, name):
+        schema = self.schemas.get(name)
+        return {
+            "estimated_count": None,
+            "size_bytes": None,
+            "storage_size_bytes": None,
+            "avg_document_bytes": None,
+            "indexes": [],
+            "fields": schema.types if schema else {},
+            "quantitative": schema.quantitative if schema else [],
+            "qualitative": schema.qualitative if schema else [],
+        }
+
+    def _collection_stats(self, db, name):
+        entry = self._schema_entry(name)
+        collection = db[name]
+        entry["estimated_count"] = collection.estimated_document_count()
+        try:
+            stats = db.command("collStats", name)
+            entry["size_bytes"] = stats.get("size")
+            entry["storage_size_bytes"] = stats.get("storageSize")
+            entry["avg_document_bytes"] = stats.get("avgObjSize")
+        except Exception:
+            pass
+        entry["indexes"] = [
+            {"name": index_name, "keys": [[field, direction] for field, direction in info["key"]], "unique": info.get("unique", False)}
+            for index_name, info in collection.index_information().items()
+        ]
+        return entry
@@ -0,0 +1,298 @@
+# Typed columnar cache for uploaded CSV files.
+#
+# Each CSV is converted once into one .npy file per column (int64 / float64 values, or
+# int32 codes into a JSON list of categories for text columns) inside
+# <upload folder>/.columnar/<file name>-<content hash>/. The file is read in chunks and
+# the columns are written to memory-mapped files, so converting holds one chunk in
+# memory. Later loads memory-map the arrays, so only the columns a query touches are
+# ever read from disk.
+#
+#   python columnar_cache.py rebuild [file.csv ...]
+#   python columnar_cache.py verify [--deep] [file.csv ...]
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+
+CACHE_DIRNAME = ".columnar"
+MANIFEST = "manifest.json"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Rows parsed per chunk while converting a CSV
+COLUMNAR_CHUNK_ROWS = int(os.environ.get("CHATDB_COLUMNAR_CHUNK_ROWS", "50000"))
+
+# Category of missing text values (NaN, as pandas reads them; one object so it is one key)
+MISSING = float("nan")
+
+
+def content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_root(path):
+    return os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIRNAME)
+
+
+# Column arrays of one cached file. Arrays are memory-mapped on first access; a store
+# built in memory (when the cache directory is not writable) holds them directly.
+class ColumnStore:
+    def __init__(self, manifest, directory=None, arrays=None, categories=None):
+        self.manifest = manifest
+        self.directory = directory
+        self.length = manifest["length"]
+        self.kinds = {column["name"]: column["kind"] for column in manifest["columns"]}
+        self.names = list(self.kinds)
+        self._files = {column["name"]: column for column in manifest["columns"]}
+        self._arrays = dict(arrays or {})
+        self._categories = dict(categories or {})
+
+    def array(self, name):
+        values = self._arrays.get(name)
+        if values is None:
+            filename = os.path.join(self.directory, self._files[name]["file"])
+            values = self._arrays[name] = np.load(filename, mmap_mode="r")
+        return values
+
+    def categories(self, name):
+        values = self._categories.get(name)
+        if values is None:
+            filename = os.path.join(self.directory, self._files[name]["categories"])
+            with open(filename, encoding="utf-8") as handle:
+                items = json.load(handle)
+            values = np.empty(len(items), dtype=object)
+            values[:] = items
+            self._categories[name] = values
+        return values
+
+
+# Kind of a column from the pandas dtype kinds of its chunks: int, float once a chunk has
+# fractions or gaps, else category. Returns (kind, dtype to read it with, None to infer).
+def column_kind(kinds):
+    if kinds <= set("iu"):
+        return "int", "int64"
+    if kinds <= set("iuf"):
+        return "float", "float64"
+    return "category", object if "O" in kinds else None
+
+
+# Array of `length` values, memory-mapped onto `filename` when given
+def new_array(filename, dtype, length):
+    if filename is None or length == 0:
+        return np.empty(length, dtype=dtype)
+    return np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=(length,))
+
+
+# Typed arrays for every column of a CSV: (manifest columns, arrays, categories, length).
+# A first pass over the chunks settles each column's kind for the whole file; the second
+# fills the arrays one chunk at a time. With `directory` the arrays are .npy files there.
+def convert_csv(path, directory=None, chunk_rows=COLUMNAR_CHUNK_ROWS):
+    import pandas as pd
+
+    names = [str(name) for name in pd.read_csv(path, nrows=0).columns]
+    seen = {name: set() for name in names}
+    length = 0
+    for chunk in pd.read_csv(path, chunksize=chunk_rows):
+        length += len(chunk)
+        for name, series in chunk.items():
+            seen[str(name)].add(series.dtype.kind)
+
+    columns, arrays, categories, dtypes, index = [], {}, {}, {}, {}
+    for i, name in enumerate(names):
+        kind, dtype = column_kind(seen[name] or {"O"})
+        entry = {"name": name, "file": f"{i}.npy", "kind": kind}
+        if dtype is not None:
+            dtypes[name] = dtype
+        filename = os.path.join(directory, entry["file"]) if directory else None
+        if kind == "category":
+            entry["categories"] = f"{i}.categories.json"
+            arrays[name] = new_array(filename, "int32", length)
+            index[name] = {}
+        else:
+            arrays[name] = new_array(filename, dtype, length)
+        columns.append(entry)
+
+    offset = 0
+    for chunk in pd.read_csv(path, chunksize=chunk_rows, dtype=dtypes or None):
+        end = offset + len(chunk)
+        for name, column in chunk.items():
+            name = str(name)
+            if name not in index:
+                arrays[name][offset:end] = column.to_numpy(dtype=arrays[name].dtype)
+                continue
+            # Codes of this chunk's values, renumbered into the file-wide categories in
+            # order of first appearance; every chunk's missing value is the one MISSING
+            values = column.astype(object).where(column.notna(), None).to_numpy()
+            codes, uniques = pd.factorize(values, use_na_sentinel=False)
+            known = index[name]
+            renumber = np.array(
+                [known.setdefault(MISSING if value != value else value, len(known)) for value in uniques], dtype="int32",
+            )
+            arrays[name][offset:end] = renumber[codes] if len(codes) else codes
+        offset = end
+
+    for name, known in index.items():
+        categories[name] = np.empty(len(known), dtype=object)
+        categories[name][:] = list(known)
+    for values in arrays.values():
+        if isinstance(values, np.memmap):
+            values.flush()
+    return columns, arrays, categories, length
+
+
+def write_cache(path, digest):
+    root = cache_root(path)
+    try:
+        os.makedirs(root, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=root)
+    except OSError:
+        staging = None
+    try:
+        columns, arrays, categories, length = convert_csv(path, staging)
+    except BaseException:
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+        raise
+    stat = os.stat(path)
+    manifest = {
+        "source": os.path.basename(path),
+        "sha256": digest,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "length": length,
+        "columns": columns,
+    }
+    if staging is None:
+        return ColumnStore(manifest, arrays=arrays, categories=categories)
+
+    for column in columns:
+        if not isinstance(arrays[column["name"]], np.memmap):
+            np.save(os.path.join(staging, column["file"]), arrays[column["name"]])
+        if column["kind"] == "category":
+            with open(os.path.join(staging, column["categories"]), "w", encoding="utf-8") as handle:
+                json.dump(categories[column["name"]].tolist(), handle)
+    arrays.clear()
+    with open(os.path.join(staging, MANIFEST), "w", encoding="utf-8") as handle:
+        json.dump(manifest, handle)
+
+    target = os.path.join(root, f"{os.path.basename(path)}-{digest[:16]}")
+    remove_stale(path)
+    os.replace(staging, target)
+    return ColumnStore(manifest, directory=target)
+
+
+# Cache directories of a source file (one per content hash seen)
+def cache_dirs(path):
+    root = cache_root(path)
+    prefix = os.path.basename(path) + "-"
+    if not os.path.isdir(root):
+        return []
+    return [os.path.join(root, name) for name in os.listdir(root) if name.startswith(prefix) and len(name) == len(prefix) + 16]
+
+
+def remove_stale(path):
+    for directory in cache_dirs(path):
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST), encoding="utf-8") as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+# Column store for a CSV file, building the cache if it is missing or stale. The content
+# hash is only recomputed when the file's size or mtime no longer match the manifest.
+def open_store(path, rebuild=False):
+    stat = os.stat(path)
+    digest = None
+    if not rebuild:
+        for directory in cache_dirs(path):
+            manifest = read_manifest(directory)
+            if manifest is None:
+                continue
+            if manifest["size"] == stat.st_size and manifest["mtime"] == stat.st_mtime:
+                return ColumnStore(manifest, directory=directory)
+            digest = digest or content_hash(path)
+            if manifest["sha256"] == digest:
+                return ColumnStore(manifest, directory=directory)
+    return write_cache(path, digest or content_hash(path))
+
+
+# Check a cache against its source; with deep=True also compare every value with a
+# fresh parse of the CSV. Returns a list of problems (empty when the cache is good).
+def verify_store(path, deep=False):
+    directories = cache_dirs(path)
+    if not directories:
+        return ["no cache"]
+    problems = []
+    digest = content_hash(path)
+    for directory in directories:
+        manifest = read_manifest(directory)
+        if manifest is None:
+            problems.append(f"{directory}: unreadable manifest")
+            continue
+        if manifest["sha256"] != digest:
+            problems.append(f"{directory}: stale (source content changed)")
+            continue
+        store = ColumnStore(manifest, directory=directory)
+        for name in store.names:
+            try:
+                values = store.array(name)
+            except (OSError, ValueError) as err:
+                problems.append(f"{directory}: column {name}: {err}")
+                continue
+            if len(values) != store.length:
+                problems.append(f"{directory}: column {name}: {len(values)} rows, expected {store.length}")
+        if deep and not problems:
+            columns, arrays, categories, length = convert_csv(path)
+            for column in columns:
+                name = column["name"]
+                expected = arrays[name] if column["kind"] != "category" else categories[name][arrays[name]]
+                actual = store.array(name) if column["kind"] != "category" else store.categories(name)[store.array(name)]
+                if column["kind"] == "float":
+                    same = np.array_equal(expected, actual, equal_nan=True)
+                else:
+                    same = len(expected) == len(actual) and all(a == b or a != a and b != b for a, b in zip(expected, actual))
+                if not same:
+                    problems.append(f"{directory}: column {name} differs from the source")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild or verify the columnar cache of uploaded CSV files")
+    parser.add_argument("command", choices=["rebuild", "verify"])
+    parser.add_argument("files", nargs="*", help="CSV files (default: every CSV in uploads/)")
+    parser.add_argument("--deep", action="store_true", help="verify: compare every value with the source")
+    args = parser.parse_args(argv)
+
+    files = args.files
+    if not files:
+        folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
+        files = [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.lower().endswith(".csv")]
+
+    failed = False
+    for path in files:
+        if args.command == "rebuild":
+            store = open_store(path, rebuild=True)
+            print(f"{path}: {store.length} rows, {len(store.names)} columns -> {store.directory}")
+        else:
+            problems = verify_store(path, deep=args.deep)
+            failed = failed or bool(problems)
+            print(f"{path}: " + ("ok" if not problems else "; ".join(problems)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
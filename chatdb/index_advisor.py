@@ -0,0 +1,259 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+# Executions of one query shape before an index is built for it
+INDEX_ADVISOR_THRESHOLD = int(os.environ.get("CHATDB_INDEX_ADVISOR_THRESHOLD", "5"))
+
+# Indexes the advisor builds on one collection at most; every index slows each write, and
+# MongoDB allows 64 per collection
+INDEX_ADVISOR_MAX_INDEXES = int(os.environ.get("CHATDB_INDEX_ADVISOR_MAX_INDEXES", "8"))
+
+# MongoDB's limit on the indexes of a collection, _id included
+MONGO_MAX_INDEXES = 64
+
+# Query shapes tracked at most; the least recently seen proposal is forgotten first
+INDEX_ADVISOR_MAX_PROPOSALS = int(os.environ.get("CHATDB_INDEX_ADVISOR_MAX_PROPOSALS", "500"))
+
+# Fields whose usage is counted per collection and kind (filtered, sorted, grouped)
+INDEX_ADVISOR_MAX_FIELDS = int(os.environ.get("CHATDB_INDEX_ADVISOR_MAX_FIELDS", "200"))
+
+# 'off' only records usage, 'auto' also builds the proposed indexes
+INDEX_ADVISOR_MODE = os.environ.get("CHATDB_INDEX_ADVISOR_MODE", "auto")
+
+# Index-relevant shape of a parsed query: (equality fields, sort keys, range fields,
+# grouped fields).
+# For aggregations only the leading $match / $sort stages can use an index; a $group key
+# is reported as usage but never indexed, since a $group with nothing in front of it
+# reads the whole collection either way.
+def query_shape(query):
+    equality, sort, ranges, grouped = [], [], [], []
+    if query["operation"] == "find":
+        filters = [query.get("filter") or {}]
+        sort = list(query.get("sort") or [])
+    else:
+        filters = []
+        leading = True
+        for stage in query["pipeline"]:
+            if not isinstance(stage, dict) or len(stage) != 1:
+                break
+            (operator, argument), = stage.items()
+            if operator == "$group" and isinstance(argument, dict):
+                key = argument.get("_id")
+                if isinstance(key, str) and key.startswith("$"):
+                    grouped.append(key[1:])
+            if leading and operator == "$match" and isinstance(argument, dict):
+                filters.append(argument)
+            elif leading and operator == "$sort" and isinstance(argument, dict) and not sort:
+                sort = list(argument.items())
+            else:
+                leading = False
+
+    for query_filter in filters:
+        for path, condition in query_filter.items():
+            if path.startswith("$"):
+                continue
+            if isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+                target = equality if set(condition) <= {"$eq", "$in"} else ranges
+            else:
+                target = equality
+            if path not in target:
+                target.append(path)
+    ranges = [path for path in ranges if path not in equality]
+    return tuple(equality), tuple((path, int(direction)) for path, direction in sort), tuple(ranges), tuple(grouped)
+
+
+# Index keys for a shape following the equality, sort, range rule: equality fields first,
+# then the sort keys in their requested directions, then range-filtered fields
+def index_keys(shape):
+    equality, sort, ranges, _ = shape
+    keys = [(path, 1) for path in equality]
+    for path, direction in sort:
+        if path not in equality:
+            keys.append((path, direction))
+    used = {path for path, _ in keys}
+    keys.extend((path, 1) for path in ranges if path not in used)
+    return tuple(keys)
+
+
+def index_name(keys):
+    return "advisor_" + "_".join(f"{path}_{direction}" for path, direction in keys)
+
+
+# Stage names of every plan node under the winning plan of an explain() result
+def plan_stages(explain):
+    stages = []
+
+    def walk(node, in_plan):
+        if isinstance(node, dict):
+            if in_plan and isinstance(node.get("stage"), str):
+                stages.append(node["stage"])
+            for key, value in node.items():
+                walk(value, in_plan or key in ("winningPlan", "queryPlan"))
+        elif isinstance(node, list):
+            for item in node:
+                walk(item, in_plan)
+
+    walk(explain, False)
+    return stages
+
+
+# Records the filter / sort shapes of executed queries per collection, proposes a
+# single-field or compound index for each shape, builds it in the background once the
+# shape has been seen `threshold` times (up to `max_indexes` per collection), and checks
+# with explain() that the query now runs as an IXSCAN instead of a COLLSCAN. Queries are
+# typed by users, so only collections `accepts` admits are tracked (building an index
+# would otherwise create the collection), and the shapes and fields kept are capped.
+class IndexAdvisor:
+    def __init__(self, get_database, threshold=INDEX_ADVISOR_THRESHOLD, mode=INDEX_ADVISOR_MODE,
+                 max_indexes=INDEX_ADVISOR_MAX_INDEXES, accepts=None, max_proposals=INDEX_ADVISOR_MAX_PROPOSALS,
+                 max_fields=INDEX_ADVISOR_MAX_FIELDS):
+        self.get_database = get_database
+        self.threshold = threshold
+        self.max_indexes = max_indexes
+        self.mode = mode
+        self.accepts = accepts
+        self.max_proposals = max_proposals
+        self.max_fields = max_fields
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._usage = {}
+        self._proposals = OrderedDict()
+
+    def _count(self, counts, path):
+        if path in counts or len(counts) < self.max_fields:
+            counts[path] = counts.get(path, 0) + 1
+
+    def record(self, query):
+        collection = query["collection"]
+        if self.accepts is not None and not self.accepts(collection):
+            return
+        shape = query_shape(query)
+        keys = index_keys(shape)
+        with self._lock:
+            usage = self._usage.setdefault(collection, {"filtered": {}, "sorted": {}, "grouped": {}})
+            for path in shape[0] + shape[2]:
+                self._count(usage["filtered"], path)
+            for path, _ in shape[1]:
+                self._count(usage["sorted"], path)
+            for path in shape[3]:
+                self._count(usage["grouped"], path)
+            if not keys:
+                return
+            proposal = self._proposals.get((collection, keys))
+            if proposal is not None:
+                self._proposals.move_to_end((collection, keys))
+            else:
+                proposal = self._proposals[(collection, keys)] = {
+                    "collection": collection,
+                    "keys": [list(key) for key in keys],
+                    "name": index_name(keys),
+                    "seen": 0,
+                    "status": "proposed",
+                    "query": query,
+                    "plan_before": None,
+                    "plan_after": None,
+                    "error": None,
+                    "built_at": None,
+                }
+                self._evict()
+            proposal["seen"] += 1
+            proposal["query"] = query
+            ready = proposal["seen"] >= self.threshold and proposal["status"] == "proposed"
+        if ready and self.mode == "auto":
+            self.start()
+            self._wake.set()
+
+    # Forget the least recently seen proposals past max_proposals, except one being built
+    def _evict(self):
+        for key in list(self._proposals):
+            if len(self._proposals) <= self.max_proposals:
+                return
+            if self._proposals[key]["status"] != "building":
+                del self._proposals[key]
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name="index-advisor", daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self.build_pending()
+
+    # Build every proposal that crossed the threshold; returns the proposals handled
+    def build_pending(self):
+        with self._lock:
+            pending = [p for p in self._proposals.values() if p["seen"] >= self.threshold and p["status"] == "proposed"]
+            for proposal in pending:
+                proposal["status"] = "building"
+        for proposal in pending:
+            self._build(proposal)
+        return pending
+
+    def _build(self, proposal):
+        try:
+            db = self.get_database()
+            # create_index would create a collection that is missing (dropped since recorded)
+            if proposal["collection"] not in db.list_collection_names():
+                proposal["status"] = "skipped"
+                proposal["error"] = f"{proposal['collection']} does not exist"
+                return
+            collection = db[proposal["collection"]]
+            keys = [tuple(key) for key in proposal["keys"]]
+            indexes = collection.index_information()
+            existing = [tuple(tuple(key) for key in info["key"]) for info in indexes.values()]
+            proposal["plan_before"] = self.explain(db, proposal["query"])
+            # An existing index with the same key prefix already serves the shape
+            if not any(index[:len(keys)] == tuple(keys) for index in existing):
+                built = sum(1 for name in indexes if name.startswith("advisor_"))
+                if built >= self.max_indexes or len(indexes) >= MONGO_MAX_INDEXES:
+                    proposal["status"] = "skipped"
+                    proposal["error"] = f"{proposal['collection']} already has {len(indexes)} indexes ({built} built by the advisor)"
+                    return
+                collection.create_index(keys, name=proposal["name"])
+                proposal["built_at"] = time.time()
+            proposal["plan_after"] = self.explain(db, proposal["query"])
+            if proposal["plan_after"] is None:
+                proposal["status"] = "built"
+            else:
+                proposal["status"] = "verified" if "IXSCAN" in proposal["plan_after"] else "unused"
+        except Exception as err:
+            proposal["status"] = "failed"
+            proposal["error"] = str(err)
+
+    # Winning-plan stages of a parsed query, or None when the server cannot explain it
+    def explain(self, db, query):
+        if query["operation"] == "find":
+            command = {"find": query["collection"], "filter": query.get("filter") or {}}
+            if query.get("sort"):
+                command["sort"] = dict(query["sort"])
+            if query.get("skip"):
+                command["skip"] = query["skip"]
+            if query.get("limit"):
+                command["limit"] = query["limit"]
+        else:
+            command = {"aggregate": query["collection"], "pipeline": query["pipeline"], "cursor": {}}
+        try:
+            return plan_stages(db.command({"explain": command, "verbosity": "queryPlanner"}))
+        except Exception:
+            return None
+
+    def report(self):
+        with self._lock:
+            proposals = [{key: value for key, value in p.items() if key != "query"} for p in self._proposals.values()]
+            return {
+                "mode": self.mode,
+                "threshold": self.threshold,
+                "max_indexes": self.max_indexes,
+                "max_proposals": self.max_proposals,
+                "usage": {name: {kind: dict(counts) for kind, counts in usage.items()} for name, usage in self._usage.items()},
+                "proposals": sorted(proposals, key=lambda p: -p["seen"]),
+            }
@@ -0,0 +1,259 @@
+import json
+import os
+import time
+import warnings
+from datetime import datetime, timezone
+
+
+# Rows parsed and inserted per batch; peak memory is bounded by one chunk
+INGEST_CHUNK_SIZE = int(os.environ.get("CHATDB_INGEST_CHUNK_SIZE", "5000"))
+
+# Bytes read from a JSON upload at a time by the streaming decoder
+JSON_READ_SIZE = 64 * 1024
+
+# Largest element the streaming decoder will buffer (MongoDB's document size limit)
+MAX_JSON_ELEMENT_SIZE = 16 * 1024 * 1024
+
+
+# Running totals for one ingestion, reported back to the uploader
+class IngestReport:
+    def __init__(self, collection):
+        self.collection = collection
+        self.inserted = 0
+        self.rejected = 0
+        self.batches = 0
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.started
+        return self
+
+    def as_dict(self):
+        return {
+            "collection": self.collection,
+            "inserted": self.inserted,
+            "rejected": self.rejected,
+            "batches": self.batches,
+            "seconds": round(self.seconds, 3),
+            "rows_per_sec": round(self.inserted / self.seconds, 1) if self.seconds else None,
+        }
+
+
+# Collection name for an uploaded file: its (already secured) name without extension
+def collection_name_for(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+# The side collections kept next to the datasets (rollups, sketches) are named chatdb_*;
+# they and MongoDB's system.* collections are never treated as datasets
+INTERNAL_PREFIX = "chatdb_"
+
+
+def is_internal_collection(name):
+    return name.startswith(INTERNAL_PREFIX) or name.startswith("system.")
+
+
+# Insert one batch unordered so a bad document does not stop the rest of the batch.
+# Returns the documents that were written, for the day rollups.
+def insert_batch(collection, documents, report):
+    from pymongo.errors import BulkWriteError
+
+    if not documents:
+        return []
+    report.batches += 1
+    try:
+        result = collection.insert_many(documents, ordered=False)
+        report.inserted += len(result.inserted_ids)
+        return documents
+    except BulkWriteError as err:
+        details = err.details
+        report.inserted += details.get("nInserted", 0)
+        report.rejected += len(details.get("writeErrors", []))
+        failed = {error["index"] for error in details.get("writeErrors", [])}
+        return [document for i, document in enumerate(documents) if i not in failed]
+
+
+# Convert a DataFrame chunk to plain Python documents (NaN becomes a missing value)
+def chunk_to_documents(chunk):
+    return chunk.astype(object).where(chunk.notna(), None).to_dict("records")
+
+
+# Stream a CSV file into a collection chunk by chunk. Lines with the wrong number of
+# fields are skipped by the parser and counted as rejected. <prefix>date / <prefix>time
+# column pairs are stored combined as an indexed <prefix>timestamp date as well.
+def ingest_csv(path, collection, chunk_size=INGEST_CHUNK_SIZE):
+    import pandas as pd
+    from rollups import (
+        GroupRollups, add_timestamps, daily_buckets, ensure_time_indexes, frame_buckets, merge_buckets, update_daily_rollups,
+    )
+    from sketches import FieldSketches
+
+    report = IngestReport(collection.name)
+    rollups = GroupRollups(collection)
+    sketches = FieldSketches(collection)
+    buckets = {}
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always", pd.errors.ParserWarning)
+        for chunk in pd.read_csv(path, chunksize=chunk_size, on_bad_lines="warn"):
+            fields = add_timestamps(chunk)
+            documents = chunk_to_documents(chunk)
+            inserted = insert_batch(collection, documents, report)
+            # Rejected rows are left out of the rollups and sketches
+            complete = len(inserted) == len(documents)
+            if complete:
+                rollups.add_frame(chunk)
+                sketches.add_frame(chunk)
+            else:
+                rollups.add(inserted)
+                sketches.add(inserted)
+            if fields:
+                merge_buckets(buckets, frame_buckets(chunk, fields) if complete else daily_buckets(inserted))
+            report.rejected += sum(str(w.message).count("Skipping line") for w in caught)
+            caught.clear()
+    rollups.finish()
+    sketches.finish()
+    time_fields = update_daily_rollups(collection, buckets, rollups.loading)
+    if time_fields:
+        ensure_time_indexes(collection, sorted(time_fields))
+    return report.finish()
+
+
+# object_hook for Extended JSON: $oid and $date wrappers (the only ones in our uploads)
+# are converted inline, anything else starting with "$" goes through json_util. bson is
+# imported only for the values that need it, so that reading dates does not load it
+def extended_json_hook(document):
+    if len(document) > 2:
+        return document
+    key = next(iter(document), "")
+    if key[:1] != "$":
+        return document
+    value = document[key]
+    if key == "$oid" and len(document) == 1:
+        from bson import ObjectId
+        return ObjectId(value)
+    if key == "$date" and len(document) == 1 and isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            parsed = None
+        if parsed is not None and not parsed.microsecond % 1000:
+            if parsed.tzinfo is not None:
+                parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+            return parsed
+    from bson import json_util
+    return json_util.object_hook(document)
+
+
+EXTENDED_JSON_DECODER = json.JSONDecoder(object_hook=extended_json_hook)
+
+# Characters that can follow a prefix of a JSON number inside the same number
+NUMBER_CHARS = frozenset("0123456789.eE+-")
+
+
+# Yield the elements of a top-level JSON array one at a time, decoding Extended JSON
+# types as they are parsed. Only the current element and one read buffer are in memory.
+# A bare top-level object is yielded as a single element.
+def iter_json_array(handle, read_size=JSON_READ_SIZE, decoder=EXTENDED_JSON_DECODER):
+    decode = decoder.raw_decode
+    buffer = ""
+    position = 0
+    eof = False
+
+    def skip_whitespace():
+        nonlocal buffer, position, eof
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n":
+                position += 1
+            if position < len(buffer) or eof:
+                return
+            chunk = handle.read(read_size)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+
+    skip_whitespace()
+    if position == len(buffer):
+        return
+    in_array = buffer[position] == "["
+    if in_array:
+        position += 1
+        skip_whitespace()
+        if buffer[position:position + 1] == "]":
+            return
+
+    while True:
+        # Decode the next element, reading more input until it is complete. An element
+        # that ends at the end of the buffer, or just before a character that could
+        # continue a number, may be a truncated number, so it is only accepted once
+        # more input (or EOF) has been seen.
+        while True:
+            try:
+                element, end = decode(buffer, position)
+                if end < len(buffer) and buffer[end] not in NUMBER_CHARS or eof:
+                    break
+            except ValueError:
+                if eof or len(buffer) - position > MAX_JSON_ELEMENT_SIZE:
+                    raise
+            chunk = handle.read(read_size)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+        yield element
+        position = end
+        if not in_array:
+            return
+
+        skip_whitespace()
+        separator = buffer[position:position + 1]
+        position += 1
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError(f"Expected ',' or ']' in JSON array, found {separator!r}")
+        skip_whitespace()
+
+
+# Insert one batch of JSON documents and fold it into the rollups, sketches and day
+# buckets of the ingestion
+def ingest_batch(collection, documents, report, rollups, sketches, buckets):
+    from rollups import daily_buckets, merge_buckets
+
+    inserted = insert_batch(collection, documents, report)
+    rollups.add(inserted)
+    sketches.add(inserted)
+    merge_buckets(buckets, daily_buckets(inserted))
+
+
+# Stream an Extended JSON array ({"$oid": ...}, {"$date": ...}) into a collection in batches
+def ingest_json(path, collection, chunk_size=INGEST_CHUNK_SIZE):
+    from rollups import GroupRollups, ensure_time_indexes, update_daily_rollups
+    from sketches import FieldSketches
+
+    report = IngestReport(collection.name)
+    rollups = GroupRollups(collection)
+    sketches = FieldSketches(collection)
+    batch = []
+    buckets = {}
+    with open(path, encoding="utf-8") as handle:
+        for document in iter_json_array(handle):
+            if not isinstance(document, dict):
+                report.rejected += 1
+                continue
+            batch.append(document)
+            if len(batch) == chunk_size:
+                ingest_batch(collection, batch, report, rollups, sketches, buckets)
+                batch = []
+    ingest_batch(collection, batch, report, rollups, sketches, buckets)
+    rollups.finish()
+    sketches.finish()
+    time_fields = update_daily_rollups(collection, buckets, rollups.loading)
+    if time_fields:
+        ensure_time_indexes(collection, sorted(time_fields))
+    return report.finish()
+
+
+# Ingest a saved upload into the collection of the same name
+def ingest_file(path, db, chunk_size=INGEST_CHUNK_SIZE):
+    collection = db[collection_name_for(path)]
+    if path.lower().endswith(".csv"):
+        return ingest_csv(path, collection, chunk_size)
+    return ingest_json(path, collection, chunk_size)
@@ -0,0 +1,99 @@
+# Closed-loop HTTP load test: `concurrency` clients each send requests back to back for
+# `duration` seconds; reports throughput and latency percentiles. Uses only asyncio, so
+# it can drive the threaded Flask server and the ASGI server alike:
+#
+#   python app.py                                    (sync, port 5000)
+#   uvicorn asgi_app:application --port 8000         (async)
+#   python loadtest.py http://127.0.0.1:5000 http://127.0.0.1:8000 --concurrency 200
+#
+# The default request is a $group over the sales collection, i.e. MongoDB-bound work
+# once the servers run with CHATDB_RESULT_CACHE_SIZE=0 (otherwise it is answered from the
+# result cache); pass --path / --body to load another endpoint.
+import argparse
+import asyncio
+import json
+import sys
+import time
+from urllib.parse import urlsplit
+
+
+DEFAULT_BODY = json.dumps({"query": 'db.sales.aggregate([{"$group": {"_id": "$store_location", "total": {"$sum": "$transaction_qty"}}}])'})
+
+
+async def request(host, port, path, body):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(
+            f"POST {path} HTTP/1.1\r\nHost: {host}:{port}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    status_line = response.split(b"\r\n", 1)[0].split()
+    return int(status_line[1]) if len(status_line) > 1 else 0
+
+
+async def client(target, body, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            status = await request(target.hostname, target.port or 80, target.path or "/", body)
+        except OSError:
+            status = 0
+        if 200 <= status < 300:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors.append(status)
+
+
+def percentile(values, share):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+async def run(url, path, body, concurrency, duration):
+    target = urlsplit(url.rstrip("/") + path)
+    latencies, errors = [], []
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*(client(target, body, deadline, latencies, errors) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "url": url,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "requests_per_sec": len(latencies) / elapsed,
+        "p50_ms": 1000 * percentile(latencies, 0.50) if latencies else None,
+        "p99_ms": 1000 * percentile(latencies, 0.99) if latencies else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Closed-loop load test for the ChatDB API")
+    parser.add_argument("urls", nargs="+", help="base URLs of the servers to compare")
+    parser.add_argument("--path", default="/api/execute_query")
+    parser.add_argument("--body", default=DEFAULT_BODY, help="JSON request body")
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per server")
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = [asyncio.run(run(url, args.path, args.body.encode(), args.concurrency, args.duration)) for url in args.urls]
+    print(f"{'server':<32}{'conc':>6}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for row in results:
+        p50 = f"{row['p50_ms']:.1f}" if row["p50_ms"] is not None else "-"
+        p99 = f"{row['p99_ms']:.1f}" if row["p99_ms"] is not None else "-"
+        print(f"{row['url']:<32}{row['concurrency']:>6}{row['requests_per_sec']:>10.1f}{p50:>10}{p99:>10}{row['errors']:>8}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            json.dump(results, handle, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
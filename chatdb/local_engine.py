@@ -0,0 +1,511 @@
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from columnar_cache import open_store
+from ingest import iter_json_array
+from query_exec import UnsupportedQuery
+
+
+# BSON comparison order of the value types we load (null < numbers < strings < ...)
+TYPE_ORDER = {type(None): 0, int: 1, float: 1, str: 2, dict: 3, list: 4, bool: 8, datetime: 9}
+
+COMPARISONS = {
+    "$gt": np.greater,
+    "$gte": np.greater_equal,
+    "$lt": np.less,
+    "$lte": np.less_equal,
+}
+
+
+def is_number(value):
+    return isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, (bool, np.bool_))
+
+
+# Resolve a dotted path the way MongoDB does: arrays of sub-documents fan out into a list
+def resolve_path(document, path):
+    value = document
+    for key in path.split("."):
+        if isinstance(value, dict):
+            value = value.get(key)
+        elif isinstance(value, list):
+            value = [item.get(key) for item in value if isinstance(item, dict) and key in item]
+        else:
+            return None
+    return value
+
+
+# Convert NumPy scalars to plain Python values for documents and JSON output
+def to_python(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, tuple):
+        return list(value)
+    return value
+
+
+# Set a dotted path in a nested document
+def set_path(document, path, value):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        document = document.setdefault(key, {})
+    document[keys[-1]] = value
+
+
+# Columnar view of one collection. Columns are object arrays (None for missing/null)
+# built on first use from either a typed column store (CSV) or a list of documents
+# (JSON). Numeric views (float64 values + validity mask) and group codes come straight
+# from the store's typed arrays when there is one, and are cached alongside.
+class Frame:
+    def __init__(self, length, documents=None, store=None):
+        self.length = length
+        self.documents = documents
+        self.store = store
+        self.derived = []
+        self._columns = {}
+        self._numeric = {}
+        self._codes = {}
+        self._orders = {}
+
+    @classmethod
+    def from_documents(cls, documents):
+        return cls(len(documents), documents=documents)
+
+    @classmethod
+    def from_store(cls, store):
+        return cls(store.length, store=store)
+
+    # Column that is not in the store, e.g. a timestamp computed at load time
+    def add_column(self, name, values):
+        self.derived.append(name)
+        self._columns[name] = values
+
+    def column(self, path):
+        values = self._columns.get(path)
+        if values is not None:
+            return values
+        if self.store is not None:
+            kind = self.store.kinds.get(path)
+            if kind == "category":
+                values = self.store.categories(path)[self.store.array(path)]
+            elif kind is not None:
+                array = self.store.array(path)
+                values = array.astype(object)
+                if kind == "float":
+                    values[np.isnan(array)] = None
+            else:
+                values = np.full(self.length, None, dtype=object)
+        else:
+            values = np.empty(self.length, dtype=object)
+            for i, document in enumerate(self.documents):
+                values[i] = resolve_path(document, path)
+        self._columns[path] = values
+        return values
+
+    # (float64 values, mask of numeric entries, whether every numeric entry is an int)
+    def numeric(self, path):
+        cached = self._numeric.get(path)
+        if cached is not None:
+            return cached
+        kind = self.store.kinds.get(path) if self.store is not None else None
+        if kind in ("int", "float"):
+            floats = np.asarray(self.store.array(path), dtype="float64")
+            valid = ~np.isnan(floats) if kind == "float" else np.ones(self.length, dtype=bool)
+            self._numeric[path] = (floats, valid, kind == "int")
+            return self._numeric[path]
+        values = self.column(path)
+        valid = np.fromiter((is_number(v) for v in values), dtype=bool, count=self.length)
+        floats = np.zeros(self.length, dtype="float64")
+        if valid.any():
+            floats[valid] = values[valid].astype("float64")
+        all_int = all(isinstance(v, (int, np.integer)) for v in values[valid])
+        self._numeric[path] = (floats, valid, all_int)
+        return self._numeric[path]
+
+    # Factorized group codes of a column (arrays become hashable tuples), cached
+    def codes(self, path):
+        cached = self._codes.get(path)
+        if cached is not None:
+            return cached
+        if self.store is not None and self.store.kinds.get(path) == "category":
+            codes = np.asarray(self.store.array(path), dtype=np.intp)
+            self._codes[path] = (codes, self.store.categories(path))
+            return self._codes[path]
+        values = self.column(path)
+        if any(isinstance(v, list) for v in values):
+            values = np.array([tuple(v) if isinstance(v, list) else v for v in values] + [None], dtype=object)[:-1]
+        self._codes[path] = pd.factorize(values, use_na_sentinel=False)
+        return self._codes[path]
+
+    # Row order for a sort specification ((path, direction), ...), cached
+    def sort_order(self, sort):
+        order = self._orders.get(sort)
+        if order is None:
+            keys = []
+            for path, direction in reversed(sort):
+                rank, value = sort_keys(self, path, direction)
+                keys.extend([value, rank])
+            order = self._orders[sort] = np.lexsort(keys)
+        return order
+
+    # Documents for the given row positions
+    def rows(self, positions):
+        if self.documents is not None:
+            return [self.documents[i] for i in positions]
+        names = self.store.names + self.derived
+        columns = [self.column(name) for name in names]
+        return [{name: to_python(column[i]) for name, column in zip(names, columns)} for i in positions]
+
+
+# Boolean mask of rows matching a find()/$match filter
+def filter_mask(frame, query_filter):
+    mask = np.ones(frame.length, dtype=bool)
+    for path, condition in query_filter.items():
+        if path.startswith("$"):
+            raise UnsupportedQuery(f"Operator {path} is not supported locally")
+        if not isinstance(condition, dict) or not any(key.startswith("$") for key in condition):
+            condition = {"$eq": condition}
+        for operator, operand in condition.items():
+            mask &= condition_mask(frame, path, operator, operand)
+    return mask
+
+
+def condition_mask(frame, path, operator, operand):
+    if operator in COMPARISONS and is_number(operand):
+        values = frame.column(path)
+        floats, valid, _ = frame.numeric(path)
+        mask = valid & COMPARISONS[operator](floats, float(operand))
+        if any(isinstance(v, list) for v in values[~valid]):
+            mask |= python_mask(values, operator, operand)
+        return mask
+    return python_mask(frame.column(path), operator, operand)
+
+
+# Element-wise fallback for strings, equality, $in and array fields (any element matches)
+def python_mask(values, operator, operand):
+    def equal(value, other):
+        if value is None or other is None:
+            return value is None and other is None
+        if TYPE_ORDER.get(type(value)) != TYPE_ORDER.get(type(other)):
+            return False
+        return value == other
+
+    def scalar_match(value):
+        if operator == "$eq":
+            return equal(value, operand)
+        if operator == "$in":
+            return any(equal(value, item) for item in operand)
+        if operator in COMPARISONS:
+            if value is None or TYPE_ORDER.get(type(value)) != TYPE_ORDER.get(type(operand)):
+                return False
+            return bool(COMPARISONS[operator](value, operand))
+        raise UnsupportedQuery(f"Operator {operator} is not supported locally")
+
+    def match(value):
+        if isinstance(value, list):
+            return any(scalar_match(item) for item in value) or (operator == "$eq" and value == operand)
+        return scalar_match(value)
+
+    if operator == "$ne":
+        return ~python_mask(values, "$eq", operand)
+    if operator == "$nin":
+        return ~python_mask(values, "$in", operand)
+    return np.fromiter((match(v) for v in values), dtype=bool, count=len(values))
+
+
+# Sort keys for np.lexsort: null < numbers < strings, missing treated as null
+def sort_keys(frame, path, direction):
+    floats, valid, _ = frame.numeric(path)
+    if frame.store is not None and frame.store.kinds.get(path) in ("int", "float"):
+        # Typed store columns hold only numbers and missing values (NaN)
+        rank = valid.astype(np.int64)
+        value = np.where(valid, floats, 0.0)
+        return [-rank, -value] if direction < 0 else [rank, value]
+    values = frame.column(path)
+    missing = np.fromiter((v is None for v in values), dtype=bool, count=len(values))
+    # Arrays sort by their smallest element ascending and their largest descending
+    arrays = np.fromiter((isinstance(v, list) for v in values), dtype=bool, count=len(values))
+    if arrays.any():
+        pick = min if direction > 0 else max
+        floats, valid = floats.copy(), valid.copy()
+        for i in np.flatnonzero(arrays):
+            if not values[i] or not all(is_number(item) for item in values[i]):
+                raise UnsupportedQuery(f"Sorting array field {path} is not supported locally")
+            floats[i], valid[i] = pick(values[i]), True
+    strings = ~(valid | missing)
+    if strings.any():
+        if not all(isinstance(v, str) for v in values[strings]):
+            raise UnsupportedQuery(f"Sorting mixed-type field {path} is not supported locally")
+        codes, _ = pd.factorize(values[strings], sort=True)
+        floats = floats.copy()
+        floats[strings] = codes
+    rank = np.where(valid, 1, np.where(missing, 0, 2))
+    value = np.where(missing, 0.0, floats)
+    if direction < 0:
+        return [-rank, -value]
+    return [rank, value]
+
+
+# Row positions of `positions` in sort order: the whole collection order is computed once
+# per sort specification and then restricted to the selected rows
+def sorted_subset(frame, sort, positions):
+    sort = tuple((path, direction) for path, direction in sort)
+    if not sort:
+        return positions
+    order = frame.sort_order(sort)
+    if len(positions) == frame.length:
+        return order
+    selected = np.zeros(frame.length, dtype=bool)
+    selected[positions] = True
+    return order[selected[order]]
+
+
+# The first k of `positions` in sort order without sorting them all (O(n) selection plus
+# a sort of about k rows). Rows are bucketed by the leading key's type rank; within the
+# bucket that holds the k-th row, np.partition finds the k-th value, and every row up to
+# it (ties included) is a candidate. Only the candidates are lexsorted on the full key,
+# in position order so that ties come out as a full sort would order them.
+def top_k_subset(frame, sort, positions, k):
+    sort = tuple((path, direction) for path, direction in sort)
+    if not sort or k <= 0:
+        return positions[:max(k, 0)]
+    if k >= len(positions) or sort in frame._orders:
+        return sorted_subset(frame, sort, positions)[:k]
+
+    rank, value = sort_keys(frame, *sort[0])
+    rank, value = rank[positions], value[positions]
+    chosen, taken = [], 0
+    for bucket_rank in np.unique(rank):
+        bucket = np.flatnonzero(rank == bucket_rank)
+        if taken + len(bucket) < k:
+            chosen.append(bucket)
+            taken += len(bucket)
+            continue
+        bucket_values = value[bucket]
+        threshold = np.partition(bucket_values, k - taken - 1)[k - taken - 1]
+        chosen.append(bucket[bucket_values <= threshold])
+        break
+    candidates = positions[np.sort(np.concatenate(chosen))]
+
+    keys = []
+    for path, direction in reversed(sort):
+        rank, value = sort_keys(frame, path, direction)
+        keys.extend([value[candidates], rank[candidates]])
+    return candidates[np.lexsort(keys)][:k]
+
+
+# $group with _id "$field" (or null) and $sum / $avg / $min / $max / $count accumulators,
+# computed from factorized group codes with np.bincount
+def group_frame(frame, spec, positions):
+    key_spec = spec.get("_id")
+    if isinstance(key_spec, str) and key_spec.startswith("$"):
+        codes, uniques = frame.codes(key_spec[1:])
+        if len(positions) < frame.length:
+            codes, used = pd.factorize(codes[positions])
+            uniques = uniques[used]
+    elif key_spec is None or not isinstance(key_spec, (dict, list)):
+        codes, uniques = np.zeros(len(positions), dtype=np.intp), np.array([key_spec], dtype=object)
+    else:
+        raise UnsupportedQuery("Compound $group keys are not supported locally")
+
+    groups = len(uniques) if len(positions) else 0
+    output = {"_id": [to_python(k) for k in uniques[:groups]]}
+    for name, accumulator in spec.items():
+        if name == "_id":
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            raise UnsupportedQuery(f"Accumulator {name} is not supported locally")
+        (operator, argument), = accumulator.items()
+        output[name] = accumulate(frame, positions, codes, groups, operator, argument)
+
+    documents = [{key: values[i] for key, values in output.items()} for i in range(groups)]
+    return Frame.from_documents(documents)
+
+
+# $unwind of a field path: one document per array element. A value that is not an array
+# keeps its document as it is; missing, null and empty arrays drop it, as in MongoDB.
+def unwind_frame(frame, argument, positions):
+    path = argument.get("path") if isinstance(argument, dict) and set(argument) == {"path"} else argument
+    if not isinstance(path, str) or not path.startswith("$"):
+        raise UnsupportedQuery("Only $unwind of a field path is supported locally")
+    keys = path[1:].split(".")
+    documents = []
+    for document in frame.rows(positions):
+        value = document
+        for key in keys:
+            if isinstance(value, list):
+                raise UnsupportedQuery(f"$unwind of {path} through an array is not supported locally")
+            value = value.get(key) if isinstance(value, dict) else None
+        if isinstance(value, list):
+            documents.extend(replace_path(document, keys, item) for item in value)
+        elif value is not None:
+            documents.append(document)
+    return Frame.from_documents(documents)
+
+
+# Copy of a document with the value at a path (given as keys) replaced
+def replace_path(document, keys, value):
+    document = dict(document)
+    document[keys[0]] = value if len(keys) == 1 else replace_path(document[keys[0]], keys[1:], value)
+    return document
+
+
+def accumulate(frame, positions, codes, groups, operator, argument):
+    if operator == "$count" or (operator == "$sum" and is_number(argument)):
+        counts = np.bincount(codes, minlength=groups)
+        factor = 1 if operator == "$count" else argument
+        return [to_python(c * factor) for c in counts]
+    if not (isinstance(argument, str) and argument.startswith("$")):
+        raise UnsupportedQuery(f"{operator} argument {argument!r} is not supported locally")
+
+    floats, valid, all_int = frame.numeric(argument[1:])
+    if len(positions) < frame.length:
+        floats, valid = floats[positions], valid[positions]
+    if not valid.all():
+        codes, floats = codes[valid], floats[valid]
+    counts = np.bincount(codes, minlength=groups)
+    if operator == "$sum":
+        sums = np.bincount(codes, weights=floats, minlength=groups)
+        return [int(s) if all_int else float(s) for s in sums]
+    if operator == "$avg":
+        sums = np.bincount(codes, weights=floats, minlength=groups)
+        return [float(s / c) if c else None for s, c in zip(sums, counts)]
+    if operator in ("$min", "$max"):
+        if not all(v is None or is_number(v) for v in frame.column(argument[1:])[positions]):
+            raise UnsupportedQuery(f"{operator} over non-numeric values is not supported locally")
+        fill, reduce = (np.inf, np.minimum) if operator == "$min" else (-np.inf, np.maximum)
+        result = np.full(groups, fill)
+        reduce.at(result, codes, floats)
+        return [(int(r) if all_int else float(r)) if c else None for r, c in zip(result, counts)]
+    raise UnsupportedQuery(f"Accumulator {operator} is not supported locally")
+
+
+def project_documents(documents, projection):
+    if not projection:
+        return documents
+    include = {k for k, v in projection.items() if v and k != "_id"}
+    exclude = {k for k, v in projection.items() if not v}
+    if include and exclude - {"_id"}:
+        raise UnsupportedQuery("Projection cannot mix inclusion and exclusion")
+    keep_id = projection.get("_id", 1)
+    projected = []
+    for document in documents:
+        if include:
+            out = {"_id": document["_id"]} if keep_id and "_id" in document else {}
+            for path in include:
+                value = resolve_path(document, path)
+                if value is not None:
+                    set_path(out, path, value)
+        else:
+            out = {k: v for k, v in document.items() if k not in exclude}
+        projected.append(out)
+    return projected
+
+
+# Embedded executor for uploaded datasets. Runs the query shapes the chat templates emit
+# (find with comparison filters and sort/limit, aggregate with $match/$group/$sort/
+# $limit/$skip) on columnar buffers and returns the documents MongoDB would return for
+# the same data, apart from the generated _id of CSV rows. Sorts are stable: rows with
+# equal sort keys keep collection order, which MongoDB leaves unspecified.
+class LocalEngine:
+    def __init__(self, get_source):
+        self.get_source = get_source
+        self._lock = threading.Lock()
+        self._frames = {}
+
+    def has(self, collection):
+        return self.get_source(collection) is not None
+
+    # Frames are cached per (path, mtime), so a re-upload replaces the buffers
+    def frame(self, collection):
+        path = self.get_source(collection)
+        if path is None:
+            raise UnsupportedQuery(f"No local data for collection {collection}")
+        stamp = (path, os.path.getmtime(path))
+        cached = self._frames.get(collection)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        frame = load_frame(path)
+        with self._lock:
+            self._frames[collection] = (stamp, frame)
+        return frame
+
+    def invalidate(self, collection):
+        with self._lock:
+            self._frames.pop(collection, None)
+
+    def execute(self, query):
+        frame = self.frame(query["collection"])
+        if query["operation"] == "find":
+            return self.find(frame, query)
+        if query["operation"] == "aggregate":
+            return self.aggregate(frame, query["pipeline"])
+        raise UnsupportedQuery(f"Operation {query['operation']} is not supported locally")
+
+    def find(self, frame, query):
+        positions = np.flatnonzero(filter_mask(frame, query.get("filter") or {}))
+        if query.get("sort") and query.get("limit"):
+            positions = top_k_subset(frame, query["sort"], positions, (query.get("skip") or 0) + query["limit"])
+        elif query.get("sort"):
+            positions = sorted_subset(frame, query["sort"], positions)
+        if query.get("skip"):
+            positions = positions[query["skip"]:]
+        if query.get("limit"):
+            positions = positions[:query["limit"]]
+        return project_documents(frame.rows(positions), query.get("projection"))
+
+    def aggregate(self, frame, pipeline):
+        positions = np.arange(frame.length)
+        for i, stage in enumerate(pipeline):
+            if not isinstance(stage, dict) or len(stage) != 1:
+                raise UnsupportedQuery("Each pipeline stage must have exactly one operator")
+            (operator, argument), = stage.items()
+            following = pipeline[i + 1] if i + 1 < len(pipeline) else None
+            if operator == "$match":
+                positions = positions[filter_mask(frame, argument)[positions]]
+            elif operator == "$group":
+                frame = group_frame(frame, argument, positions)
+                positions = np.arange(frame.length)
+            elif operator == "$sort" and isinstance(following, dict) and "$limit" in following:
+                # $sort + $limit is a top-k selection, as in MongoDB
+                positions = top_k_subset(frame, argument.items(), positions, int(following["$limit"]))
+            elif operator == "$sort":
+                positions = sorted_subset(frame, argument.items(), positions)
+            elif operator == "$limit":
+                positions = positions[:int(argument)]
+            elif operator == "$skip":
+                positions = positions[int(argument):]
+            elif operator == "$unwind":
+                frame = unwind_frame(frame, argument, positions)
+                positions = np.arange(frame.length)
+            else:
+                raise UnsupportedQuery(f"Stage {operator} is not supported locally")
+        return frame.rows(positions)
+
+
+# The combined <prefix>timestamp columns ingestion stores for CSV rows (see
+# rollups.add_timestamps), computed once per frame so its rows match the documents
+def add_timestamp_columns(frame):
+    from rollups import add_timestamps, timestamp_columns
+
+    pairs = timestamp_columns(frame.store.names)
+    if not pairs:
+        return
+    chunk = pd.DataFrame({column: frame.column(column) for pair in pairs for column in pair[:2]})
+    for field in add_timestamps(chunk):
+        parsed = chunk[field]
+        values = np.array(parsed.dt.to_pydatetime(), dtype=object)
+        values[parsed.isna().to_numpy()] = None
+        frame.add_column(field, values)
+
+
+def load_frame(path):
+    if path.lower().endswith(".csv"):
+        frame = Frame.from_store(open_store(path))
+        add_timestamp_columns(frame)
+        return frame
+    with open(path, encoding="utf-8") as handle:
+        return Frame.from_documents([d for d in iter_json_array(handle) if isinstance(d, dict)])
@@ -0,0 +1,224 @@
+import asyncio
+import os
+import threading
+import time
+
+from pymongo import AsyncMongoClient, MongoClient, monitoring
+
+
+# Connection settings, overridable from the environment
+MONGO_SETTINGS = {
+    "uri": os.environ.get("CHATDB_MONGO_URI", "mongodb://localhost:27017/"),
+    "database": os.environ.get("CHATDB_MONGO_DB", "chatdb"),
+    "maxPoolSize": int(os.environ.get("CHATDB_MONGO_MAX_POOL_SIZE", "50")),
+    "minPoolSize": int(os.environ.get("CHATDB_MONGO_MIN_POOL_SIZE", "0")),
+    "connectTimeoutMS": int(os.environ.get("CHATDB_MONGO_CONNECT_TIMEOUT_MS", "5000")),
+    "serverSelectionTimeoutMS": int(os.environ.get("CHATDB_MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+    "waitQueueTimeoutMS": int(os.environ.get("CHATDB_MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000")),
+    "health_check_interval": float(os.environ.get("CHATDB_MONGO_HEALTH_CHECK_INTERVAL", "30")),
+}
+
+
+# Pool event listener keeping running counters for the stats endpoint
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.open_connections = 0
+            self.checked_out = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.total_wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "open_connections": self.open_connections,
+                "checked_out": self.checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "avg_wait_ms": 1000 * self.total_wait_seconds / self.checkouts if self.checkouts else 0.0,
+                "max_wait_ms": 1000 * self.max_wait_seconds,
+            }
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open_connections += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open_connections -= 1
+
+    def connection_checked_out(self, event):
+        wait = event.duration or 0.0
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+            self.total_wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+
+# Process-wide MongoClient, created lazily and recreated after fork.
+# MongoClient is thread-safe and pools its own connections, so every request in a
+# process shares one instance; a forked child (e.g. a gunicorn worker) must not reuse
+# the parent's sockets, so the client is keyed by the pid that created it.
+class MongoClientRegistry:
+    def __init__(self, settings=None):
+        self.settings = dict(MONGO_SETTINGS if settings is None else settings)
+        self.stats = PoolStatsListener()
+        self.health = {"ok": None, "checked_at": None, "latency_ms": None, "error": None}
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+        self._health_thread = None
+        self._stop = threading.Event()
+
+    def configure(self, **settings):
+        with self._lock:
+            self.settings.update(settings)
+            self._drop_client()
+
+    def get_client(self):
+        client = self._client
+        if client is not None and self._pid == os.getpid():
+            return client
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                self._drop_client()
+                self._client = MongoClient(
+                    self.settings["uri"],
+                    maxPoolSize=self.settings["maxPoolSize"],
+                    minPoolSize=self.settings["minPoolSize"],
+                    connectTimeoutMS=self.settings["connectTimeoutMS"],
+                    serverSelectionTimeoutMS=self.settings["serverSelectionTimeoutMS"],
+                    waitQueueTimeoutMS=self.settings["waitQueueTimeoutMS"],
+                    event_listeners=[self.stats],
+                )
+                self._pid = os.getpid()
+                if self.settings["health_check_interval"] > 0:
+                    self.start_health_check()
+            return self._client
+
+    def get_database(self):
+        return self.get_client()[self.settings["database"]]
+
+    # Called in a freshly forked child: forget the parent's client without closing its
+    # sockets (they still belong to the parent). Threads do not survive fork, so the
+    # health checker is restarted with the child's own client on first use.
+    def reset_after_fork(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._client = None
+        self._pid = None
+        self._health_thread = None
+        self.stats = PoolStatsListener()
+
+    def _drop_client(self):
+        if self._client is not None and self._pid == os.getpid():
+            self._client.close()
+        self._client = None
+        self._pid = None
+        self.stats.reset()
+
+    def check_health(self):
+        started = time.perf_counter()
+        try:
+            self.get_client().admin.command("ping")
+            self.health = {
+                "ok": True,
+                "checked_at": time.time(),
+                "latency_ms": 1000 * (time.perf_counter() - started),
+                "error": None,
+            }
+        except Exception as err:
+            self.health = {"ok": False, "checked_at": time.time(), "latency_ms": None, "error": str(err)}
+        return self.health
+
+    def _health_loop(self):
+        while not self._stop.is_set():
+            self.check_health()
+            self._stop.wait(self.settings["health_check_interval"])
+
+    def start_health_check(self):
+        if self._health_thread is not None and self._health_thread.is_alive():
+            return
+        self._stop.clear()
+        self._health_thread = threading.Thread(target=self._health_loop, name="mongo-health", daemon=True)
+        self._health_thread.start()
+
+    def stop_health_check(self):
+        self._stop.set()
+
+    def pool_stats(self):
+        stats = self.stats.snapshot()
+        stats["max_pool_size"] = self.settings["maxPoolSize"]
+        stats["min_pool_size"] = self.settings["minPoolSize"]
+        stats["health"] = dict(self.health)
+        return stats
+
+
+# AsyncMongoClient for the ASGI server. An async client belongs to the event loop it
+# was first used on, so one is kept per (process, loop); with a single-loop server that
+# is one client per worker, sharing the same pool settings and stats listener as MONGO.
+class AsyncMongoClientRegistry:
+    def __init__(self, sync_registry):
+        self.sync_registry = sync_registry
+        self._clients = {}
+
+    def get_database(self):
+        key = (os.getpid(), asyncio.get_running_loop())
+        client = self._clients.get(key)
+        if client is None:
+            settings = self.sync_registry.settings
+            client = self._clients[key] = AsyncMongoClient(
+                settings["uri"],
+                maxPoolSize=settings["maxPoolSize"],
+                minPoolSize=settings["minPoolSize"],
+                connectTimeoutMS=settings["connectTimeoutMS"],
+                serverSelectionTimeoutMS=settings["serverSelectionTimeoutMS"],
+                waitQueueTimeoutMS=settings["waitQueueTimeoutMS"],
+                event_listeners=[self.sync_registry.stats],
+            )
+        return client[self.sync_registry.settings["database"]]
+
+    async def close(self):
+        client = self._clients.pop((os.getpid(), asyncio.get_running_loop()), None)
+        if client is not None:
+            await client.close()
+
+
+MONGO = MongoClientRegistry()
+ASYNC_MONGO = AsyncMongoClientRegistry(MONGO)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=MONGO.reset_after_fork)
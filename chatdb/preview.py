@@ -0,0 +1,258 @@
+# Sampled preview of the $group aggregations the chat templates generate ("total /
+# average <A> by <B>", "count of <B>", top N): each group's values are estimated from a
+# uniform sample of the collection, with a confidence interval, instead of scanning every
+# document. Rounds double the sample until the latency budget would be exceeded; a
+# progressive preview keeps refining and ends with the exact answer.
+#
+# Estimators, for a sample of n of the N documents (1.96 standard errors at 95%):
+#   count  N * p,           p the fraction of sampled documents in the group
+#   $sum   N * mean(x),     x the measure inside the group and 0 outside it
+#   $avg   mean of the group's sampled numeric values
+# Averages use Student's t for the group's sample size, and get no interval below
+# PREVIEW_MIN_GROUP sampled values. Samples from the embedded engine are drawn without
+# replacement, so their standard errors carry the finite population correction; MongoDB's
+# $sample may repeat documents. Intervals are normal approximations: on heavy-tailed
+# measures they are too narrow until the sample holds a fair share of the tail.
+import math
+import os
+import time
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+from local_engine import Frame, LocalEngine, is_number
+from query_exec import UnsupportedQuery
+
+
+PREVIEW_SAMPLE_SIZE = 1000
+
+PREVIEW_BUDGET_MS = 1000
+
+# Largest $sample one round asks MongoDB for; past it a progressive preview runs the query
+PREVIEW_MAX_SAMPLE = int(os.environ.get("CHATDB_PREVIEW_MAX_SAMPLE", "100000"))
+
+PREVIEW_CONFIDENCE = 0.95
+
+PREVIEW_MIN_GROUP = 5
+
+# Stages after the $group run on the estimated rows
+ROW_ENGINE = LocalEngine(lambda collection: None)
+
+
+# (group key path or None, accumulators [(name, kind, path, factor)], remaining stages)
+# of a previewable pipeline; UnsupportedQuery for anything else
+def preview_plan(query):
+    pipeline = query.get("pipeline") or []
+    if query["operation"] != "aggregate" or not pipeline or "$group" not in pipeline[0]:
+        raise UnsupportedQuery("Only aggregations starting with $group can be previewed")
+    spec = pipeline[0]["$group"]
+    key = spec.get("_id")
+    if isinstance(key, str) and key.startswith("$"):
+        key = key[1:]
+    elif key is not None:
+        raise UnsupportedQuery("Only $group keys on one field can be previewed")
+
+    accumulators = []
+    for name, accumulator in spec.items():
+        if name == "_id":
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            raise UnsupportedQuery(f"Accumulator {name} cannot be previewed")
+        (operator, argument), = accumulator.items()
+        if operator == "$count" or (operator == "$sum" and isinstance(argument, (int, float))):
+            accumulators.append((name, "count", None, 1 if operator == "$count" else argument))
+        elif operator in ("$sum", "$avg") and isinstance(argument, str) and argument.startswith("$"):
+            accumulators.append((name, operator[1:], argument[1:], 1))
+        else:
+            raise UnsupportedQuery(f"Accumulator {operator} cannot be previewed")
+    return key, accumulators, pipeline[1:]
+
+
+# Sampled documents pooled over rounds: group keys and (floats, valid) per measure
+class Sample:
+    def __init__(self, paths):
+        self.keys = []
+        self.measures = {path: ([], []) for path in paths}
+        self.size = 0
+
+    def add(self, keys, measures):
+        self.keys.append(keys)
+        for path, (floats, valid) in measures.items():
+            self.measures[path][0].append(floats)
+            self.measures[path][1].append(valid)
+        self.size += len(keys)
+
+    def arrays(self):
+        keys = np.concatenate(self.keys)
+        measures = {path: (np.concatenate(floats), np.concatenate(valid)) for path, (floats, valid) in self.measures.items()}
+        return keys, measures
+
+
+# $sample rounds against MongoDB, projecting only the group key and measures
+class MongoSampler:
+    without_replacement = False
+
+    def __init__(self, db, collection, key, paths, max_time_ms):
+        self.collection = db[collection]
+        self.key = key
+        self.paths = list(paths)
+        self.max_time_ms = max_time_ms
+        self.population = self.collection.estimated_document_count()
+
+    def draw(self, size):
+        projection = {"_id": 0}
+        if self.key is not None:
+            projection["k"] = f"${self.key}"
+        for i, path in enumerate(self.paths):
+            projection[f"m{i}"] = f"${path}"
+        rows = list(self.collection.aggregate(
+            [{"$sample": {"size": int(size)}}, {"$project": projection}], maxTimeMS=self.max_time_ms,
+        ))
+        keys = np.empty(len(rows), dtype=object)
+        keys[:] = [row.get("k") for row in rows]
+        measures = {}
+        for i, path in enumerate(self.paths):
+            values = [row.get(f"m{i}") for row in rows]
+            valid = np.array([is_number(v) for v in values], dtype=bool)
+            floats = np.array([v if ok else 0.0 for v, ok in zip(values, valid)], dtype=np.float64)
+            measures[path] = (floats, valid)
+        return keys, measures
+
+
+# Rounds over an embedded-engine frame: successive slices of one random permutation, so
+# every round extends the sample without replacement (reservoir sampling of an in-memory
+# column comes down to this)
+class FrameSampler:
+    without_replacement = True
+
+    def __init__(self, frame, key, paths):
+        self.frame = frame
+        self.key = key
+        self.paths = list(paths)
+        self.population = frame.length
+        self._order = np.random.default_rng().permutation(frame.length)
+        self._taken = 0
+
+    def draw(self, size):
+        positions = self._order[self._taken:self._taken + int(size)]
+        self._taken += len(positions)
+        if self.key is not None:
+            keys = self.frame.column(self.key)[positions]
+        else:
+            keys = np.full(len(positions), None, dtype=object)
+        measures = {}
+        for path in self.paths:
+            floats, valid, _ = self.frame.numeric(path)
+            measures[path] = (floats[positions], valid[positions])
+        return keys, measures
+
+
+# Student's t quantile with `df` degrees of freedom (Cornish-Fisher expansion around
+# the normal quantile z; within 1% of the exact value from 4 degrees of freedom up)
+def t_quantile(z, df):
+    df = np.maximum(df, 1).astype(np.float64)
+    return (z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+            + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * df ** 3))
+
+
+# Estimated $group rows and their intervals ({name: [low, high]} per row) from a sample
+def estimate_groups(accumulators, sample, population, confidence, without_replacement):
+    keys, measures = sample.arrays()
+    n = len(keys)
+    if any(isinstance(k, list) for k in keys):
+        keys = np.array([tuple(k) if isinstance(k, list) else k for k in keys] + [None], dtype=object)[:-1]
+    codes, uniques = pd.factorize(keys, use_na_sentinel=False)
+    groups = len(uniques)
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    fpc = 1.0
+    if without_replacement and population > 1:
+        fpc = math.sqrt(max(population - n, 0) / (population - 1))
+
+    columns, intervals = {}, {}
+    for name, kind, path, factor in accumulators:
+        if kind == "count":
+            p = np.bincount(codes, minlength=groups) / n
+            estimate = population * p * factor
+            half = z * population * np.sqrt(p * (1 - p) / n) * fpc * abs(factor)
+        elif kind == "sum":
+            floats, valid = measures[path]
+            x = np.where(valid, floats, 0.0)
+            mean = np.bincount(codes, weights=x, minlength=groups) / n
+            square = np.bincount(codes, weights=x * x, minlength=groups) / n
+            variance = np.maximum(square - mean * mean, 0) * n / max(n - 1, 1)
+            estimate = population * mean
+            half = z * population * np.sqrt(variance / n) * fpc
+        else:
+            floats, valid = measures[path]
+            k = np.bincount(codes[valid], minlength=groups)
+            total = np.bincount(codes[valid], weights=floats[valid], minlength=groups)
+            square = np.bincount(codes[valid], weights=floats[valid] ** 2, minlength=groups)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                estimate = total / k
+                variance = np.maximum(square / k - estimate * estimate, 0) * k / (k - 1)
+                half = t_quantile(z, k - 1) * np.sqrt(variance / k) * fpc
+            estimate = np.where(k > 0, estimate, np.nan)
+            half = np.where(k >= PREVIEW_MIN_GROUP, half, np.nan)
+        columns[name] = estimate
+        intervals[name] = half
+
+    rows = []
+    for g in range(groups):
+        row = {"_id": uniques[g].item() if isinstance(uniques[g], np.generic) else uniques[g]}
+        bounds = {}
+        for name in columns:
+            value, half = float(columns[name][g]), float(intervals[name][g])
+            row[name] = None if math.isnan(value) else value
+            bounds[name] = None if math.isnan(value) or math.isnan(half) else [value - half, value + half]
+        row["_interval"] = bounds
+        rows.append(row)
+    return rows
+
+
+# Apply the stages after the $group to the estimated rows; returns (rows, intervals)
+def finish_rows(rows, stages):
+    if stages:
+        rows = ROW_ENGINE.aggregate(Frame.from_documents(rows), stages)
+    intervals = []
+    for row in rows:
+        bounds = row.pop("_interval")
+        intervals.append(dict({"_id": row["_id"]}, **bounds))
+    return rows, intervals
+
+
+# Preview rounds of a parsed query: yields one result per round. Without `progressive`
+# it stops at the last round the budget allows; with it, rounds go on until the sample
+# would reach the whole collection (or PREVIEW_MAX_SAMPLE). A round that would is
+# answered by `exact()` instead, which returns the query's rows.
+def preview_rounds(sampler, plan, exact, budget_ms=PREVIEW_BUDGET_MS, confidence=PREVIEW_CONFIDENCE,
+                   first_size=PREVIEW_SAMPLE_SIZE, progressive=False):
+    _, accumulators, stages = plan
+    started = time.perf_counter()
+    sample = Sample(path for _, kind, path, _ in accumulators if kind != "count")
+    population = sampler.population
+    size = max(int(first_size), 1)
+    round_number = 0
+    while True:
+        round_started = time.perf_counter()
+        if sample.size + size >= population or size > PREVIEW_MAX_SAMPLE:
+            rows = exact()
+            yield {
+                "round": round_number + 1, "exact": True, "rows": rows, "sample_size": population,
+                "population": population, "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+            }
+            return
+        keys, measures = sampler.draw(size)
+        sample.add(keys, measures)
+        round_number += 1
+        rows = estimate_groups(accumulators, sample, population, confidence, sampler.without_replacement)
+        rows, intervals = finish_rows(rows, stages)
+        now = time.perf_counter()
+        yield {
+            "round": round_number, "exact": False, "rows": rows, "intervals": intervals, "confidence": confidence,
+            "sample_size": sample.size, "population": population, "elapsed_ms": round((now - started) * 1000, 3),
+        }
+        # The next round draws as many documents as all before it, about twice this one
+        if not progressive and (now - started + 2 * (now - round_started)) * 1000 > budget_ms:
+            return
+        size = sample.size
@@ -0,0 +1,602 @@
+import base64
+import hashlib
+import json
+import re
+import time
+from datetime import date, datetime
+from functools import lru_cache
+
+
+# Limits for /api/execute_query; a request may lower them but never raise them
+EXECUTE_DEFAULTS = {
+    "batch_size": 500,
+    "row_cap": 10000,
+    "max_time_ms": 10000,
+}
+
+
+class QueryParseError(ValueError):
+    pass
+
+
+# A query shape the embedded engine (local_engine) cannot run
+class UnsupportedQuery(ValueError):
+    pass
+
+
+# Shell queries: db.<collection>.<operation>(<args>) with find(), aggregate() or distinct(),
+# then cursor calls such as .sort(...).skip(...).limit(...). The collection may also be
+# named as db.getCollection("<name>") or db["<name>"].
+SHELL_CALL_PATTERN = re.compile(
+    r'\s*db\s*(?:\.\s*(\w+)|\.\s*getCollection\(\s*"([^"\\]+)"\s*\)|\[\s*"([^"\\]+)"\s*\])\s*\.\s*(\w+)\s*\(\s*'
+)
+CHAINED_CALL_PATTERN = re.compile(r"\s*\.\s*(\w+)\s*\(\s*")
+WHITESPACE = re.compile(r"\s*")
+JSON_DECODER = json.JSONDecoder()
+
+# Cursor calls that only change how the shell prints results
+DISPLAY_CALLS = frozenset(["pretty", "toArray"])
+
+# Parsed queries kept by parse_shell_query, by text
+PARSE_CACHE_SIZE = 1024
+
+
+# The arguments of a call whose "(" ends before `position`: JSON values separated by
+# commas. Returns (arguments, position after the closing ")").
+def parse_arguments(text, position, call):
+    args = []
+    if text.startswith(")", position):
+        return args, position + 1
+    while True:
+        try:
+            value, position = JSON_DECODER.raw_decode(text, position)
+        except ValueError as err:
+            raise QueryParseError(f"{call}() arguments are not valid JSON: {err}")
+        args.append(value)
+        position = WHITESPACE.match(text, position).end()
+        separator = text[position:position + 1]
+        if separator not in (",", ")"):
+            raise QueryParseError(f"Expected ',' or ')' in {call}() at position {position}")
+        position = WHITESPACE.match(text, position + 1).end()
+        if separator == ")":
+            return args, position
+
+
+def count_argument(method, args):
+    if len(args) != 1 or not isinstance(args[0], int) or isinstance(args[0], bool):
+        raise QueryParseError(f".{method}() takes one integer")
+    return args[0]
+
+
+# Pipeline of db.<collection>.distinct(field, filter): one row {"_id": value} per distinct
+# value, array elements counted one by one as distinct() does (null is left out)
+def distinct_pipeline(field, query_filter):
+    pipeline = [{"$match": query_filter}] if query_filter else []
+    return pipeline + [{"$unwind": f"${field}"}, {"$group": {"_id": f"${field}"}}, {"$sort": {"_id": 1}}]
+
+
+# Parse a mongo-shell query typed into the execute box or produced by the chat templates.
+# Arguments must be JSON (the form generate_mongo_query and generate_sample_queries emit);
+# nothing is eval'd. Each JSON argument is decoded in place by the C decoder, so the text
+# is read once. distinct() becomes the equivalent aggregation.
+def parse_shell_text(text):
+    match = SHELL_CALL_PATTERN.match(text)
+    if not match:
+        raise QueryParseError("Expected db.<collection>.find(...), .aggregate([...]) or .distinct(...)")
+    collection = match.group(1) or match.group(2) or match.group(3)
+    operation = match.group(4)
+    if operation not in ("find", "aggregate", "distinct"):
+        raise QueryParseError(f"Unsupported operation {operation}(); use find(), aggregate() or distinct()")
+    args, position = parse_arguments(text, match.end(), operation)
+
+    query = {"collection": collection, "operation": operation, "sort": None, "limit": None, "skip": None}
+    if operation == "find":
+        if len(args) > 2:
+            raise QueryParseError("find() takes at most a filter and a projection")
+        query["filter"] = args[0] if args else {}
+        query["projection"] = args[1] if len(args) > 1 else None
+        if not isinstance(query["filter"], dict):
+            raise QueryParseError("find() filter must be a document")
+    elif operation == "aggregate":
+        if len(args) != 1 or not isinstance(args[0], list):
+            raise QueryParseError("aggregate() takes a single pipeline array")
+        query["pipeline"] = args[0]
+    else:
+        if not 1 <= len(args) <= 2 or not isinstance(args[0], str) or not args[0]:
+            raise QueryParseError("distinct() takes a field name and an optional filter")
+        query_filter = args[1] if len(args) > 1 else {}
+        if not isinstance(query_filter, dict):
+            raise QueryParseError("distinct() filter must be a document")
+        query["operation"] = "aggregate"
+        query["pipeline"] = distinct_pipeline(args[0], query_filter)
+
+    while True:
+        chained = CHAINED_CALL_PATTERN.match(text, position)
+        if not chained:
+            break
+        method = chained.group(1)
+        args, position = parse_arguments(text, chained.end(), f".{method}")
+        if method in DISPLAY_CALLS and not args:
+            continue
+        if operation != "find":
+            raise QueryParseError(f".{method}() is only supported after find()")
+        if method in ("sort", "projection"):
+            if len(args) != 1 or not isinstance(args[0], dict):
+                raise QueryParseError(f".{method}() takes one document")
+            if method == "sort":
+                query["sort"] = list(args[0].items()) or None
+            else:
+                query["projection"] = args[0] or None
+        elif method == "limit":
+            # As in the shell, limit(0) is no limit and a negative limit its absolute value
+            query["limit"] = abs(count_argument(method, args)) or None
+        elif method == "skip":
+            skip = count_argument(method, args)
+            if skip < 0:
+                raise QueryParseError(".skip() takes a non-negative integer")
+            query["skip"] = skip or None
+        else:
+            raise QueryParseError(f"Unsupported call .{method}(); use sort(), limit(), skip() or projection()")
+
+    position = WHITESPACE.match(text, position).end()
+    if text.startswith(";", position):
+        position = WHITESPACE.match(text, position + 1).end()
+    if position != len(text):
+        raise QueryParseError(f"Unexpected text after the query at position {position}")
+    return query
+
+
+# parse_shell_text with an LRU of the parsed queries by text, so a query that is run again
+# (the execute box, repeated chat replies) is not parsed again. Callers get a copy of the
+# top level; the filter, pipeline and other values inside are shared and left unchanged.
+def parse_shell_query(text):
+    return dict(cached_parse(text))
+
+
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def cached_parse(text):
+    return parse_shell_text(text)
+
+
+# Encoder of MongoQuery keys, made once: json.dumps with any option builds a new encoder
+# on every call
+KEY_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+# Query as the chat templates build it: rendered to mongo-shell text for the chat UI and
+# executed from as_dict() (the form parse_shell_query returns) without a parse. Equality
+# and hashing go by content, so equal queries share cache entries. Treated as immutable
+# once built.
+class MongoQuery:
+    __slots__ = ("collection", "operation", "filter", "projection", "sort", "limit", "skip", "pipeline", "_key", "_text")
+
+    def __init__(self, collection, operation, filter=None, projection=None, sort=None, limit=None, pipeline=None,
+                 skip=None):
+        self.collection = collection
+        self.operation = operation
+        self.filter = filter
+        self.projection = projection
+        self.sort = sort
+        self.limit = limit
+        self.skip = skip
+        self.pipeline = pipeline
+        self._key = None
+        self._text = None
+
+    @classmethod
+    def find(cls, collection, filter=None, projection=None, sort=None, limit=None, skip=None):
+        return cls(collection, "find", filter or {}, projection, list(sort) if sort else None, limit, skip=skip)
+
+    @classmethod
+    def aggregate(cls, collection, pipeline):
+        return cls(collection, "aggregate", pipeline=list(pipeline))
+
+    @classmethod
+    def from_dict(cls, query):
+        return cls(query["collection"], query["operation"], query.get("filter"), query.get("projection"),
+                   query.get("sort"), query.get("limit"), query.get("pipeline"), query.get("skip"))
+
+    def as_dict(self):
+        query = {"collection": self.collection, "operation": self.operation, "sort": self.sort, "limit": self.limit,
+                 "skip": self.skip}
+        if self.operation == "find":
+            query["filter"] = self.filter
+            query["projection"] = self.projection
+        else:
+            query["pipeline"] = self.pipeline
+        return query
+
+    # Compact JSON of the query's content, in key order
+    def key(self):
+        if self._key is None:
+            self._key = KEY_ENCODER.encode(
+                [self.collection, self.operation, self.filter, self.projection, self.sort, self.limit, self.pipeline, self.skip]
+            )
+        return self._key
+
+    def render(self):
+        if self._text is None:
+            self._text = render_query(self.key())
+        return self._text
+
+    __str__ = render
+
+    def __eq__(self, other):
+        return isinstance(other, MongoQuery) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return f"MongoQuery({self.key()})"
+
+
+# Shell text of a MongoQuery key, laid out like the templates always were (JSON with
+# 4-space indents). json.dumps with an indent runs the pure-Python encoder, so the texts
+# of recurring queries are cached.
+@lru_cache(maxsize=1024)
+def render_query(key):
+    collection, operation, query_filter, projection, sort, limit, pipeline, skip = json.loads(key)
+
+    def dump(value):
+        return json.dumps(value, indent=4, ensure_ascii=False)
+
+    if operation == "aggregate":
+        return f"\ndb.{collection}.aggregate({dump(pipeline)})\n"
+    args = ""
+    if query_filter or projection:
+        args = dump(query_filter)
+        if projection:
+            args += ", " + dump(projection)
+    text = f"\ndb.{collection}.find({args})"
+    if sort:
+        text += f".sort({dump(dict(sort))})"
+    if skip:
+        text += f".skip({skip})"
+    if limit is not None:
+        text += f".limit({limit})"
+    return text + "\n"
+
+
+# Open a cursor for a parsed query. The server is asked for at most row_cap + 1
+# documents so the caller can tell a capped result from a complete one.
+def open_cursor(db, query, batch_size, row_cap, max_time_ms):
+    collection = db[query["collection"]]
+    fetch_limit = row_cap + 1
+    if query["operation"] == "find":
+        if query["limit"]:
+            fetch_limit = min(fetch_limit, query["limit"])
+        cursor = collection.find(
+            query["filter"],
+            query["projection"],
+            batch_size=batch_size,
+            max_time_ms=max_time_ms,
+            limit=fetch_limit,
+            skip=query.get("skip") or 0,
+        )
+        if query["sort"]:
+            cursor = cursor.sort(query["sort"])
+        return cursor
+    pipeline = list(query["pipeline"]) + [{"$limit": fetch_limit}]
+    return collection.aggregate(pipeline, batchSize=batch_size, maxTimeMS=max_time_ms)
+
+
+# Async counterpart of open_cursor for pymongo's AsyncMongoClient
+async def open_async_cursor(db, query, batch_size, row_cap, max_time_ms):
+    collection = db[query["collection"]]
+    fetch_limit = row_cap + 1
+    if query["operation"] == "find":
+        if query["limit"]:
+            fetch_limit = min(fetch_limit, query["limit"])
+        cursor = collection.find(
+            query["filter"],
+            query["projection"],
+            batch_size=batch_size,
+            max_time_ms=max_time_ms,
+            limit=fetch_limit,
+            skip=query.get("skip") or 0,
+        )
+        if query["sort"]:
+            cursor = cursor.sort(query["sort"])
+        return cursor
+    pipeline = list(query["pipeline"]) + [{"$limit": fetch_limit}]
+    return await collection.aggregate(pipeline, batchSize=batch_size, maxTimeMS=max_time_ms)
+
+
+# Stages that may not appear inside a $facet sub-pipeline
+FACET_FORBIDDEN_STAGES = {"$collStats", "$facet", "$geoNear", "$indexStats", "$out", "$merge", "$planCacheStats"}
+
+
+# A parsed query as an aggregation pipeline returning at most row_cap + 1 documents
+def query_pipeline(query, row_cap):
+    if query["operation"] == "aggregate":
+        return list(query["pipeline"]) + [{"$limit": row_cap + 1}]
+    pipeline = [{"$match": query["filter"]}] if query["filter"] else []
+    if query["sort"]:
+        pipeline.append({"$sort": dict(query["sort"])})
+    limit = min(row_cap + 1, query["limit"]) if query["limit"] else row_cap + 1
+    if query.get("skip"):
+        pipeline.append({"$skip": query["skip"]})
+    pipeline.append({"$limit": limit})
+    if query["projection"]:
+        pipeline.append({"$project": query["projection"]})
+    return pipeline
+
+
+# Run many parsed queries with one aggregate round trip per collection: each query
+# becomes one branch of a $facet. Returns {query index: (rows, truncated) or Exception}.
+# Queries whose pipelines cannot be nested in $facet run on their own.
+def run_faceted(db, queries, row_cap, max_time_ms):
+    by_collection = {}
+    for index, query in enumerate(queries):
+        by_collection.setdefault(query["collection"], []).append(index)
+
+    results = {}
+    for collection, indexes in by_collection.items():
+        facets = {}
+        for index in indexes:
+            pipeline = query_pipeline(queries[index], row_cap)
+            if any(next(iter(stage), None) in FACET_FORBIDDEN_STAGES for stage in pipeline):
+                try:
+                    rows = list(db[collection].aggregate(pipeline, maxTimeMS=max_time_ms))
+                    results[index] = (rows[:row_cap], len(rows) > row_cap)
+                except Exception as err:
+                    results[index] = err
+            else:
+                facets[f"q{index}"] = pipeline
+        if not facets:
+            continue
+        try:
+            document = next(db[collection].aggregate([{"$facet": facets}], maxTimeMS=max_time_ms), {})
+        except Exception as err:
+            for name in facets:
+                results[int(name[1:])] = err
+            continue
+        for name in facets:
+            rows = document.get(name, [])
+            results[int(name[1:])] = (rows[:row_cap], len(rows) > row_cap)
+    return results
+
+
+# Keyset pagination. A page token is an opaque (base64 Extended JSON) record of where the
+# previous page stopped: for MongoDB the sort values and _id of its last row, so the next
+# page is found by seeking past them instead of skipping over every earlier row; for the
+# embedded engine, whose sorted order is cached, the row offset. Tokens also carry a
+# fingerprint of the query they belong to and how much of a .limit() is left.
+def encode_page_token(state):
+    from bson import json_util
+    return base64.urlsafe_b64encode(json_util.dumps(state).encode()).decode().rstrip("=")
+
+
+def decode_page_token(token):
+    from bson import json_util
+    try:
+        state = json_util.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        raise QueryParseError("Invalid page token")
+    # Tokens come back from clients: check the shape before anything indexes into it
+    if (not isinstance(state, dict) or not isinstance(state.get("query"), str) or "remaining" not in state
+            or ("after" in state) == ("offset" in state)):
+        raise QueryParseError("Invalid page token")
+    remaining = state["remaining"]
+    if "after" in state:
+        valid = isinstance(state["after"], list)
+    else:
+        valid = isinstance(state["offset"], int) and not isinstance(state["offset"], bool) and state["offset"] >= 0
+    if not valid or not (remaining is None or isinstance(remaining, int) and not isinstance(remaining, bool) and remaining > 0):
+        raise QueryParseError("Invalid page token")
+    return state
+
+
+def query_fingerprint(query):
+    key = [query["collection"], query["filter"], query["projection"], query["sort"], query["limit"], query.get("skip")]
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+# Sort of a paginated find: the requested keys, then _id so that every row has a unique
+# position in the order
+def page_sort(query):
+    sort = [(path, 1 if direction > 0 else -1) for path, direction in query["sort"] or []]
+    if "_id" not in (path for path, _ in sort):
+        sort.append(("_id", 1))
+    return sort
+
+
+# $type aliases of the BSON types in MongoDB's sort order, after missing and null
+# ("number" covers int, long, double and decimal, which compare with each other). The
+# MinKey / MaxKey sentinels never occur in uploaded data and are left out.
+SORT_TYPE_ORDER = ["number", "string", "object", "binData", "objectId", "bool", "date", "timestamp", "regex"]
+
+SORT_TYPE_RANKS = {"Decimal128": 0, "ObjectId": 4, "Timestamp": 7, "Regex": 8}
+
+
+# Position of a (non-null) sort value's type in SORT_TYPE_ORDER, None for other types
+def sort_type_rank(value):
+    if isinstance(value, bool):
+        return 5
+    if isinstance(value, (int, float)):
+        return 0
+    if isinstance(value, str):
+        return 1
+    if isinstance(value, dict):
+        return 2
+    if isinstance(value, datetime):
+        return 6
+    if isinstance(value, bytes):
+        return 3
+    return SORT_TYPE_RANKS.get(type(value).__name__)
+
+
+# Filter matching the rows that come after `values` in `sort` order. $gt / $lt only
+# compare values of the same BSON type, so rows of the types sorting after that of the
+# value (neither null nor a type up to its own) or, in descending order, before it get
+# their own branch; missing and null sort before every other value.
+def seek_filter(sort, values):
+    branches = []
+    for i, ((path, direction), value) in enumerate(zip(sort, values)):
+        prefix = {p: v for (p, _), v in zip(sort[:i], values[:i])}
+        if value is None:
+            after = [{path: {"$ne": None}}] if direction > 0 else []
+        else:
+            after = [{path: {"$gt" if direction > 0 else "$lt": value}}]
+            rank = sort_type_rank(value)
+            if rank is not None and direction > 0:
+                after.append({"$nor": [{path: None}] + [{path: {"$type": alias}} for alias in SORT_TYPE_ORDER[:rank + 1]]})
+            elif rank is not None:
+                after.extend({path: {"$type": alias}} for alias in SORT_TYPE_ORDER[:rank])
+            if direction < 0:
+                after.append({path: None})
+        branches.extend({**prefix, **condition} for condition in after)
+    return {"$or": branches} if branches else {"_id": {"$exists": False}}
+
+
+def sort_values(document, sort):
+    values = []
+    for path, _ in sort:
+        value = document
+        for key in path.split("."):
+            value = value.get(key) if isinstance(value, dict) else None
+        if isinstance(value, list):
+            raise QueryParseError(f"Cannot paginate on array field {path}")
+        values.append(value)
+    return values
+
+
+# The find() for one page of `query` after the position in `state` (None for page 1),
+# the number of rows that page may hold, the .limit() rows left, and the fields to hide
+def keyset_page_query(query, page_size, state):
+    if query["operation"] != "find":
+        raise QueryParseError("Pagination is only supported for find() queries")
+    remaining = state["remaining"] if state else query["limit"]
+    this_page = min(page_size, remaining) if remaining else page_size
+    sort = page_sort(query)
+    query_filter = query["filter"]
+    if state:
+        if len(state["after"]) != len(sort):
+            raise QueryParseError("Invalid page token")
+        seek = seek_filter(sort, state["after"])
+        query_filter = {"$and": [query_filter, seek]} if query_filter else seek
+    # The sort keys must come back with each row to build the next token; top-level
+    # fields added for that are hidden from the client again
+    projection, hidden = query["projection"], set()
+    if projection:
+        if any(v for k, v in projection.items() if k != "_id"):
+            shown = {k.split(".")[0] for k, v in projection.items() if v}
+            if projection.get("_id", 1):
+                shown.add("_id")
+            hidden = {path.split(".")[0] for path, _ in sort} - shown
+            projection = {**projection, **{path: 1 for path, _ in sort}}
+        else:
+            hidden = {path.split(".")[0] for path, _ in sort if projection.get(path, 1) == 0}
+            projection = {k: v for k, v in projection.items() if k not in dict(sort)}
+    more = remaining is None or remaining > this_page
+    # The first page skips as the query does; later pages seek past the rows already sent
+    page = dict(query, filter=query_filter, sort=sort, projection=projection or None,
+                limit=this_page + (1 if more else 0), skip=None if state else query.get("skip"))
+    return page, this_page, remaining, hidden
+
+
+# Cursor-like wrapper so locally computed results stream through stream_ndjson
+class ListCursor:
+    def __init__(self, documents):
+        self._documents = iter(documents)
+
+    def __iter__(self):
+        return self._documents
+
+    def close(self):
+        self._documents = iter(())
+
+
+# JSON fallback for BSON types, rendered the way the results table shows them
+def json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def ndjson_line(document):
+    return json.dumps(document, default=json_default) + "\n"
+
+
+def end_line(rows, truncated, next_page_token=None):
+    end = {"rows": rows, "truncated": truncated}
+    if next_page_token is not None:
+        end["next_page_token"] = next_page_token
+    return json.dumps({"$end": end}) + "\n"
+
+
+def error_line(err):
+    return json.dumps({"$error": str(err)}) + "\n"
+
+
+# Yield one NDJSON line per document while the cursor is still fetching, then a trailer
+# line with the row count. Only the current batch is ever held in memory. on_complete, if
+# given, receives the seconds spent waiting on the cursor and encoding rows; page_token_for,
+# if given, builds the trailer's next_page_token from the last row of a truncated page;
+# top-level fields in `hide` (added only to build that token) are left out of the rows.
+def stream_ndjson(cursor, row_cap, on_complete=None, page_token_for=None, hide=()):
+    rows = 0
+    truncated = False
+    last = None
+    fetch_seconds = serialize_seconds = 0.0
+    documents = iter(cursor)
+    try:
+        while True:
+            started = time.perf_counter()
+            document = next(documents, None)
+            fetched = time.perf_counter()
+            fetch_seconds += fetched - started
+            if document is None:
+                break
+            if rows == row_cap:
+                truncated = True
+                break
+            rows += 1
+            last = document
+            line = ndjson_line({k: v for k, v in document.items() if k not in hide} if hide else document)
+            serialize_seconds += time.perf_counter() - fetched
+            yield line
+        token = page_token_for(last) if truncated and page_token_for is not None else None
+    except Exception as err:
+        yield error_line(err)
+        return
+    finally:
+        cursor.close()
+        if on_complete is not None:
+            on_complete(fetch_seconds, serialize_seconds)
+    yield end_line(rows, truncated, token)
+
+
+# stream_ndjson for an async cursor; fetch time is time spent awaiting the next batch
+async def stream_ndjson_async(cursor, row_cap, on_complete=None, page_token_for=None, hide=()):
+    rows = 0
+    truncated = False
+    last = None
+    fetch_seconds = serialize_seconds = 0.0
+    documents = cursor.__aiter__()
+    try:
+        while True:
+            started = time.perf_counter()
+            document = await anext(documents, None)
+            fetched = time.perf_counter()
+            fetch_seconds += fetched - started
+            if document is None:
+                break
+            if rows == row_cap:
+                truncated = True
+                break
+            rows += 1
+            last = document
+            line = ndjson_line({k: v for k, v in document.items() if k not in hide} if hide else document)
+            serialize_seconds += time.perf_counter() - fetched
+            yield line
+        token = page_token_for(last) if truncated and page_token_for is not None else None
+    except Exception as err:
+        yield error_line(err)
+        return
+    finally:
+        await cursor.close()
+        if on_complete is not None:
+            on_complete(fetch_seconds, serialize_seconds)
+    yield end_line(rows, truncated, token)
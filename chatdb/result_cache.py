@@ -0,0 +1,221 @@
+# Results of executed queries, in a size-bounded LRU with a TTL.
+#
+# Entries are keyed by a canonical hash of the parsed query (collection, filter /
+# normalized pipeline, sort, limit) and the row cap, so the same query text in any key
+# order hits the same entry, whichever chat message produced it. Each entry records the
+# version of every collection the query reads; ingestion bumps a collection's version
+# (bump()), which makes the results read from its old data stale at once instead of when
+# the TTL runs out. The TTL bounds the staleness of writes made outside this process.
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import RESULT_CACHE_EVENTS
+
+
+RESULT_CACHE_SIZE = int(os.environ.get("CHATDB_RESULT_CACHE_SIZE", "256"))
+
+RESULT_CACHE_TTL = float(os.environ.get("CHATDB_RESULT_CACHE_TTL", "300"))
+
+# Results with more rows than this are not cached
+RESULT_CACHE_MAX_ROWS = int(os.environ.get("CHATDB_RESULT_CACHE_MAX_ROWS", "10000"))
+
+# Stages whose argument's key order is part of their meaning (sort priority, output field
+# order); every other document is compared with its keys sorted
+ORDERED_STAGES = frozenset(["$sort", "$project", "$group", "$addFields", "$set"])
+
+
+def ordered_stage(stage):
+    if isinstance(stage, dict) and len(stage) == 1:
+        (operator, argument), = stage.items()
+        if operator in ORDERED_STAGES and isinstance(argument, dict):
+            return {operator: [[key, value] for key, value in argument.items()]}
+    return stage
+
+
+def result_key(query, row_cap):
+    normalized = dict(query)
+    if query.get("pipeline") is not None:
+        normalized["pipeline"] = [ordered_stage(stage) for stage in query["pipeline"]]
+    text = json.dumps([normalized, row_cap], sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+# Collections a query reads: its own and those of $lookup, $graphLookup and $unionWith
+# stages, including the sub-pipelines of $lookup, $unionWith and $facet
+def query_collections(query):
+    names = [query["collection"]]
+
+    def visit(pipeline):
+        for stage in pipeline or []:
+            if not isinstance(stage, dict):
+                continue
+            for operator, argument in stage.items():
+                if operator in ("$lookup", "$graphLookup") and isinstance(argument, dict):
+                    if isinstance(argument.get("from"), str):
+                        names.append(argument["from"])
+                    if isinstance(argument.get("pipeline"), list):
+                        visit(argument["pipeline"])
+                elif operator == "$unionWith":
+                    if isinstance(argument, str):
+                        names.append(argument)
+                    elif isinstance(argument, dict):
+                        if isinstance(argument.get("coll"), str):
+                            names.append(argument["coll"])
+                        if isinstance(argument.get("pipeline"), list):
+                            visit(argument["pipeline"])
+                elif operator == "$facet" and isinstance(argument, dict):
+                    for branch in argument.values():
+                        if isinstance(branch, list):
+                            visit(branch)
+
+    visit(query.get("pipeline"))
+    return tuple(sorted(set(names)))
+
+
+class ResultCache:
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, max_rows=RESULT_CACHE_MAX_ROWS,
+                 events=RESULT_CACHE_EVENTS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.events = events
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._versions = {}
+
+    # Current versions of the given collections; taken before a query runs and passed to
+    # put(), so a write that lands while it runs keeps its result out of the cache
+    def versions(self, collections):
+        return tuple(self._versions.get(name, 0) for name in collections)
+
+    # The collection was written: drop every result read from it
+    def bump(self, collection):
+        with self._lock:
+            self._versions[collection] = self._versions.get(collection, 0) + 1
+            stale = [key for key, entry in self._entries.items() if collection in entry[0]]
+            for key in stale:
+                del self._entries[key]
+        if stale:
+            self.events.inc("invalidation", amount=len(stale))
+
+    # (rows, truncated) of a cached result, or None
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                collections, versions, expires, result = entry
+                if expires <= now:
+                    del self._entries[key]
+                    event = "expiration"
+                elif versions != self.versions(collections):
+                    del self._entries[key]
+                    event = "invalidation"
+                else:
+                    self._entries.move_to_end(key)
+                    event = None
+        if entry is not None and event is None:
+            self.events.inc("hit")
+            return result
+        if entry is not None:
+            self.events.inc(event)
+        self.events.inc("miss")
+        return None
+
+    def put(self, key, collections, versions, rows, truncated):
+        if len(rows) > self.max_rows or self.max_entries <= 0:
+            return
+        evicted = 0
+        with self._lock:
+            if versions != self.versions(collections):
+                return
+            self._entries[key] = (collections, versions, time.monotonic() + self.ttl, (rows, truncated))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+        if evicted:
+            self.events.inc("eviction", amount=evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._entries)
+            rows = sum(len(entry[3][0]) for entry in self._entries.values())
+        counts = {event: self.events.value(event) for event in ("hit", "miss", "eviction", "expiration", "invalidation")}
+        lookups = counts["hit"] + counts["miss"]
+        return {
+            "entries": entries,
+            "rows": rows,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            **counts,
+            "hit_ratio": counts["hit"] / lookups if lookups else None,
+            "versions": dict(self._versions),
+        }
+
+
+# Cursor wrapper that collects the documents a response streams and caches them once the
+# cursor was read to its end (or one past the row cap); an error or a client that
+# disconnects early leaves the cache alone. A result with more rows than the cache holds
+# is not collected past that point: its rows only pass through.
+class RecordingCursor:
+    def __init__(self, cursor, cache, key, collections, versions, row_cap):
+        self.cursor = cursor
+        self.cache = cache
+        self.key = key
+        self.collections = collections
+        self.versions = versions
+        self.row_cap = row_cap
+        self.rows = []
+        self.complete = False
+
+    # rows becomes None once the result is known to be too large to cache
+    def record(self, document):
+        if self.rows is None:
+            return
+        self.rows.append(document)
+        if len(self.rows) > self.row_cap:
+            self.complete = True
+        elif len(self.rows) > self.cache.max_rows:
+            self.rows = None
+
+    def __iter__(self):
+        for document in self.cursor:
+            self.record(document)
+            yield document
+        self.complete = True
+
+    def store(self):
+        if self.complete and self.rows is not None:
+            self.cache.put(self.key, self.collections, self.versions, self.rows[:self.row_cap], len(self.rows) > self.row_cap)
+
+    def close(self):
+        self.cursor.close()
+        self.store()
+
+
+# Documents to stream for a cached result: a placeholder past the row cap marks it as
+# truncated, as the extra document fetched from the cursor did
+def cached_documents(rows, truncated):
+    return rows + [{}] if truncated else rows
+
+
+# RecordingCursor for the async cursors of the ASGI server
+class AsyncRecordingCursor(RecordingCursor):
+    async def __aiter__(self):
+        async for document in self.cursor:
+            self.record(document)
+            yield document
+        self.complete = True
+
+    async def close(self):
+        await self.cursor.close()
+        self.store()
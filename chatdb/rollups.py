@@ -0,0 +1,631 @@
+# Rollups maintained while collections are ingested, so that the common aggregations
+# read one document per group or per day instead of every document.
+#
+# Day buckets (time-window queries). Every top-level timestamp field of the documents
+# (including the <prefix>timestamp that CSV ingestion combines from <prefix>date and
+# <prefix>time columns) gets one bucket per calendar day in the DAILY_ROLLUPS side
+# collection, holding the number of documents and the sum of each numeric measure:
+#
+#   {"collection": "sales", "field": "transaction_timestamp", "day": "2023-01-01",
+#    "week": "2022-12-26", "month": "2023-01", "count": 512, "sum": {"transaction_qty": 731, ...}}
+#
+# The buckets of an ingestion are collected in memory and applied with $inc when it
+# ends, so appending to a collection keeps them current. A window then costs one bucket per day instead of one read per row; only
+# the partial days at its edges are aggregated from the raw documents.
+#
+# Group rollups ("total / average <A> by <B>", "count of <B>"). Every top-level attribute
+# <B> gets one document per value in the GROUP_ROLLUPS side collection, holding the
+# number of documents and, per measure, the sum and the number of numeric values, so
+# that an average is sum / n exactly as $avg computes it:
+#
+#   {"_id": {"collection": "orders", "attr": "status", "value": "shipped"},
+#    "collection": "orders", "attr": "status", "value": "shipped",
+#    "count": 3, "sum": {"totalAmount": 1549.97}, "n": {"totalAmount": 3}}
+#
+# The ROLLUP_CATALOG document of each collection records how many documents were
+# folded in and which attribute rollups are complete.
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from ingest import INTERNAL_PREFIX
+from schema import ID_FIELD_PATTERN
+
+
+DAILY_ROLLUPS = INTERNAL_PREFIX + "rollups_daily"
+GROUP_ROLLUPS = INTERNAL_PREFIX + "rollups"
+ROLLUP_CATALOG = INTERNAL_PREFIX + "rollup_catalog"
+
+# Groups an attribute may have before its rollup is dropped: past that, reading the
+# rollup is no longer much cheaper than grouping the documents themselves
+ROLLUP_MAX_GROUPS = int(os.environ.get("CHATDB_ROLLUP_MAX_GROUPS", "1000"))
+
+PERIODS = ("day", "week", "month")
+
+# Formats tried before falling back to per-value parsing (sales.csv: 1/1/2023 7:59:58)
+TIMESTAMP_FORMATS = ("%m/%d/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S")
+
+
+# (date column, time column, timestamp field) for every <prefix>date column that has a
+# matching <prefix>time column, e.g. transaction_date + transaction_time
+def timestamp_columns(columns):
+    by_lower = {str(column).lower(): column for column in columns}
+    pairs = []
+    for column in columns:
+        name = str(column)
+        if not name.lower().endswith("date"):
+            continue
+        prefix = name[:-4]
+        time_column = by_lower.get(prefix.lower() + "time")
+        if time_column is not None:
+            pairs.append((column, time_column, prefix + "timestamp"))
+    return pairs
+
+
+# Add the combined timestamp columns to a DataFrame chunk read from a CSV; returns the
+# names of the fields added. Unparseable date/time pairs become missing values.
+def add_timestamps(chunk):
+    import pandas as pd
+
+    fields = []
+    for date_column, time_column, field in timestamp_columns(list(chunk.columns)):
+        present = chunk[date_column].notna() & chunk[time_column].notna()
+        text = chunk[date_column].astype(str) + " " + chunk[time_column].astype(str)
+        parsed = pd.Series(pd.NaT, index=chunk.index, dtype="datetime64[ns]")
+        for timestamp_format in TIMESTAMP_FORMATS:
+            pending = present & parsed.isna()
+            if not pending.any():
+                break
+            parsed[pending] = pd.to_datetime(text[pending], format=timestamp_format, errors="coerce")
+        pending = present & parsed.isna()
+        if pending.any():
+            parsed[pending] = pd.to_datetime(text[pending], format="mixed", errors="coerce")
+        chunk[field] = parsed
+        fields.append(field)
+    return fields
+
+
+def is_measure_field(key):
+    return key != "_id" and not ID_FIELD_PATTERN.search(key)
+
+
+# Key of a sum inside a bucket; dots would nest the $inc path
+def measure_key(field):
+    return field.replace(".", "_")
+
+
+# ISO keys of the day, week (its Monday) and month a timestamp falls in
+def bucket_keys(timestamp):
+    day = timestamp.date()
+    week = day - timedelta(days=day.weekday())
+    return day.isoformat(), week.isoformat(), day.isoformat()[:7]
+
+
+def add_to_bucket(buckets, field, timestamp, count, sums):
+    day, week, month = bucket_keys(timestamp)
+    bucket = buckets.get((field, day))
+    if bucket is None:
+        bucket = buckets[(field, day)] = [week, month, 0, {}]
+    bucket[2] += count
+    totals = bucket[3]
+    for key, total in sums:
+        totals[key] = totals.get(key, 0) + total
+
+
+# Add the buckets of one batch to those collected for an ingestion
+def merge_buckets(into, buckets):
+    for key, (week, month, count, sums) in buckets.items():
+        bucket = into.get(key)
+        if bucket is None:
+            into[key] = [week, month, count, dict(sums)]
+            continue
+        bucket[2] += count
+        totals = bucket[3]
+        for name, total in sums.items():
+            totals[name] = totals.get(name, 0) + total
+
+
+# {(field, day): [week, month, count, {measure: sum}]} for a batch of documents: every
+# top-level date is a timestamp field, every top-level number (except ids) a measure
+def daily_buckets(documents):
+    buckets = {}
+    measure_keys = {}
+    for document in documents:
+        measures = None
+        for field, value in document.items():
+            if not isinstance(value, datetime) or value != value:
+                continue
+            if measures is None:
+                measures = []
+                for key, item in document.items():
+                    if isinstance(item, (int, float)) and not isinstance(item, bool) and item == item:
+                        name = measure_keys.get(key)
+                        if name is None:
+                            name = measure_keys[key] = measure_key(key) if is_measure_field(key) else ""
+                        if name:
+                            measures.append((name, item))
+            add_to_bucket(buckets, field, value, 1, measures)
+    return buckets
+
+
+# daily_buckets for a DataFrame chunk and its timestamp columns, grouped by pandas
+def frame_buckets(chunk, fields):
+    measures = [column for column in chunk.columns if chunk[column].dtype.kind in "iuf" and is_measure_field(str(column))]
+    buckets = {}
+    for field in fields:
+        present = chunk[field].notna()
+        if not present.any():
+            continue
+        grouped = chunk.loc[present, measures].groupby(chunk.loc[present, field].dt.normalize())
+        counts = grouped.size()
+        sums = grouped.sum()
+        columns = [(measure_key(str(column)), sums[column].tolist()) for column in measures]
+        for i, (day, count) in enumerate(zip(counts.index, counts.tolist())):
+            add_to_bucket(buckets, field, day, count, [(key, values[i]) for key, values in columns])
+    return buckets
+
+
+# Fold the buckets of an ingestion into the day rollups of its collection; returns the
+# timestamp fields seen. Loading a new collection (loading=True) inserts the buckets,
+# replacing any left from before it, instead of upserting them one by one.
+def update_daily_rollups(collection, buckets, loading=False):
+    from pymongo import UpdateOne
+
+    if not buckets:
+        return set()
+    name = collection.name
+    if loading:
+        store = collection.database[DAILY_ROLLUPS]
+        store.delete_many({"collection": name})
+        store.insert_many([
+            {"_id": f"{name}|{field}|{day}", "collection": name, "field": field, "day": day, "week": week,
+             "month": month, "count": count, "sum": dict(sums)}
+            for (field, day), (week, month, count, sums) in buckets.items()
+        ], ordered=False)
+        return {field for field, _ in buckets}
+    requests = []
+    for (field, day), (week, month, count, sums) in buckets.items():
+        increments = {"count": count}
+        increments.update({f"sum.{key}": total for key, total in sums.items()})
+        requests.append(UpdateOne(
+            {"_id": f"{name}|{field}|{day}"},
+            {
+                "$inc": increments,
+                "$setOnInsert": {"collection": name, "field": field, "day": day, "week": week, "month": month},
+            },
+            upsert=True,
+        ))
+    collection.database[DAILY_ROLLUPS].bulk_write(requests, ordered=False)
+    return {field for field, _ in buckets}
+
+
+# Indexes for windowed reads: the raw timestamp fields and the buckets by day
+def ensure_time_indexes(collection, fields):
+    for field in fields:
+        collection.create_index(field)
+    collection.database[DAILY_ROLLUPS].create_index([("collection", 1), ("field", 1), ("day", 1)])
+
+
+# Timestamp field of a collection schema: the combined CSV timestamp, else the first
+# field sampled as a date
+def time_field(schema):
+    if schema is None:
+        return None
+    pairs = timestamp_columns(schema.fields)
+    if pairs:
+        return pairs[0][2]
+    return next((field for field in schema.fields if schema.types.get(field) == "date"), None)
+
+
+def period_key(day, period):
+    if period == "day":
+        return day
+    if period == "month":
+        return day[:7]
+    start = datetime.strptime(day, "%Y-%m-%d").date()
+    return (start - timedelta(days=start.weekday())).isoformat()
+
+
+def start_of_day(timestamp):
+    return datetime(timestamp.year, timestamp.month, timestamp.day)
+
+
+# Per-period count and sums of `field` in [start, end). Whole days are read from the
+# day buckets; the partial days at either edge of the window are aggregated from the
+# raw documents with a range scan on the (indexed) timestamp field.
+def window_totals(db, collection, field, start, end, period="day"):
+    if period not in PERIODS:
+        raise ValueError(f"period must be one of {', '.join(PERIODS)}")
+    first_full = start_of_day(start)
+    if first_full < start:
+        first_full += timedelta(days=1)
+    last_full = start_of_day(end)
+
+    days, scanned, bucket_count = {}, 0, 0
+    if first_full < last_full:
+        cursor = db[DAILY_ROLLUPS].find({
+            "collection": collection,
+            "field": field,
+            "day": {"$gte": first_full.date().isoformat(), "$lt": last_full.date().isoformat()},
+        })
+        for bucket in cursor:
+            bucket_count += 1
+            days[bucket["day"]] = [bucket["count"], dict(bucket.get("sum") or {})]
+        edges = [(start, first_full), (last_full, end)]
+    else:
+        edges = [(start, end)]
+
+    for low, high in edges:
+        if low >= high:
+            continue
+        documents = list(db[collection].find({field: {"$gte": low, "$lt": high}}))
+        scanned += len(documents)
+        for (bucket_field, day), (_, _, count, sums) in daily_buckets(documents).items():
+            if bucket_field != field:
+                continue
+            totals = days.setdefault(day, [0, {}])
+            totals[0] += count
+            for key, total in sums.items():
+                totals[1][key] = totals[1].get(key, 0) + total
+
+    periods = {}
+    for day in sorted(days):
+        count, sums = days[day]
+        totals = periods.setdefault(period_key(day, period), {"count": 0, "sum": {}})
+        totals["count"] += count
+        for key, total in sums.items():
+            totals["sum"][key] = totals["sum"].get(key, 0) + total
+    return {
+        "collection": collection,
+        "field": field,
+        "period": period,
+        "buckets": [{"period": key, **totals} for key, totals in periods.items()],
+        "rollup_days": bucket_count,
+        "scanned_rows": scanned,
+    }
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value == value
+
+
+# Output document of a rebuilt group, in the stored form
+def group_document(collection, attr, value, count, sums, numbers):
+    return {
+        "_id": {"collection": collection, "attr": attr, "value": value},
+        "collection": collection,
+        "attr": attr,
+        "value": value,
+        "count": count,
+        "sum": sums,
+        "n": numbers,
+    }
+
+
+# Incremental maintenance of the group rollups of one collection during an ingestion.
+# A top-level number in a field that is not an id is a measure; every other top-level
+# field except dates (which get day buckets) is an attribute to group by. An attribute
+# rollup is "ready", "stale" (the attribute first appeared after documents without it
+# had been folded in, so their null group is incomplete until rebuilt) or "dropped" (too
+# many groups, or array / sub-document values).
+#
+# Loading a new (empty) collection keeps the groups in memory, bounded by max_groups per
+# attribute, and writes them with one insert_many and the catalog once in finish().
+# Appending to a collection with documents upserts the groups of every batch.
+class GroupRollups:
+    def __init__(self, collection, max_groups=ROLLUP_MAX_GROUPS):
+        self.collection = collection
+        self.db = collection.database
+        self.name = collection.name
+        self.max_groups = max_groups
+        catalog = self.db[ROLLUP_CATALOG].find_one({"_id": self.name}) or {}
+        self.documents = catalog.get("documents", 0)
+        self.measures = set(catalog.get("measures") or [])
+        self.attrs = {state["attr"]: dict(state) for state in catalog.get("attrs") or []}
+        self.loading = not self.documents and collection.estimated_document_count() == 0
+        self.pending = {}
+
+    def register(self, attrs, measures):
+        self.measures.update(measures)
+        for attr in attrs:
+            if attr not in self.attrs:
+                status = "stale" if self.documents else "ready"
+                self.attrs[attr] = {"attr": attr, "status": status, "groups": 0, "reason": None}
+
+    # Fold one inserted batch of documents into the rollups
+    def add(self, documents):
+        if not documents:
+            return
+        attrs, measures = set(), set()
+        for document in documents:
+            for key, value in document.items():
+                if key == "_id" or isinstance(value, datetime):
+                    continue
+                if is_measure_field(key) and (value is None or is_number(value)):
+                    if value is not None:
+                        measures.add(key)
+                else:
+                    attrs.add(key)
+        self.register(sorted(attrs), measures)
+        active = [attr for attr, state in self.attrs.items() if state["status"] != "dropped"]
+        names = [(key, measure_key(key)) for key in self.measures]
+
+        groups = {}
+        for document in documents:
+            values = [(name, document.get(key)) for key, name in names]
+            values = [(name, value) for name, value in values if is_number(value)]
+            for attr in active:
+                value = document.get(attr)
+                if isinstance(value, (dict, list)):
+                    if self.attrs[attr]["status"] != "dropped":
+                        self.drop(attr, "array or sub-document values")
+                    continue
+                key = (attr, type(value) is bool, value)
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = [value, 0, {}, {}]
+                group[1] += 1
+                sums, numbers = group[2], group[3]
+                for name, item in values:
+                    sums[name] = sums.get(name, 0) + item
+                    numbers[name] = numbers.get(name, 0) + 1
+        self.write(groups, len(documents))
+
+    # add() for a DataFrame chunk of a CSV whose rows were all inserted, grouped with
+    # pandas instead of document by document
+    def add_frame(self, chunk):
+        import pandas as pd
+
+        if not len(chunk):
+            return
+        attrs, measures = [], []
+        for column in chunk.columns:
+            kind = chunk[column].dtype.kind
+            if kind == "M":
+                continue
+            if kind in "iuf" and is_measure_field(str(column)):
+                measures.append(column)
+            else:
+                attrs.append(column)
+        self.register(attrs, measures)
+
+        groups = {}
+        for attr in attrs:
+            if self.attrs[attr]["status"] == "dropped":
+                continue
+            codes, uniques = pd.factorize(chunk[attr], use_na_sentinel=False)
+            grouped = chunk[measures].groupby(codes)
+            counts = grouped.size().tolist()
+            sums = {measure_key(str(column)): values.tolist() for column, values in grouped.sum().items()}
+            numbers = {measure_key(str(column)): values.tolist() for column, values in grouped.count().items()}
+            for i, value in enumerate(uniques.tolist()):
+                if value != value:
+                    value = None
+                group_sums = {name: totals[i] for name, totals in sums.items() if numbers[name][i]}
+                group_numbers = {name: totals[i] for name, totals in numbers.items() if totals[i]}
+                groups[(attr, type(value) is bool, value)] = [value, counts[i], group_sums, group_numbers]
+        self.write(groups, len(chunk))
+
+    # Apply the groups of one batch: {(attr, is bool, value): [value, count, sums, numbers]}
+    def write(self, groups, documents):
+        from pymongo import UpdateOne
+
+        batch_groups = {}
+        for attr, _, _ in groups:
+            batch_groups[attr] = batch_groups.get(attr, 0) + 1
+        for attr, count in batch_groups.items():
+            if self.attrs[attr]["status"] != "dropped" and count > self.max_groups:
+                self.drop(attr, "too many groups")
+
+        if self.loading:
+            self.merge(groups)
+            self.documents += documents
+            return
+
+        requests, owners = [], []
+        for (attr, _, _), (value, count, sums, numbers) in groups.items():
+            if self.attrs[attr]["status"] == "dropped":
+                continue
+            increments = {"count": count}
+            increments.update({f"sum.{name}": total for name, total in sums.items()})
+            increments.update({f"n.{name}": total for name, total in numbers.items()})
+            requests.append(UpdateOne(
+                {"_id": {"collection": self.name, "attr": attr, "value": value}},
+                {"$inc": increments, "$setOnInsert": {"collection": self.name, "attr": attr, "value": value}},
+                upsert=True,
+            ))
+            owners.append(attr)
+        if requests:
+            result = self.db[GROUP_ROLLUPS].bulk_write(requests, ordered=False)
+            for index in result.upserted_ids:
+                self.attrs[owners[index]]["groups"] += 1
+        for attr, state in self.attrs.items():
+            if state["status"] != "dropped" and state["groups"] > self.max_groups:
+                self.drop(attr, "too many groups")
+        self.documents += documents
+        self.save()
+
+    # Fold the groups of one batch into the pending groups of a load
+    def merge(self, groups):
+        for key, (value, count, sums, numbers) in groups.items():
+            state = self.attrs[key[0]]
+            if state["status"] == "dropped":
+                continue
+            group = self.pending.get(key)
+            if group is None:
+                self.pending[key] = [value, count, dict(sums), dict(numbers)]
+                state["groups"] += 1
+                continue
+            group[1] += count
+            for name, total in sums.items():
+                group[2][name] = group[2].get(name, 0) + total
+            for name, total in numbers.items():
+                group[3][name] = group[3].get(name, 0) + total
+        for attr, state in self.attrs.items():
+            if state["status"] != "dropped" and state["groups"] > self.max_groups:
+                self.drop(attr, "too many groups")
+
+    # Write the groups of a load; any group documents left from before it are replaced
+    def flush(self):
+        self.db[GROUP_ROLLUPS].delete_many({"collection": self.name})
+        documents = [
+            group_document(self.name, attr, value, count, sums, numbers)
+            for (attr, _, _), (value, count, sums, numbers) in self.pending.items()
+        ]
+        if documents:
+            self.db[GROUP_ROLLUPS].insert_many(documents, ordered=False)
+        self.pending = {}
+        self.save()
+
+    def drop(self, attr, reason):
+        self.attrs[attr].update(status="dropped", groups=0, reason=reason)
+        if self.loading:
+            self.pending = {key: group for key, group in self.pending.items() if key[0] != attr}
+            return
+        self.db[GROUP_ROLLUPS].delete_many({"collection": self.name, "attr": attr})
+
+    def save(self):
+        self.db[ROLLUP_CATALOG].replace_one({"_id": self.name}, {
+            "_id": self.name,
+            "documents": self.documents,
+            "measures": sorted(self.measures),
+            "attrs": list(self.attrs.values()),
+            "updated_at": time.time(),
+        }, upsert=True)
+
+    # End of an ingestion: rebuild rollups that cannot be trusted, i.e. stale ones, or
+    # all of them when the collection holds documents that were never folded in
+    def finish(self):
+        if self.loading:
+            self.flush()
+        self.db[GROUP_ROLLUPS].create_index([("collection", 1), ("attr", 1)])
+        if self.collection.estimated_document_count() != self.documents:
+            pending = [attr for attr, state in self.attrs.items() if state["status"] != "dropped"]
+        else:
+            pending = [attr for attr, state in self.attrs.items() if state["status"] == "stale"]
+        if pending:
+            rebuild_group_rollups(self.db, self.name, pending, sorted(self.measures), self.max_groups)
+
+
+# Recompute attribute rollups from the documents with $group (independently of the
+# incremental path), count the stored groups that differ, and replace them. Returns
+# {attr: {"status", "groups", "mismatched"}} and updates the catalog.
+def rebuild_group_rollups(db, collection, attrs, measures, max_groups=ROLLUP_MAX_GROUPS):
+    stored_catalog = db[ROLLUP_CATALOG].find_one({"_id": collection}) or {}
+    states = {state["attr"]: dict(state) for state in stored_catalog.get("attrs") or []}
+    measures = [measure for measure in measures if is_measure_field(measure)]
+    documents = db[collection].count_documents({})
+    report = {}
+    for attr in attrs:
+        accumulators = {"count": {"$sum": 1}}
+        for i, measure in enumerate(measures):
+            accumulators[f"sum{i}"] = {"$sum": f"${measure}"}
+            accumulators[f"n{i}"] = {"$sum": {"$cond": [{"$isNumber": f"${measure}"}, 1, 0]}}
+        rows = list(db[collection].aggregate([{"$group": {"_id": f"${attr}", **accumulators}}, {"$limit": max_groups + 1}]))
+
+        state = {"attr": attr, "status": "ready", "groups": len(rows), "reason": None}
+        if len(rows) > max_groups:
+            state.update(status="dropped", groups=0, reason="too many groups")
+        elif any(isinstance(row["_id"], (dict, list)) for row in rows):
+            state.update(status="dropped", groups=0, reason="array or sub-document values")
+
+        rebuilt = {}
+        for row in rows:
+            sums, numbers = {}, {}
+            for i, measure in enumerate(measures):
+                if row[f"n{i}"]:
+                    sums[measure_key(measure)] = row[f"sum{i}"]
+                    numbers[measure_key(measure)] = row[f"n{i}"]
+            rebuilt[(type(row["_id"]) is bool, row["_id"])] = group_document(collection, attr, row["_id"], row["count"], sums, numbers)
+
+        mismatched = 0
+        if state["status"] == "ready":
+            stored = {}
+            for document in db[GROUP_ROLLUPS].find({"collection": collection, "attr": attr}):
+                stored[(type(document["value"]) is bool, document["value"])] = document
+            for key in set(stored) | set(rebuilt):
+                if not same_group(stored.get(key), rebuilt.get(key)):
+                    mismatched += 1
+
+        db[GROUP_ROLLUPS].delete_many({"collection": collection, "attr": attr})
+        if state["status"] == "ready" and rebuilt:
+            db[GROUP_ROLLUPS].insert_many(list(rebuilt.values()))
+        states[attr] = state
+        report[attr] = {"status": state["status"], "groups": state["groups"], "mismatched": mismatched}
+
+    db[ROLLUP_CATALOG].replace_one({"_id": collection}, {
+        "_id": collection,
+        "documents": documents,
+        "measures": sorted(set(stored_catalog.get("measures") or []) | set(measures)),
+        "attrs": list(states.values()),
+        "updated_at": time.time(),
+    }, upsert=True)
+    return report
+
+
+# Whether a stored group matches its rebuilt counterpart (sums up to float rounding)
+def same_group(stored, rebuilt):
+    if stored is None or rebuilt is None:
+        return stored is rebuilt
+    if stored.get("count") != rebuilt["count"] or (stored.get("n") or {}) != rebuilt["n"]:
+        return False
+    sums = stored.get("sum") or {}
+    return set(sums) == set(rebuilt["sum"]) and all(
+        abs(sums[key] - total) <= 1e-9 * max(1.0, abs(total)) for key, total in rebuilt["sum"].items()
+    )
+
+
+# In-memory copy of the rollup catalog for query generation, so choosing between a
+# rollup and a live $group never waits on MongoDB. The first lookup starts a background
+# load, and uploads reload it; until a load succeeds nothing is covered.
+class RollupCatalog:
+    def __init__(self, get_database):
+        self.get_database = get_database
+        self._lock = threading.Lock()
+        self._thread = None
+        self._entries = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self.refresh, name="rollup-catalog", daemon=True)
+            self._thread.start()
+
+    def refresh(self):
+        try:
+            catalog = list(self.get_database()[ROLLUP_CATALOG].find())
+        except Exception:
+            return False
+        entries = {}
+        for entry in catalog:
+            entry["attrs"] = {state["attr"]: state for state in entry.get("attrs") or []}
+            entry["measures"] = set(entry.get("measures") or [])
+            entries[entry["_id"]] = entry
+        self._entries = entries
+        return True
+
+    # Whether the rollups of `collection` answer a group by `attr` (of `measure`). Reads
+    # only what the last refresh loaded (at startup, after an upload or a rebuild): query
+    # generation never waits on or connects to MongoDB
+    def covers(self, collection, attr, measure=None):
+        entry = (self._entries or {}).get(collection)
+        if entry is None:
+            return False
+        state = entry["attrs"].get(attr)
+        if state is None or state["status"] != "ready":
+            return False
+        return measure is None or measure in entry["measures"]
+
+    def report(self):
+        entries = self._entries or {}
+        return {
+            name: {
+                "documents": entry.get("documents"),
+                "measures": sorted(entry["measures"]),
+                "attrs": list(entry["attrs"].values()),
+                "updated_at": entry.get("updated_at"),
+            }
+            for name, entry in entries.items()
+        }
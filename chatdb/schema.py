@@ -0,0 +1,251 @@
+import csv
+import json
+import os
+import re
+import threading
+from datetime import date, datetime
+from itertools import islice
+
+from ingest import collection_name_for, extended_json_hook, is_internal_collection, iter_json_array
+
+
+# Documents (or CSV rows) sampled per collection to infer its schema
+SCHEMA_SAMPLE_SIZE = int(os.environ.get("CHATDB_SCHEMA_SAMPLE_SIZE", "200"))
+
+# A field is quantitative when at least this share of its sampled values are numbers
+QUANTITATIVE_SHARE = 0.9
+
+# userId, CourseID, store_id, id: numeric identifiers are labels, not measures
+ID_FIELD_PATTERN = re.compile(r"(?:^|[_.])[iI][dD]$|[a-z]I[dD]$")
+
+
+# Inferred layout of one collection
+class CollectionSchema:
+    def __init__(self, name, fields, types, quantitative, qualitative, sampled, source):
+        self.name = name
+        self.fields = fields
+        self.types = types
+        self.quantitative = quantitative
+        self.qualitative = qualitative
+        self.sampled = sampled
+        self.source = source
+
+    def as_dict(self):
+        return {
+            "fields": self.fields,
+            "types": self.types,
+            "quantitative": self.quantitative,
+            "qualitative": self.qualitative,
+            "sampled": self.sampled,
+            "source": self.source,
+        }
+
+
+# Type label of one scalar value
+def value_type(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, (datetime, date)):
+        return "date"
+    return type(value).__name__
+
+
+# (dotted path, value) for every scalar leaf; arrays of sub-documents are traversed the
+# way MongoDB resolves "ratings.rating"
+def iter_leaves(value, path=""):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from iter_leaves(item, f"{path}.{key}" if path else key)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_leaves(item, path)
+    elif value is not None:
+        yield path, value
+
+
+# Classify sampled leaf types into quantitative and qualitative paths
+def classify_fields(type_counts):
+    types, quantitative, qualitative = {}, [], []
+    for path, counts in type_counts.items():
+        total = sum(counts.values())
+        types[path] = max(counts, key=counts.get)
+        if path == "_id":
+            continue
+        numeric = counts.get("int", 0) + counts.get("float", 0)
+        if numeric >= QUANTITATIVE_SHARE * total and not ID_FIELD_PATTERN.search(path):
+            quantitative.append(path)
+        else:
+            qualitative.append(path)
+    return types, quantitative, qualitative
+
+
+def infer_from_documents(name, documents, source):
+    fields, type_counts, sampled = {}, {}, 0
+    for document in documents:
+        sampled += 1
+        for key in document:
+            fields.setdefault(key, None)
+        for path, value in iter_leaves(document):
+            counts = type_counts.setdefault(path, {})
+            label = value_type(value)
+            counts[label] = counts.get(label, 0) + 1
+    types, quantitative, qualitative = classify_fields(type_counts)
+    return CollectionSchema(name, list(fields), types, quantitative, qualitative, sampled, source)
+
+
+# Cells read_csv treats as missing by default
+CSV_MISSING = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+               "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}
+CSV_BOOLEANS = {"True", "False", "true", "false", "TRUE", "FALSE"}
+CSV_INTEGER = re.compile(r"^[+-]?\d+$")
+
+
+def is_csv_float(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+# Type label read_csv would give a column of sampled cells: int without missing cells,
+# float for other numbers, bool for True/False without missing cells, string otherwise
+def csv_column_type(cells):
+    present = [cell for cell in cells if cell not in CSV_MISSING]
+    complete = len(present) == len(cells)
+    if all(CSV_INTEGER.match(cell) for cell in present):
+        return "int" if complete and present else "float"
+    if all(is_csv_float(cell) for cell in present):
+        return "float"
+    if complete and all(cell in CSV_BOOLEANS for cell in present):
+        return "bool"
+    return "string"
+
+
+# CSV files: header and column types of the first sample_size rows. Read with the csv
+# module rather than pandas so that schema inference (and so the chat path) does not
+# pay for importing pandas.
+def infer_from_csv(name, path, sample_size):
+    with open(path, newline="", encoding="utf-8") as handle:
+        reader = csv.reader(handle)
+        header = next(reader, [])
+        rows = [row for row in islice(reader, sample_size) if len(row) == len(header)]
+    type_counts = {column: {csv_column_type([row[i] for row in rows]): 1} for i, column in enumerate(header)}
+    types, quantitative, qualitative = classify_fields(type_counts)
+    return CollectionSchema(name, list(type_counts), types, quantitative, qualitative, len(rows), path)
+
+
+# Stands in for the ObjectIds of sampled documents: inference only needs their type label,
+# and decoding real ones would import bson when the app (and its chat path) starts
+class ObjectId:
+    __slots__ = ()
+
+
+def sample_json_hook(document):
+    if len(document) == 1 and "$oid" in document:
+        return ObjectId()
+    return extended_json_hook(document)
+
+
+SAMPLE_JSON_DECODER = json.JSONDecoder(object_hook=sample_json_hook)
+
+
+def infer_from_file(name, path, sample_size):
+    if path.lower().endswith(".csv"):
+        return infer_from_csv(name, path, sample_size)
+    with open(path, encoding="utf-8") as handle:
+        documents = islice(iter_json_array(handle, decoder=SAMPLE_JSON_DECODER), sample_size)
+        return infer_from_documents(name, [d for d in documents if isinstance(d, dict)], path)
+
+
+# Per-collection schema cache. A schema is inferred from a sample the first time it is
+# needed and kept until that collection is written (invalidate), so query generation
+# never scans a collection to learn its fields.
+class SchemaRegistry:
+    def __init__(self, get_database=None, sample_size=SCHEMA_SAMPLE_SIZE):
+        self.get_database = get_database
+        self.sample_size = sample_size
+        self._lock = threading.Lock()
+        self._sources = {}
+        self._schemas = {}
+        self.version = 0
+
+    # Register every CSV / JSON file in an upload folder as the sample source of the
+    # collection of the same name: the collections in `first` in that order, then the
+    # others by filename
+    def discover_files(self, folder, extensions, first=()):
+        if not os.path.isdir(folder):
+            return
+
+        def order(filename):
+            collection = collection_name_for(filename)
+            return (first.index(collection) if collection in first else len(first), filename)
+
+        for filename in sorted(os.listdir(folder), key=order):
+            if filename.rsplit(".", 1)[-1].lower() in extensions and not is_internal_collection(collection_name_for(filename)):
+                self.register_file(collection_name_for(filename), os.path.join(folder, filename))
+
+    def register_file(self, collection, path):
+        with self._lock:
+            if collection not in self._sources:
+                self.version += 1
+            self._sources[collection] = path
+            self._schemas.pop(collection, None)
+
+    # Collections that live only in MongoDB are sampled with $sample
+    def register_collection(self, collection):
+        with self._lock:
+            if collection not in self._sources:
+                self._sources[collection] = None
+                self.version += 1
+
+    # Infer every file-backed schema now (at startup) so the first chat request finds
+    # them ready; MongoDB-only collections are still sampled on first use
+    def warm(self):
+        for collection, source in list(self._sources.items()):
+            if source is not None:
+                self.get(collection)
+
+    def invalidate(self, collection):
+        with self._lock:
+            self._schemas.pop(collection, None)
+
+    def collections(self):
+        return list(self._sources)
+
+    # Uploaded file backing a collection, or None for MongoDB-only collections
+    def source(self, collection):
+        return self._sources.get(collection)
+
+    def __contains__(self, collection):
+        return collection in self._sources
+
+    def get(self, collection):
+        schema = self._schemas.get(collection)
+        if schema is not None or collection not in self._sources:
+            return schema
+        source = self._sources[collection]
+        if source is not None:
+            schema = infer_from_file(collection, source, self.sample_size)
+        else:
+            schema = self._infer_from_database(collection)
+        if schema is not None:
+            with self._lock:
+                if self._sources.get(collection) == source:
+                    self._schemas[collection] = schema
+        return schema
+
+    def _infer_from_database(self, collection):
+        if self.get_database is None:
+            return None
+        try:
+            documents = self.get_database()[collection].aggregate([{"$sample": {"size": self.sample_size}}])
+            return infer_from_documents(collection, list(documents), "mongodb")
+        except Exception:
+            return None
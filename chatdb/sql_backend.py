@@ -0,0 +1,356 @@
+# Embedded SQL backend for the "MySQL" database type: every uploaded CSV file is loaded
+# into a table of the same name in an SQLite database in WAL mode (readers keep their
+# snapshot while a reload writes), indexed on the fields the chat templates group, filter
+# and sort on. The template queries are translated to SQL that MySQL runs as well
+# (backtick identifiers, ? parameters), and user SQL runs on read-only connections.
+#
+# Tables are loaded on first use and reloaded when their file changes: one transaction
+# per file, rows inserted with executemany in chunks, indexes built after the rows and
+# ANALYZEd for the planner. Statements are parameterized, so each connection's statement
+# cache (cached_statements) reuses one prepared statement per template and table whatever
+# the threshold or limit.
+import json
+import math
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+
+from query_exec import MongoQuery, UnsupportedQuery
+
+
+SqlError = sqlite3.Error
+
+# Rows per executemany() while loading a CSV file
+SQL_LOAD_CHUNK_SIZE = int(os.environ.get("CHATDB_SQL_LOAD_CHUNK_SIZE", "50000"))
+
+# Prepared statements kept per connection
+SQL_STATEMENT_CACHE = int(os.environ.get("CHATDB_SQL_STATEMENT_CACHE", "256"))
+
+# Table recording what was loaded from where
+CATALOG = "chatdb_tables"
+
+# Virtual machine steps between checks of a query's time limit
+PROGRESS_STEPS = 10000
+
+COMPARISON_OPERATORS = {"$eq": "=", "$ne": "<>", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+
+AGGREGATE_FUNCTIONS = {"$sum": "COALESCE(SUM({}), 0)", "$avg": "AVG({})", "$min": "MIN({})", "$max": "MAX({})"}
+
+
+def quote(name):
+    return "`" + str(name).replace("`", "``") + "`"
+
+
+def sql_literal(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)) and math.isfinite(value):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+# One SQL statement: the text with ? placeholders that runs, its parameters, and the text
+# with the values written in that the chat UI shows. Equal statements compare and hash
+# equal.
+class SqlQuery:
+    __slots__ = ("table", "text", "params", "display")
+
+    def __init__(self, table, text, params, display):
+        self.table = table
+        self.text = text
+        self.params = params
+        self.display = display
+
+    def render(self):
+        return f"\n{self.display}\n"
+
+    __str__ = render
+
+    def __eq__(self, other):
+        return isinstance(other, SqlQuery) and (self.text, self.params) == (other.text, other.params)
+
+    def __hash__(self):
+        return hash((self.text, self.params))
+
+    def __repr__(self):
+        return f"SqlQuery({self.text!r}, {self.params!r})"
+
+
+# SQL for a generated MongoQuery. Template queries are cached, and so are their
+# translations.
+@lru_cache(maxsize=1024)
+def translate(query):
+    return to_sql(query.as_dict() if isinstance(query, MongoQuery) else query)
+
+
+# SQL for a parsed query of the shapes the chat templates produce: find() with comparison
+# filters, sort, skip and limit, or a pipeline of $match, a $group on one field, $sort and
+# $limit (in that order, each optional). UnsupportedQuery for anything else.
+def to_sql(query):
+    params = []
+
+    def bind(value):
+        params.append(value)
+        return "?"
+
+    text = sql_text(query, bind)
+    return SqlQuery(query["collection"], text, tuple(params), sql_text(query, sql_literal))
+
+
+def sql_text(query, value):
+    table = quote(query["collection"])
+    if query["operation"] == "find":
+        clauses = [f"SELECT {select_columns(query.get('projection'))}", f"FROM {table}"]
+        where = where_clause(query.get("filter") or {}, value)
+        if where:
+            clauses.append(f"WHERE {where}")
+        if query.get("sort"):
+            clauses.append(f"ORDER BY {order_by(query['sort'])}")
+        if query.get("limit"):
+            clauses.append(f"LIMIT {value(query['limit'])}")
+            if query.get("skip"):
+                clauses[-1] += f" OFFSET {value(query['skip'])}"
+        elif query.get("skip"):
+            raise UnsupportedQuery(".skip() without .limit() has no SQL translation")
+        return "\n".join(clauses)
+
+    stages = {}
+    order = ["$match", "$group", "$sort", "$limit"]
+    for stage in query["pipeline"]:
+        operator = next(iter(stage), None) if isinstance(stage, dict) and len(stage) == 1 else None
+        if operator not in order or (stages and order.index(operator) <= order.index(list(stages)[-1])):
+            raise UnsupportedQuery(f"Stage {operator} has no SQL translation here")
+        stages[operator] = stage[operator]
+
+    select, group_by = ["*"], None
+    if "$group" in stages:
+        select, group_by = group_columns(stages["$group"], value)
+    clauses = [f"SELECT {', '.join(select)}", f"FROM {table}"]
+    where = where_clause(stages.get("$match") or {}, value)
+    if where:
+        clauses.append(f"WHERE {where}")
+    if group_by:
+        clauses.append(f"GROUP BY {group_by}")
+    if stages.get("$sort"):
+        clauses.append(f"ORDER BY {order_by(stages['$sort'].items())}")
+    if "$limit" in stages:
+        clauses.append(f"LIMIT {value(int(stages['$limit']))}")
+    return "\n".join(clauses)
+
+
+def select_columns(projection):
+    if not projection:
+        return "*"
+    if any(not shown for name, shown in projection.items() if name != "_id"):
+        raise UnsupportedQuery("Exclusion projections have no SQL translation")
+    columns = [quote(name) for name, shown in projection.items() if name != "_id" and shown]
+    return ", ".join(columns) or "*"
+
+
+def where_clause(query_filter, value):
+    conditions = []
+    for field, condition in query_filter.items():
+        if field.startswith("$"):
+            raise UnsupportedQuery(f"Filter operator {field} has no SQL translation")
+        column = quote(field)
+        if isinstance(condition, dict) and condition and all(key.startswith("$") for key in condition):
+            for operator, operand in condition.items():
+                if operator not in COMPARISON_OPERATORS or isinstance(operand, (dict, list)):
+                    raise UnsupportedQuery(f"Filter operator {operator} has no SQL translation")
+                if operand is None:
+                    conditions.append(f"{column} IS {'NOT ' if operator == '$ne' else ''}NULL")
+                elif operator == "$ne":
+                    # $ne matches missing values too
+                    conditions.append(f"({column} <> {value(operand)} OR {column} IS NULL)")
+                else:
+                    conditions.append(f"{column} {COMPARISON_OPERATORS[operator]} {value(operand)}")
+        elif isinstance(condition, (dict, list)):
+            raise UnsupportedQuery(f"Filter on {field} has no SQL translation")
+        elif condition is None:
+            conditions.append(f"{column} IS NULL")
+        else:
+            conditions.append(f"{column} = {value(condition)}")
+    return " AND ".join(conditions)
+
+
+def order_by(sort):
+    keys = []
+    for field, direction in sort:
+        if direction not in (1, -1):
+            raise UnsupportedQuery(f"Sort direction {direction!r} has no SQL translation")
+        keys.append(f"{quote(field)} {'ASC' if direction == 1 else 'DESC'}")
+    return ", ".join(keys)
+
+
+# SELECT list and GROUP BY of a $group with _id "$field" (or null) and $sum / $avg / $min
+# / $max / $count accumulators; output names are the $group's
+def group_columns(spec, value):
+    key = spec.get("_id")
+    if isinstance(key, str) and key.startswith("$"):
+        group_by = quote(key[1:])
+        select = [f"{group_by} AS `_id`"]
+    elif key is None:
+        group_by, select = None, ["NULL AS `_id`"]
+    else:
+        raise UnsupportedQuery("Only $group keys on one field have an SQL translation")
+    for name, accumulator in spec.items():
+        if name == "_id":
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            raise UnsupportedQuery(f"Accumulator {name} has no SQL translation")
+        (operator, argument), = accumulator.items()
+        if operator == "$count" or (operator == "$sum" and argument == 1 and not isinstance(argument, bool)):
+            expression = "COUNT(*)"
+        elif operator == "$sum" and isinstance(argument, (int, float)) and not isinstance(argument, bool):
+            expression = f"COUNT(*) * {value(argument)}"
+        elif operator in AGGREGATE_FUNCTIONS and isinstance(argument, str) and argument.startswith("$"):
+            expression = AGGREGATE_FUNCTIONS[operator].format(quote(argument[1:]))
+        else:
+            raise UnsupportedQuery(f"Accumulator {operator} has no SQL translation")
+        select.append(f"{expression} AS {quote(name)}")
+    return select, group_by
+
+
+# Cursor-like wrapper that streams rows as documents ({column: value}) a batch at a time
+class SqlCursor:
+    def __init__(self, cursor, batch_size):
+        self.cursor = cursor
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        if self.cursor.description is None:
+            return
+        names = [column[0] for column in self.cursor.description]
+        while True:
+            rows = self.cursor.fetchmany(self.batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield dict(zip(names, row))
+
+    def close(self):
+        self.cursor.close()
+
+
+# Deny statements that would reach past this database from user SQL
+def read_authorizer(action, *args):
+    if action in (sqlite3.SQLITE_ATTACH, sqlite3.SQLITE_DETACH):
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
+
+
+class SqlStore:
+    def __init__(self, path, chunk_size=SQL_LOAD_CHUNK_SIZE, statement_cache=SQL_STATEMENT_CACHE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.statement_cache = statement_cache
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._writer = sqlite3.connect(path, isolation_level=None, check_same_thread=False,
+                                       cached_statements=statement_cache)
+        self._writer.execute("PRAGMA journal_mode=WAL")
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+        self._writer.execute(
+            f"CREATE TABLE IF NOT EXISTS {CATALOG} (name TEXT PRIMARY KEY, path TEXT, mtime REAL, rows INTEGER, "
+            "columns TEXT, indexes TEXT, loaded_at REAL, load_seconds REAL)"
+        )
+        self._loaded = {name: (path, mtime) for name, path, mtime in self._writer.execute(
+            f"SELECT name, path, mtime FROM {CATALOG}"
+        )}
+
+    # This thread's read-only connection; a time limit set by cursor() interrupts the
+    # statement from the progress handler
+    def reader(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            uri = pathlib.Path(os.path.abspath(self.path)).as_uri() + "?mode=ro"
+            connection = sqlite3.connect(uri, uri=True, cached_statements=self.statement_cache)
+            connection.set_authorizer(read_authorizer)
+            local = self._local
+            local.deadline = math.inf
+            connection.set_progress_handler(lambda: time.perf_counter() > local.deadline, PROGRESS_STEPS)
+            local.connection = connection
+        return connection
+
+    def cursor(self, text, params=(), batch_size=500, max_time_ms=None):
+        connection = self.reader()
+        self._local.deadline = time.perf_counter() + max_time_ms / 1000 if max_time_ms else math.inf
+        return SqlCursor(connection.execute(text, params), batch_size)
+
+    # Load every {table: CSV path} whose file changed since it was loaded
+    def sync(self, sources, index_columns):
+        for table, path in sources.items():
+            try:
+                stamp = (path, os.path.getmtime(path))
+            except OSError:
+                continue
+            if self._loaded.get(table) == stamp:
+                continue
+            with self._write_lock:
+                if self._loaded.get(table) != stamp:
+                    self.load_csv(table, path, index_columns(table), stamp[1])
+
+    # Replace `table` with the rows of a CSV file, in one transaction, then index the
+    # given columns; readers see the old table until it commits
+    def load_csv(self, table, path, index_columns=(), mtime=None):
+        import pandas as pd
+
+        started = time.perf_counter()
+        writer = self._writer
+        columns, indexes, rows = [], [], 0
+        writer.execute("BEGIN IMMEDIATE")
+        try:
+            writer.execute(f"DROP TABLE IF EXISTS {quote(table)}")
+            insert = None
+            for chunk in pd.read_csv(path, chunksize=self.chunk_size):
+                if insert is None:
+                    columns = [str(name) for name in chunk.columns]
+                    types = [column_type(chunk[name].dtype) for name in chunk.columns]
+                    definition = ", ".join(f"{quote(name)} {kind}" for name, kind in zip(columns, types))
+                    writer.execute(f"CREATE TABLE {quote(table)} ({definition})")
+                    insert = f"INSERT INTO {quote(table)} VALUES ({', '.join(['?'] * len(columns))})"
+                values = chunk.astype(object).where(chunk.notna(), None)
+                writer.executemany(insert, values.itertuples(index=False, name=None))
+                rows += len(chunk)
+            for column in index_columns:
+                if column in columns:
+                    name = f"{table}__{column}"
+                    writer.execute(f"CREATE INDEX {quote(name)} ON {quote(table)} ({quote(column)})")
+                    indexes.append(column)
+            if insert is not None:
+                writer.execute(f"ANALYZE {quote(table)}")
+            writer.execute(
+                f"INSERT OR REPLACE INTO {CATALOG} VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (table, path, mtime if mtime is not None else os.path.getmtime(path), rows, json.dumps(columns),
+                 json.dumps(indexes), time.time(), time.perf_counter() - started),
+            )
+            writer.execute("COMMIT")
+        except BaseException:
+            writer.execute("ROLLBACK")
+            raise
+        self._loaded[table] = (path, mtime if mtime is not None else os.path.getmtime(path))
+        return {"table": table, "rows": rows, "indexes": indexes, "seconds": round(time.perf_counter() - started, 3)}
+
+    # Loaded tables for /api/explore
+    def tables(self):
+        cursor = self.reader().execute(
+            f"SELECT name, path, rows, columns, indexes, loaded_at, load_seconds FROM {CATALOG} ORDER BY name"
+        )
+        return [
+            {"name": name, "source": path, "rows": rows, "columns": json.loads(columns), "indexes": json.loads(indexes),
+             "loaded_at": loaded_at, "load_seconds": round(seconds, 3)}
+            for name, path, rows, columns, indexes, loaded_at, seconds in cursor
+        ]
+
+
+def column_type(dtype):
+    if dtype.kind in "iub":
+        return "INTEGER"
+    if dtype.kind == "f":
+        return "REAL"
+    return "TEXT"
@@ -0,0 +1,1084 @@
+import asyncio
+import base64
+import io
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from datetime import date, datetime, timedelta
+from itertools import islice
+from unittest import mock
+
+import numpy as np
+
+from app import (
+    CONSTRUCT_KEYWORDS, QUERY_PATTERNS, RESULT_CACHE, SCHEMAS, Intent, IntentMatcher, app, generate_query_for_intent,
+    generate_sample_queries, template_query, top_n_query,
+)
+from columnar_cache import convert_csv, open_store, verify_store
+from index_advisor import IndexAdvisor
+from ingest import iter_json_array
+from local_engine import Frame, LocalEngine, resolve_path
+from metrics import Counter, Histogram
+from preview import FrameSampler, Sample, estimate_groups, preview_plan, preview_rounds
+from query_exec import (
+    ListCursor, MongoQuery, QueryParseError, UnsupportedQuery, cached_parse, decode_page_token, encode_page_token,
+    keyset_page_query, parse_shell_query, seek_filter, sort_values, stream_ndjson,
+)
+import result_cache
+from result_cache import RecordingCursor, ResultCache
+from rollups import ROLLUP_CATALOG, RollupCatalog
+from schema import ID_FIELD_PATTERN
+from sketches import HyperLogLog, KLLSketch, hash_keys, hash_numbers, value_key
+from sql_backend import SqlError, SqlStore, to_sql, translate
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+COLLECTIONS = ["products", "orders", "order", "reviews", "users", "sales"]
+
+WORDS = [
+    "find", "show", "list", "top", "5", "total", "average", "count", "of", "greater", "than",
+    "100", "sorted", "by", "in", "all", "group", "having", "aggregation", "explore", "sample",
+    "records", "from", "the", "last", "7", "days", "per", "day", "distinct", "how", "many",
+    "median", "90th", "percentile", "minimum", "and", "maximum", "price", "brand", "Orders",
+    "ordersorted", "salesman", "x", "  ", "\t",
+] + COLLECTIONS
+
+MESSAGES = [
+    "", "explore", "sample", "sample orders", "explore sample orders",
+    "find total price by brand in products", "Find Total Price By Brand In PRODUCTS",
+    "top 5 products by price in products", "top 3 x by y in users top 2 a by b in orders",
+    "list all x sorted  by y in orders", "find price greater  than 50 in products",
+    "find price greater\tthan 50 in users", "ordersorted by", "show count  of x in reviews",
+    "total price by brand in salesman", "how many distinct brand in products",
+    "list records from the last 7 days in sales", "show price per week in orders",
+    "90th percentile of price in products", "median of price in reviews",
+]
+
+
+# The intent the original chain of `keyword in message` checks in determine_response
+# picked: explore, then sample, then the first construct keyword with the first
+# collection, then the first query pattern naming a known collection
+def reference_intent(message, collections, constructs, patterns):
+    message = message.lower()
+    if "explore" in message:
+        return Intent("explore", None, None, ())
+    if "sample" in message:
+        for collection in collections:
+            if collection in message:
+                return Intent("sample", None, collection, ())
+        return Intent("sample", None, None, ())
+    for construct in constructs:
+        if construct in message:
+            for collection in collections:
+                if collection in message:
+                    return Intent("construct", constructs[construct], collection, ())
+    return reference_pattern(message, collections, patterns)
+
+
+def reference_pattern(message, collections, patterns):
+    message = message.lower()
+    for pattern, template in patterns:
+        match = pattern.search(message)
+        if match and match.groups()[-1] in collections:
+            return Intent("query", template, match.groups()[-1], match.groups())
+    return Intent("miss", None, None, ())
+
+
+# Regression corpus: the hand-written messages plus seeded random word salads that mix
+# keywords, collection names and overlapping words
+def message_corpus(size=20000, seed=1):
+    rng = random.Random(seed)
+    corpus = list(MESSAGES)
+    for _ in range(size):
+        corpus.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12))))
+    return corpus
+
+
+class IntentMatcherParityTest(unittest.TestCase):
+    def setUp(self):
+        self.matcher = IntentMatcher(COLLECTIONS, CONSTRUCT_KEYWORDS, QUERY_PATTERNS)
+
+    def test_match_agrees_with_keyword_checks(self):
+        for message in message_corpus():
+            expected = reference_intent(message, COLLECTIONS, CONSTRUCT_KEYWORDS, QUERY_PATTERNS)
+            self.assertEqual(self.matcher.match(message), expected, repr(message))
+
+    # The matcher the app builds, over the schema's collections in their registered order
+    def test_app_collection_order(self):
+        collections = SCHEMAS.collections()
+        self.assertEqual(collections[:3], ["products", "orders", "reviews"])
+        matcher = IntentMatcher(collections, CONSTRUCT_KEYWORDS, QUERY_PATTERNS)
+        for message in message_corpus(size=5000, seed=3):
+            expected = reference_intent(message, collections, CONSTRUCT_KEYWORDS, QUERY_PATTERNS)
+            self.assertEqual(matcher.match(message), expected, repr(message))
+
+    def test_match_pattern_agrees_with_pattern_loop(self):
+        for message in message_corpus(size=5000, seed=2):
+            expected = reference_pattern(message, COLLECTIONS, QUERY_PATTERNS)
+            self.assertEqual(self.matcher.match_pattern(message), expected, repr(message))
+
+    def test_required_literals(self):
+        literals = [self.matcher._pattern_literals[i] for i in range(len(QUERY_PATTERNS))]
+        for (pattern, template), literal in zip(QUERY_PATTERNS, literals):
+            self.assertIsNotNone(literal, template)
+            self.assertIn(literal, pattern.pattern)
+
+
+class IdentifierFieldTest(unittest.TestCase):
+    def test_identifier_names(self):
+        for name in ["id", "ID", "Id", "userId", "CourseID", "store_id", "store_ID", "items.id"]:
+            self.assertTrue(ID_FIELD_PATTERN.search(name), name)
+
+    def test_words_ending_in_id_are_not_identifiers(self):
+        for name in ["paid", "amount_paid", "max_bid", "valid", "grid", "android"]:
+            self.assertFalse(ID_FIELD_PATTERN.search(name), name)
+
+
+# Queries of the chat templates. Messages are matched lowercased; the queries must name
+# fields as they are stored.
+class TemplateQueryTest(unittest.TestCase):
+    def query(self, message):
+        return generate_query_for_intent(IntentMatcher(SCHEMAS.collections(), {}, QUERY_PATTERNS).match_pattern(message))
+
+    def test_top_n_resolves_fields(self):
+        query = self.query("top 2 instructorname by credithours in courses").as_dict()
+        self.assertEqual(query["pipeline"][0]["$group"], {"_id": "$InstructorName", "total_CreditHours": {"$sum": "$CreditHours"}})
+        query = self.query("top 2 courses by credithours in courses").as_dict()
+        self.assertEqual(query["pipeline"][0], {"$sort": {"CreditHours": -1}})
+
+    def test_top_n_rejects_unknown_measure(self):
+        self.assertEqual(self.query("top 2 instructorname by nosuch in courses"), "Error: courses has no numeric field nosuch.")
+
+    def test_per_period_resolves_measure(self):
+        query = generate_query_for_intent(Intent("query", "<A> per <period>", "orders", ("show", "totalamount", "day", "orders")))
+        self.assertEqual(query.as_dict()["pipeline"][1]["$group"]["total_totalAmount"], {"$sum": "$sum.totalAmount"})
+
+    def test_last_n_days_is_a_calendar_window(self):
+        query = self.query("list records from the last 30 days in orders").as_dict()
+        cutoff = (date.today() - timedelta(days=30)).isoformat()
+        self.assertEqual(query["pipeline"][0]["$match"]["day"], {"$gte": cutoff})
+        self.assertNotIn("$limit", json.dumps(query["pipeline"]))
+
+    def test_percentile_query_is_generated_without_the_database(self):
+        with mock.patch("app.get_mongo_connection", side_effect=AssertionError("chat reply touched MongoDB")):
+            query = generate_query_for_intent(Intent("query", "<P>th percentile of <A>", "sales", ("7th", "unit_price")))
+        pipeline = query.as_dict()["pipeline"]
+        self.assertEqual([next(iter(stage)) for stage in pipeline], ["$match", "$setWindowFields", "$match", "$project"])
+        self.assertEqual(pipeline[1]["$setWindowFields"]["sortBy"], {"unit_price": 1})
+        self.assertEqual(pipeline[3]["$project"], {"_id": 0, "7th_percentile_unit_price": "$unit_price"})
+
+    # The $match on the rank selects the nearest-rank percentile, ceil(n * p / 100)
+    def test_percentile_rank_is_nearest_rank(self):
+        for p in range(1, 100):
+            query = generate_query_for_intent(Intent("query", "<P>th percentile of <A>", "sales", (f"{p}th", "unit_price")))
+            rank = query.as_dict()["pipeline"][2]["$match"]["$expr"]["$eq"][1]
+            for n in range(1, 201):
+                self.assertEqual(evaluate(rank, {"n": n}), max(1, -(-n * p // 100)), (p, n))
+
+
+# Value of an aggregation expression over one document, for the operators the generated
+# queries use
+def evaluate(expression, document):
+    if isinstance(expression, str) and expression.startswith("$"):
+        return document[expression[1:]]
+    if not isinstance(expression, dict):
+        return expression
+    (operator, args), = expression.items()
+    args = [evaluate(arg, document) for arg in (args if isinstance(args, list) else [args])]
+    operators = {"$max": max, "$ceil": math.ceil, "$divide": lambda a, b: a / b, "$multiply": lambda a, b: a * b}
+    return operators[operator](*args)
+
+
+LOCAL_TEMPLATES = ["total <A> by <B>", "average <A> by <B>", "count of <B>", "find <A> greater than a threshold",
+                   "list all <B> sorted by <A>"]
+
+# Rows of each uploaded CSV file the parity test loads (mongomock is slow on the full files)
+PARITY_CSV_ROWS = 1000
+
+
+# Every query the chat templates generate for a collection, with the (path, direction)
+# sort of its result (None when MongoDB returns it in no defined order) and its limit
+def template_queries(collection):
+    schema = SCHEMAS.get(collection)
+    for quantitative_attr in schema.quantitative:
+        for qualitative_attr in schema.qualitative:
+            for template in LOCAL_TEMPLATES:
+                sort = (quantitative_attr, 1) if template == "list all <B> sorted by <A>" else None
+                yield template_query(template, collection, quantitative_attr, qualitative_attr), sort, None
+            total = "total_" + quantitative_attr.replace(".", "_")
+            yield top_n_query(collection, 10, qualitative_attr, quantitative_attr), (total, -1), 10
+        yield top_n_query(collection, 10, None, quantitative_attr), (quantitative_attr, -1), 10
+
+
+# The value MongoDB sorts a document by, as (type rank, value): missing and null before
+# numbers before strings, and an array by its smallest element ascending and its largest
+# descending
+def sort_value(document, path, direction):
+    value = resolve_path(document, path)
+    if isinstance(value, list) and value:
+        value = min(value) if direction > 0 else max(value)
+    if value is None or value == []:
+        return (0, 0)
+    return (2, value) if isinstance(value, str) else (1, value)
+
+
+def canonical(document, drop_id):
+    return json.dumps({k: v for k, v in document.items() if not (drop_id and k == "_id")}, default=str, sort_keys=True)
+
+
+# LocalEngine.execute returns what MongoDB returns for the template queries, as far as
+# MongoDB defines it: the same documents, in the same order of sort keys. Rows with equal
+# sort keys come out in collection order locally, while MongoDB leaves their order (and
+# which of them a $limit keeps) unspecified, so they are compared as a multiset, and the
+# rows tied at a limit's cut only by count.
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class LocalEngineParityTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        from bench import mongomock_bulk_write
+        from ingest import ingest_file
+
+        cls._bulk_write = mongomock.collection.Collection.bulk_write
+        mongomock.collection.Collection.bulk_write = mongomock_bulk_write
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.db = mongomock.MongoClient().db
+        sources = {}
+        for collection in SCHEMAS.collections():
+            source = SCHEMAS.source(collection)
+            path = sources[collection] = os.path.join(cls.directory.name, os.path.basename(source))
+            with open(source, encoding="utf-8") as original, open(path, "w", encoding="utf-8") as copy:
+                lines = original if not source.lower().endswith(".csv") else islice(original, PARITY_CSV_ROWS + 1)
+                copy.writelines(lines)
+            ingest_file(path, cls.db)
+        cls.engine = LocalEngine(sources.get)
+
+    @classmethod
+    def tearDownClass(cls):
+        mongomock.collection.Collection.bulk_write = cls._bulk_write
+        cls.directory.cleanup()
+
+    # mongomock orders arrays element by element instead of by their smallest (largest)
+    # element, so a sorted result is read unsorted and ordered here by MongoDB's rule
+    def mongo_rows(self, query, sort, limit):
+        collection = self.db[query["collection"]]
+        if query["operation"] == "aggregate":
+            pipeline = [stage for stage in query["pipeline"] if sort is None or not {"$sort", "$limit"} & set(stage)]
+            rows = list(collection.aggregate(pipeline))
+        else:
+            rows = list(collection.find(query["filter"], query["projection"]))
+        if sort is not None:
+            rows.sort(key=lambda document: sort_value(document, *sort), reverse=sort[1] < 0)
+        return rows[:limit] if limit else rows
+
+    def assertSameRows(self, local, mongo, sort, limit, drop_id, message):
+        if sort is None:
+            self.assertEqual(sorted(canonical(d, drop_id) for d in local), sorted(canonical(d, drop_id) for d in mongo), message)
+            return
+        keys = [[sort_value(d, *sort) for d in rows] for rows in (local, mongo)]
+        self.assertEqual(keys[0], keys[1], message)
+        cut = keys[0][-1] if limit and keys[0] else None
+        runs = [
+            sorted(canonical(d, drop_id) for d, key in zip(rows, row_keys) if key != cut)
+            for rows, row_keys in zip((local, mongo), keys)
+        ]
+        self.assertEqual(runs[0], runs[1], message)
+
+    def test_template_queries_match_mongodb(self):
+        compared = 0
+        for collection in SCHEMAS.collections():
+            drop_id = SCHEMAS.source(collection).lower().endswith(".csv")
+            for query, sort, limit in template_queries(collection):
+                query = query.as_dict()
+                local = self.engine.execute(query)
+                mongo = self.mongo_rows(query, sort, limit)
+                self.assertSameRows(local, mongo, sort, limit, drop_id, f"{collection}: {json.dumps(query)}")
+                compared += 1
+        self.assertGreater(compared, 0)
+
+
+
+# Conversion reads the CSV in chunks; columns whose type changes between chunks (a gap
+# turning ints into floats, text after numbers) get the kind they have over the file
+class ColumnarCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "mixed.csv")
+        with open(self.path, "w", encoding="utf-8") as handle:
+            handle.write("n,gap,code,label\n")
+            for i in range(100):
+                gap = "" if i == 70 else str(i)
+                code = str(i) if i < 80 else f"x{i}"
+                label = "" if 30 <= i < 40 else f"l{i % 3}"
+                handle.write(f"{i},{gap},{code},{label}\n")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_chunked_conversion_matches_one_chunk(self):
+        whole = convert_csv(self.path, chunk_rows=1000)
+        chunked = convert_csv(self.path, chunk_rows=7)
+        self.assertEqual(whole[0], chunked[0])
+        self.assertEqual([column["kind"] for column in chunked[0]], ["int", "float", "category", "category"])
+        for name in ("n", "gap"):
+            np.testing.assert_array_equal(whole[1][name], chunked[1][name])
+        for name in ("code", "label"):
+            values = [chunked[2][name][code] for code in chunked[1][name]]
+            self.assertEqual(values, [whole[2][name][code] for code in whole[1][name]])
+        self.assertEqual(len(chunked[2]["label"]), 4)
+
+    def test_store_reads_the_written_columns(self):
+        store = open_store(self.path)
+        self.assertEqual(store.length, 100)
+        self.assertEqual(store.array("n").tolist(), list(range(100)))
+        self.assertEqual(store.categories("code")[store.array("code")[85]], "x85")
+        self.assertEqual(verify_store(self.path, deep=True), [])
+
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class IndexAdvisorTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mongomock.MongoClient().db
+        self.db.products.insert_one({"price": 1})
+        self.known = {"products", "orders"}
+
+    def advisor(self, **options):
+        return IndexAdvisor(lambda: self.db, threshold=1, mode="off", accepts=self.known.__contains__, **options)
+
+    def test_ignores_unknown_collections(self):
+        advisor = self.advisor()
+        advisor.record({"collection": "typo", "operation": "find", "filter": {"x": 1}})
+        self.assertEqual(advisor.report()["usage"], {})
+        self.assertEqual(advisor.report()["proposals"], [])
+
+    def test_never_creates_a_missing_collection(self):
+        advisor = self.advisor()
+        advisor.record({"collection": "orders", "operation": "find", "filter": {"x": 1}})
+        proposal, = advisor.build_pending()
+        self.assertEqual(proposal["status"], "skipped")
+        self.assertNotIn("orders", self.db.list_collection_names())
+
+    def test_caps_proposals_and_fields(self):
+        advisor = self.advisor(max_proposals=3, max_fields=4)
+        for i in range(10):
+            advisor.record({"collection": "products", "operation": "find", "filter": {f"f{i}": 1}})
+        advisor.record({"collection": "products", "operation": "find", "filter": {"f0": 2}})
+        report = advisor.report()
+        # f0 was forgotten and comes back as the most recent shape, pushing out f7
+        self.assertEqual(sorted(p["name"] for p in report["proposals"]), ["advisor_f0_1", "advisor_f8_1", "advisor_f9_1"])
+        self.assertEqual(report["usage"]["products"]["filtered"], {"f0": 2, "f1": 1, "f2": 1, "f3": 1})
+
+
+
+class RollupCatalogTest(unittest.TestCase):
+    def test_covers_reads_only_the_loaded_catalog(self):
+        get_database = mock.Mock(side_effect=AssertionError("covers() must not connect"))
+        catalog = RollupCatalog(get_database)
+        self.assertFalse(catalog.covers("sales", "region", "amount"))
+        self.assertIsNone(catalog._thread)
+        get_database.assert_not_called()
+
+    @unittest.skipIf(mongomock is None, "mongomock is not installed")
+    def test_refresh_loads_ready_attributes(self):
+        db = mongomock.MongoClient().db
+        db[ROLLUP_CATALOG].insert_one({
+            "_id": "sales", "measures": ["amount"],
+            "attrs": [{"attr": "region", "status": "ready"}, {"attr": "store", "status": "building"}],
+        })
+        catalog = RollupCatalog(lambda: db)
+        self.assertTrue(catalog.refresh())
+        self.assertTrue(catalog.covers("sales", "region", "amount"))
+        self.assertTrue(catalog.covers("sales", "region"))
+        self.assertFalse(catalog.covers("sales", "region", "price"))
+        self.assertFalse(catalog.covers("sales", "store"))
+
+
+
+class ColdStartTest(unittest.TestCase):
+    # A fresh worker answers its first chat message without loading the MongoDB driver
+    def test_chat_does_not_import_the_driver(self):
+        script = (
+            "import sys, app\n"
+            "app.answer_chat({'message': 'find total price by brand in products'})\n"
+            "print(sorted(m for m in sys.modules if m.split('.')[0] in ('bson', 'pymongo')))\n"
+        )
+        proc = subprocess.run(
+            [sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        )
+        self.assertEqual(proc.stdout.strip(), "[]")
+
+
+
+class PageTokenTest(unittest.TestCase):
+    query = {"collection": "sales", "operation": "find", "filter": {}, "projection": None, "sort": [("v", 1)], "limit": None}
+
+    def token(self, state):
+        return base64.urlsafe_b64encode(json.dumps(state).encode()).decode()
+
+    def test_round_trip(self):
+        state = {"query": "abc", "after": [2.5, datetime(2024, 1, 2), "x"], "remaining": None}
+        self.assertEqual(decode_page_token(encode_page_token(state)), state)
+        state = {"query": "abc", "offset": 40, "remaining": 7}
+        self.assertEqual(decode_page_token(encode_page_token(state)), state)
+
+    def test_tampered_tokens_are_rejected(self):
+        tampered = [
+            "not base64!", self.token([1, 2]), self.token("abc"),
+            self.token({"query": "abc", "remaining": None}),
+            self.token({"query": "abc", "after": [1], "offset": 0, "remaining": None}),
+            self.token({"query": "abc", "after": 1, "remaining": None}),
+            self.token({"query": "abc", "offset": -1, "remaining": None}),
+            self.token({"query": "abc", "offset": 0}),
+            self.token({"query": "abc", "offset": 0, "remaining": 0}),
+            self.token({"after": [1], "remaining": None}),
+        ]
+        for token in tampered:
+            with self.assertRaises(QueryParseError, msg=token):
+                decode_page_token(token)
+        with self.assertRaises(QueryParseError):
+            keyset_page_query(self.query, 10, {"query": "abc", "after": [1], "remaining": None})
+
+    def test_tampered_token_is_a_client_error(self):
+        response = app.test_client().post("/api/execute_query", json={
+            "query": "db.sales.find()", "page_size": 10, "page_token": self.token({"query": "abc", "remaining": None}),
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json(), {"message": "Invalid page token"})
+
+    @unittest.skipIf(mongomock is None, "mongomock is not installed")
+    def test_seek_pages_through_mixed_types(self):
+        collection = mongomock.MongoClient().db.mixed
+        values = [None, 3, 1.5, "a", "b", True, False, datetime(2020, 1, 1), {"x": 1}, "c", 7]
+        collection.insert_many([{"_id": i, "v": value} for i, value in enumerate(values)] + [{"_id": 99}])
+        for direction in (1, -1):
+            sort = [("v", direction), ("_id", 1)]
+            pages, last = [], None
+            while True:
+                seek = seek_filter(sort, sort_values(last, sort)) if last else {}
+                page = list(collection.find(seek).sort(sort).limit(2))
+                if not page:
+                    break
+                pages.extend(row["_id"] for row in page)
+                last = page[-1]
+            self.assertEqual(pages, [row["_id"] for row in collection.find().sort(sort)])
+
+
+
+class SampleQueryTest(unittest.TestCase):
+    def test_every_collection_has_samples(self):
+        for collection in SCHEMAS.collections():
+            samples = generate_sample_queries(collection)
+            self.assertEqual(len(samples), 3, collection)
+            for sample in samples:
+                self.assertEqual(parse_shell_query(sample)["collection"], collection)
+
+    def test_samples_follow_the_schema(self):
+        schema = SCHEMAS.get("sales")
+        group, find, distinct = generate_sample_queries("sales")
+        self.assertIn(f'"$sum": "${schema.quantitative[0]}"', group)
+        self.assertEqual(parse_shell_query(find)["sort"], [(schema.quantitative[0], -1)])
+        label = parse_shell_query(distinct)["pipeline"][1]["$group"]["_id"][1:]
+        self.assertEqual(schema.types[label], "string")
+        self.assertIsNone(ID_FIELD_PATTERN.search(label))
+        self.assertEqual(generate_sample_queries("nope"), ["Invalid collection specified."])
+
+
+
+# Drive the ASGI application in-process: (status, headers, body chunks) of one request
+def asgi_request(method, path, payload=None):
+    import asgi_app
+
+    body = json.dumps(payload).encode() if payload is not None else b""
+    messages = [{"type": "http.request", "body": body[:10], "more_body": True}, {"type": "http.request", "body": body[10:]}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "headers": [(b"content-type", b"application/json")]}
+    asyncio.run(asgi_app.application(scope, receive, send))
+    return sent[0]["status"], dict(sent[0]["headers"]), [message["body"] for message in sent[1:] if message["body"]]
+
+
+class AsgiRoutesTest(unittest.TestCase):
+    def test_flask_endpoints_are_served(self):
+        status, _, chunks = asgi_request("POST", "/api/chat/batch", {"messages": ["sample sales", "explore", "sample sales"]})
+        self.assertEqual(status, 200)
+        self.assertEqual(json.loads(b"".join(chunks))["unique_messages"], 2)
+        status, _, chunks = asgi_request("POST", "/api/time_window", {"collection": "nope"})
+        self.assertEqual(status, 400)
+        self.assertEqual(asgi_request("GET", "/nope")[0], 404)
+        self.assertEqual(asgi_request("GET", "/api/chat/batch")[0], 405)
+
+    def test_progressive_preview_is_streamed(self):
+        query = 'db.sales.aggregate([{"$group": {"_id": "$store_location", "qty": {"$sum": "$transaction_qty"}}}])'
+        with mock.patch.dict(app.config, EXECUTE_BACKEND="local"):
+            status, headers, chunks = asgi_request("POST", "/api/preview_query", {"query": query, "progressive": True})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers[b"content-type"], b"application/x-ndjson")
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(json.loads(chunks[-1])["exact"])
+
+
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.events = Counter("test_result_cache_events_total", "", ["event"])
+        self.now = 1000.0
+        patcher = mock.patch.object(result_cache, "time", mock.Mock(monotonic=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def cache(self, **options):
+        return ResultCache(events=self.events, **options)
+
+    def put(self, cache, key, collections=("sales",), rows=([{"n": 1}]), truncated=False):
+        cache.put(key, collections, cache.versions(collections), list(rows), truncated)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = self.cache(max_entries=2)
+        self.put(cache, "a")
+        self.put(cache, "b")
+        self.assertIsNotNone(cache.get("a"))
+        self.put(cache, "c")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), ([{"n": 1}], False))
+        self.assertIsNotNone(cache.get("c"))
+        self.assertEqual(self.events.value("eviction"), 1)
+
+    def test_entries_expire(self):
+        cache = self.cache(ttl=10)
+        self.put(cache, "a")
+        self.now += 9.5
+        self.assertIsNotNone(cache.get("a"))
+        self.now += 1
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(self.events.value("expiration"), 1)
+        self.assertEqual(cache.stats()["entries"], 0)
+
+    def test_writes_invalidate_their_collections(self):
+        cache = self.cache()
+        self.put(cache, "joined", collections=("orders", "products"))
+        self.put(cache, "sales")
+        before = cache.versions(("orders",))
+        cache.bump("orders")
+        self.assertIsNone(cache.get("joined"))
+        self.assertIsNotNone(cache.get("sales"))
+        self.assertEqual(self.events.value("invalidation"), 1)
+        # A result read before the write landed is not cached
+        cache.put("late", ("orders",), before, [{"n": 2}], False)
+        self.assertIsNone(cache.get("late"))
+
+    def test_recording_cursor(self):
+        rows = [{"n": i} for i in range(5)]
+
+        def record(cache, key, row_cap, consume):
+            cursor = RecordingCursor(ListCursor(rows), cache, key, ("sales",), cache.versions(("sales",)), row_cap)
+            seen = list(islice(cursor, consume))
+            cursor.close()
+            return seen
+
+        cache = self.cache(max_rows=3)
+        # Past max_rows the rows only pass through, and nothing is cached
+        self.assertEqual(record(cache, "big", 10, 10), rows)
+        self.assertIsNone(cache.get("big"))
+        # One row past the row cap completes a truncated result
+        record(cache, "capped", 2, 3)
+        self.assertEqual(cache.get("capped"), (rows[:2], True))
+        # A client that stops early leaves the cache alone
+        record(cache, "partial", 4, 2)
+        self.assertIsNone(cache.get("partial"))
+        cache = self.cache(max_rows=10)
+        record(cache, "whole", 10, 10)
+        self.assertEqual(cache.get("whole"), (rows, False))
+
+
+
+class SqlBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.csv = os.path.join(self.directory.name, "items.csv")
+        self.write_csv(["a,1,5.0", "b,2,", "a,3,1.5", ",4,2.0", "c,5,7.5"])
+        self.store = SqlStore(os.path.join(self.directory.name, "store.sqlite"))
+        self.addCleanup(self.store._writer.close)
+        self.store.sync({"items": self.csv}, lambda table: ["kind"])
+
+    def write_csv(self, lines):
+        with open(self.csv, "w", encoding="utf-8") as handle:
+            handle.write("kind,n,price\n" + "\n".join(lines) + "\n")
+
+    def rows(self, query):
+        statement = to_sql(query)
+        return [tuple(row.values()) for row in self.store.cursor(statement.text, statement.params)]
+
+    def test_find(self):
+        query = {"collection": "items", "operation": "find", "filter": {"n": {"$gt": 1}, "kind": "a"},
+                 "projection": {"kind": 1, "n": 1}, "sort": [("n", -1)], "limit": 5, "skip": None}
+        statement = to_sql(query)
+        self.assertEqual(statement.text, "SELECT `kind`, `n`\nFROM `items`\nWHERE `n` > ? AND `kind` = ?\nORDER BY `n` DESC\nLIMIT ?")
+        self.assertEqual(statement.params, (1, "a", 5))
+        self.assertIn("WHERE `n` > 1 AND `kind` = 'a'", statement.display)
+        self.assertEqual(self.rows(query), [("a", 3)])
+
+    def test_aggregate(self):
+        query = {"collection": "items", "operation": "aggregate", "pipeline": [
+            {"$match": {"n": {"$lte": 4}}},
+            {"$group": {"_id": "$kind", "total": {"$sum": "$price"}, "count": {"$sum": 1}}},
+            {"$sort": {"total": -1}},
+            {"$limit": 2},
+        ]}
+        self.assertEqual(self.rows(query), [("a", 6.5, 2), (None, 2.0, 1)])
+        self.assertIs(translate(MongoQuery.from_dict(query)), translate(MongoQuery.from_dict(query)))
+
+    # MongoDB's $ne also matches documents where the field is null or missing
+    def test_not_equal_includes_null(self):
+        query = {"collection": "items", "operation": "find", "filter": {"kind": {"$ne": "a"}}, "projection": None,
+                 "sort": [("n", 1)], "limit": None, "skip": None}
+        self.assertEqual([row[1] for row in self.rows(query)], [2, 4, 5])
+        query["filter"] = {"price": {"$ne": None}}
+        self.assertEqual([row[1] for row in self.rows(query)], [1, 3, 4, 5])
+
+    def test_unsupported_shapes(self):
+        pipelines = [
+            [{"$sort": {"n": 1}}, {"$match": {"n": 1}}],
+            [{"$match": {"n": 1}}, {"$match": {"n": 2}}],
+            [{"$unwind": "$kind"}],
+            [{"$group": {"_id": {"k": "$kind"}}}],
+        ]
+        for pipeline in pipelines:
+            with self.assertRaises(UnsupportedQuery, msg=pipeline):
+                to_sql({"collection": "items", "operation": "aggregate", "pipeline": pipeline})
+        with self.assertRaises(UnsupportedQuery):
+            to_sql({"collection": "items", "operation": "find", "filter": {"$or": []}, "sort": None, "limit": None})
+
+    def test_reload_when_the_file_changes(self):
+        with mock.patch.object(self.store, "load_csv", wraps=self.store.load_csv) as load_csv:
+            self.store.sync({"items": self.csv}, lambda table: ["kind"])
+            load_csv.assert_not_called()
+            self.write_csv(["z,9,1.0"])
+            os.utime(self.csv, (time.time() + 5, time.time() + 5))
+            self.store.sync({"items": self.csv}, lambda table: ["kind"])
+            load_csv.assert_called_once()
+        self.assertEqual(list(self.store.cursor("SELECT kind, n FROM items")), [{"kind": "z", "n": 9}])
+        self.assertEqual(self.store.tables()[0]["indexes"], ["kind"])
+
+    def test_reader_is_read_only(self):
+        for statement in ("INSERT INTO items VALUES ('x', 1, 1.0)", "DROP TABLE items",
+                          f"ATTACH DATABASE '{self.csv}.db' AS other"):
+            with self.assertRaises(SqlError, msg=statement):
+                self.store.cursor(statement)
+        self.assertEqual(len(list(self.store.cursor("SELECT * FROM items"))), 5)
+
+
+
+class SketchAccuracyTest(unittest.TestCase):
+    def test_hyperloglog_within_its_standard_error(self):
+        rng = np.random.default_rng(20)
+        for n in (50, 5000, 200000):
+            values = rng.choice(2 ** 40, size=n, replace=False).astype(np.float64)
+            sketch, halves = HyperLogLog(), [HyperLogLog(), HyperLogLog()]
+            sketch.add_hashes(hash_numbers(np.concatenate([values, values[:n // 2]])))
+            halves[0].add_hashes(hash_numbers(values[:n // 2]))
+            halves[1].add_hashes(hash_numbers(values[n // 2:]))
+            halves[0].merge(halves[1])
+            np.testing.assert_array_equal(sketch.registers, halves[0].registers)
+            # 4 standard errors: a seeded run that fails is a broken estimator, not bad luck
+            self.assertLess(abs(sketch.estimate() - n) / n, 4 * sketch.relative_error, n)
+        keys = hash_keys([value_key(f"user{i}") for i in range(20000)])
+        sketch = HyperLogLog()
+        sketch.add_hashes(keys)
+        self.assertLess(abs(sketch.estimate() - 20000) / 20000, 4 * sketch.relative_error)
+
+    def test_kll_within_its_rank_error(self):
+        rng = np.random.default_rng(20)
+        values = np.concatenate([rng.lognormal(3, 1, 150000), rng.integers(0, 10, 50000)])
+        rng.shuffle(values)
+        ordered = np.sort(values)
+        sketch, other = KLLSketch(), KLLSketch()
+        sketch._rng, other._rng = np.random.default_rng(1), np.random.default_rng(2)
+        for chunk in np.array_split(values[:120000], 30):
+            sketch.update(chunk)
+        other.update(values[120000:])
+        sketch.merge(other)
+        self.assertEqual(sketch.n, len(values))
+        for q in (0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99):
+            estimate = sketch.quantile(q)
+            # Any rank the estimate occupies (ties span several) within the error of q
+            low = np.searchsorted(ordered, estimate, side="left") / len(values)
+            high = np.searchsorted(ordered, estimate, side="right") / len(values)
+            self.assertLessEqual(max(low - q, q - high, 0), sketch.rank_error, q)
+
+
+
+class PreviewTest(unittest.TestCase):
+    query = {"collection": "t", "operation": "aggregate", "pipeline": [
+        {"$group": {"_id": "$g", "n": {"$sum": 1}, "total": {"$sum": "$x"}, "mean": {"$avg": "$x"}}},
+        {"$sort": {"total": -1}},
+    ]}
+
+    def setUp(self):
+        rng = np.random.default_rng(21)
+        groups = rng.choice(["a", "b", "c"], size=20000, p=[0.6, 0.3, 0.1])
+        values = rng.gamma(2.0, 10.0, size=20000)
+        self.documents = [{"g": str(g), "x": float(x)} for g, x in zip(groups, values)]
+        self.exact = {}
+        for g in ("a", "b", "c"):
+            x = values[groups == g]
+            self.exact[g] = {"n": len(x), "total": x.sum(), "mean": x.mean()}
+        self.frame = Frame.from_documents(self.documents)
+
+    def sampler(self, seed):
+        sampler = FrameSampler(self.frame, "g", ["x"])
+        sampler._order = np.random.default_rng(seed).permutation(sampler.population)
+        return sampler
+
+    def test_plan(self):
+        key, accumulators, stages = preview_plan(self.query)
+        self.assertEqual(key, "g")
+        self.assertEqual(accumulators, [("n", "count", None, 1), ("total", "sum", "x", 1), ("mean", "avg", "x", 1)])
+        self.assertEqual(stages, [{"$sort": {"total": -1}}])
+        for pipeline in ([{"$match": {}}], [{"$group": {"_id": {"g": "$g"}}}], [{"$group": {"_id": None, "m": {"$max": "$x"}}}]):
+            with self.assertRaises(UnsupportedQuery):
+                preview_plan({"collection": "t", "operation": "aggregate", "pipeline": pipeline})
+
+    # 95% intervals hold the exact value in about 95 of 100 seeded samples
+    def test_intervals_cover_the_exact_answer(self):
+        _, accumulators, _ = preview_plan(self.query)
+        covered, rounds = {}, 100
+        for seed in range(rounds):
+            sample = Sample(["x"])
+            sample.add(*self.sampler(seed).draw(800))
+            for row in estimate_groups(accumulators, sample, len(self.documents), 0.95, True):
+                for name, (low, high) in row["_interval"].items():
+                    hit = low <= self.exact[row["_id"]][name] <= high
+                    covered[(row["_id"], name)] = covered.get((row["_id"], name), 0) + hit
+        self.assertEqual(len(covered), 9)
+        for cell, hits in covered.items():
+            self.assertGreaterEqual(hits / rounds, 0.88, cell)
+
+    def test_progressive_preview_ends_exact(self):
+        exact_rows = [{"_id": g, **self.exact[g]} for g in ("a", "b", "c")]
+        rounds = list(preview_rounds(self.sampler(0), preview_plan(self.query), lambda: exact_rows,
+                                     budget_ms=1, first_size=1000, progressive=True))
+        self.assertEqual([r["sample_size"] for r in rounds[:-1]], [1000, 2000, 4000, 8000, 16000][:len(rounds) - 1])
+        self.assertFalse(any(r["exact"] for r in rounds[:-1]))
+        self.assertEqual([row["_id"] for row in rounds[0]["rows"]], ["a", "b", "c"])
+        self.assertTrue(rounds[-1]["exact"])
+        self.assertIs(rounds[-1]["rows"], exact_rows)
+        single = list(preview_rounds(self.sampler(0), preview_plan(self.query), lambda: exact_rows,
+                                     budget_ms=1, first_size=1000))
+        self.assertEqual(len(single), 1)
+        self.assertFalse(single[0]["exact"])
+
+
+
+class ShellParserTest(unittest.TestCase):
+    def test_accepted_forms(self):
+        query = parse_shell_query(' db.products.find({"price": {"$gt": 100}}, {"name": 1}).sort({"price": -1}).skip(5).limit(-10).pretty() ; ')
+        self.assertEqual(query, {
+            "collection": "products", "operation": "find", "filter": {"price": {"$gt": 100}}, "projection": {"name": 1},
+            "sort": [("price", -1)], "limit": 10, "skip": 5,
+        })
+        for text in ('db.getCollection("my-items").find()', 'db["my-items"].find({})'):
+            self.assertEqual(parse_shell_query(text)["collection"], "my-items")
+        query = parse_shell_query('db.orders.aggregate([{"$match": {"status": "shipped"}}, {"$count": "n"}])')
+        self.assertEqual(query["pipeline"], [{"$match": {"status": "shipped"}}, {"$count": "n"}])
+        query = parse_shell_query('db.orders.distinct("status", {"totalAmount": {"$gt": 5}})')
+        self.assertEqual(query["operation"], "aggregate")
+        self.assertEqual(query["pipeline"][0], {"$match": {"totalAmount": {"$gt": 5}}})
+        self.assertIsNone(parse_shell_query("db.orders.find().limit(0)")["limit"])
+        self.assertEqual(parse_shell_query('db.orders.find().projection({"_id": 0})')["projection"], {"_id": 0})
+
+    def test_malformed_queries(self):
+        cases = {
+            "products.find()": "Expected db.<collection>.find(...)",
+            "db.products.insertOne({})": "Unsupported operation insertOne()",
+            "db.products.find({price: 1})": "find() arguments are not valid JSON",
+            'db.products.find({} {})': "Expected ',' or ')' in find()",
+            "db.products.find([])": "find() filter must be a document",
+            "db.products.find({}, {}, {})": "find() takes at most a filter and a projection",
+            "db.products.aggregate({})": "aggregate() takes a single pipeline array",
+            "db.products.distinct(1)": "distinct() takes a field name",
+            "db.products.aggregate([]).limit(1)": ".limit() is only supported after find()",
+            'db.products.find().limit("5")': ".limit() takes one integer",
+            "db.products.find().skip(-1)": ".skip() takes a non-negative integer",
+            "db.products.find().sort(1)": ".sort() takes one document",
+            "db.products.find().count()": "Unsupported call .count()",
+            "db.products.find() db.orders.find()": "Unexpected text after the query",
+        }
+        for text, message in cases.items():
+            with self.assertRaises(QueryParseError, msg=text) as raised:
+                parse_shell_query(text)
+            self.assertIn(message, str(raised.exception), text)
+
+    # A repeated text is served from the cache, as a copy callers may modify
+    def test_cache_hits_are_copies(self):
+        text = 'db.reviews.find({"rating": {"$gt": 4}}).limit(3)'
+        first = parse_shell_query(text)
+        hits = cached_parse.cache_info().hits
+        second = parse_shell_query(text)
+        self.assertEqual(cached_parse.cache_info().hits, hits + 1)
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        second["limit"] = 1
+        self.assertEqual(parse_shell_query(text)["limit"], 3)
+
+
+
+class MongoQueryTest(unittest.TestCase):
+    queries = [
+        MongoQuery.find("products", {"price": {"$gt": 100}}, {"name": 1}, [("price", -1), ("_id", 1)], 5, 10),
+        MongoQuery.find("products"),
+        MongoQuery.aggregate("orders", [{"$group": {"_id": "$status", "total": {"$sum": "$totalAmount"}}}, {"$limit": 3}]),
+    ]
+
+    # The shell text shown in the chat UI parses back to the query that is executed
+    def test_rendered_text_parses_back(self):
+        for query in self.queries:
+            self.assertEqual(parse_shell_query(query.render()), query.as_dict(), query.render())
+
+    def test_equality_and_hashing_by_content(self):
+        copy = MongoQuery.from_dict(self.queries[0].as_dict())
+        self.assertEqual(copy, self.queries[0])
+        self.assertEqual(hash(copy), hash(self.queries[0]))
+        self.assertEqual(len(set(self.queries + [copy])), 3)
+        self.assertNotEqual(MongoQuery.find("products", limit=5), MongoQuery.find("products", limit=6))
+        self.assertIs(template_query("total <A> by <B>", "products", "price", "brand"),
+                      template_query("total <A> by <B>", "products", "price", "brand"))
+
+
+
+class StreamingTest(unittest.TestCase):
+    class Cursor:
+        def __init__(self, documents, fail_at=None):
+            self.documents, self.fail_at = documents, fail_at
+            self.pulled, self.closed = 0, False
+
+        def __iter__(self):
+            for document in self.documents:
+                if self.pulled == self.fail_at:
+                    raise RuntimeError("cursor died")
+                self.pulled += 1
+                yield document
+
+        def close(self):
+            self.closed = True
+
+    def lines(self, cursor, row_cap):
+        return [json.loads(line) for line in stream_ndjson(cursor, row_cap)]
+
+    # Rows are read lazily: one past the cap decides the truncation flag
+    def test_row_cap_and_truncation(self):
+        cursor = self.Cursor(({"n": i} for i in range(1000)))
+        lines = self.lines(cursor, 3)
+        self.assertEqual(lines, [{"n": 0}, {"n": 1}, {"n": 2}, {"$end": {"rows": 3, "truncated": True}}])
+        self.assertEqual(cursor.pulled, 4)
+        self.assertTrue(cursor.closed)
+        self.assertEqual(self.lines(self.Cursor([{"n": 1}, {"n": 2}]), 2)[-1], {"$end": {"rows": 2, "truncated": False}})
+
+    def test_cursor_error_ends_the_stream(self):
+        cursor = self.Cursor([{"n": i} for i in range(5)], fail_at=2)
+        lines = self.lines(cursor, 10)
+        self.assertEqual(lines[:2], [{"n": 0}, {"n": 1}])
+        self.assertEqual(list(lines[2]), ["$error"])
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(cursor.closed)
+
+    def test_execute_query_streams_ndjson(self):
+        with mock.patch.dict(app.config, EXECUTE_BACKEND="local"):
+            response = app.test_client().post("/api/execute_query", json={"query": "db.sales.find()", "limit": 2})
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[-1], {"$end": {"rows": 2, "truncated": True}})
+
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class IngestionTest(unittest.TestCase):
+    def setUp(self):
+        from bench import mongomock_bulk_write
+
+        patcher = mock.patch.object(mongomock.collection.Collection, "bulk_write", mongomock_bulk_write)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.db = mongomock.MongoClient().db
+
+    def write(self, name, text):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w", encoding="utf-8") as handle:
+            handle.write(text)
+        return path
+
+    def ingest(self, path, chunk_size):
+        from ingest import ingest_file, is_internal_collection
+
+        batches = []
+        insert_many = mongomock.collection.Collection.insert_many
+
+        def spy(collection, documents, *args, **kwargs):
+            if not is_internal_collection(collection.name):
+                batches.append(len(documents))
+            return insert_many(collection, documents, *args, **kwargs)
+
+        with mock.patch.object(mongomock.collection.Collection, "insert_many", spy):
+            report = ingest_file(path, self.db, chunk_size)
+        return report, batches
+
+    def test_csv_in_chunks(self):
+        lines = [f"{i},{'' if i % 5 == 0 else i * 1.5},k{i % 3}" for i in range(25)]
+        lines[7:7] = ["1,2,3,4"]
+        path = self.write("items.csv", "n,price,kind\n" + "\n".join(lines) + "\n")
+        report, batches = self.ingest(path, 10)
+        self.assertEqual(batches, [10, 10, 5])
+        self.assertEqual((report.inserted, report.rejected, report.batches), (25, 1, 3))
+        self.assertEqual(self.db["items"].count_documents({}), 25)
+        self.assertEqual(self.db["items"].find_one({"n": 5})["price"], None)
+
+    def test_json_in_chunks_with_rejected_documents(self):
+        documents = [{"_id": {"$oid": f"{i:024x}"}, "n": i, "at": {"$date": "2024-01-02T03:04:05Z"}} for i in range(12)]
+        documents[3]["_id"] = documents[2]["_id"]
+        path = self.write("events.json", json.dumps(documents[:6] + [17] + documents[6:]))
+        report, batches = self.ingest(path, 5)
+        self.assertEqual(batches, [5, 5, 2])
+        self.assertEqual((report.inserted, report.rejected), (11, 2))
+        stored = self.db["events"].find_one({"n": 0})
+        self.assertEqual(type(stored["_id"]).__name__, "ObjectId")
+        self.assertEqual(stored["at"], datetime(2024, 1, 2, 3, 4, 5))
+
+
+
+class ExtendedJsonDecoderTest(unittest.TestCase):
+    def decode(self, text, read_size=7):
+        return list(iter_json_array(io.StringIO(text), read_size=read_size))
+
+    # Every read size splits elements, strings and numbers somewhere
+    def test_matches_json_util_at_any_read_size(self):
+        from bson import json_util
+
+        with open(SCHEMAS.source("orders"), encoding="utf-8") as handle:
+            text = handle.read()
+        expected = json_util.loads(text)
+        for read_size in (1, 3, 64, 1 << 16):
+            self.assertEqual(self.decode(text, read_size), expected, read_size)
+        self.assertEqual(self.decode("[1, 22, 333.5, -4e2]", 1), [1, 22, 333.5, -400.0])
+
+    def test_shapes(self):
+        self.assertEqual(self.decode("  [ ]  "), [])
+        self.assertEqual(self.decode(""), [])
+        self.assertEqual(self.decode('{"a": {"$date": "2024-05-06T07:08:09.123Z"}}'),
+                         [{"a": datetime(2024, 5, 6, 7, 8, 9, 123000)}])
+        from bson import ObjectId
+
+        self.assertEqual(self.decode('[{"_id": {"$oid": "0123456789abcdef01234567"}}]', 5),
+                         [{"_id": ObjectId("0123456789abcdef01234567")}])
+        with self.assertRaises(ValueError):
+            self.decode('[{"a": 1}, {"a": ]')
+
+    # Elements are yielded as they are read, not after the whole file
+    def test_reads_incrementally(self):
+        handle = io.StringIO("[" + ",".join(f'{{"n": {i}}}' for i in range(10000)) + "]")
+        documents = iter_json_array(handle, read_size=100)
+        self.assertEqual(next(documents), {"n": 0})
+        self.assertLess(handle.tell(), 1000)
+
+
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram_exposition(self):
+        histogram = Histogram("test_seconds", "Test latency", ["stage"], buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 5.0):
+            histogram.observe(value, 'a"b\\c\nd')
+        self.assertEqual(histogram.render().split("\n"), [
+            "# HELP test_seconds Test latency",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{stage="a\\"b\\\\c\\nd",le="0.1"} 2',
+            'test_seconds_bucket{stage="a\\"b\\\\c\\nd",le="1.0"} 3',
+            'test_seconds_bucket{stage="a\\"b\\\\c\\nd",le="+Inf"} 4',
+            'test_seconds_sum{stage="a\\"b\\\\c\\nd"} 5.65',
+            'test_seconds_count{stage="a\\"b\\\\c\\nd"} 4',
+        ])
+
+    def test_counter_exposition(self):
+        counter = Counter("test_total", "Test events", ["event"])
+        counter.inc("miss")
+        counter.inc("hit", amount=3)
+        self.assertEqual(counter.render().split("\n"), [
+            "# HELP test_total Test events",
+            "# TYPE test_total counter",
+            'test_total{event="hit"} 3',
+            'test_total{event="miss"} 1',
+        ])
+
+    def test_metrics_endpoint(self):
+        app.test_client().post("/api/chat", json={"message": "explore"})
+        response = app.test_client().get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain; version=0.0.4"))
+        text = response.get_data(as_text=True)
+        self.assertIn("# TYPE chatdb_stage_seconds histogram", text)
+        self.assertIn('stage="intent"', text)
+        self.assertTrue(text.endswith("\n"))
+        status, headers, _ = asgi_request("GET", "/metrics")
+        self.assertEqual(status, 200)
+        self.assertTrue(headers[b"content-type"].startswith(b"text/plain; version=0.0.4"))
+
+
+
+class ChatBatchTest(unittest.TestCase):
+    def post(self, payload):
+        return app.test_client().post("/api/chat/batch", json=payload)
+
+    def test_duplicates_are_answered_once_in_order(self):
+        app_module = sys.modules["app"]
+        query = "total transaction_qty by store_location in sales"
+        messages = [query, "explore", query, "explore", query]
+        with mock.patch.dict(app.config, EXECUTE_BACKEND="local", CHAT_BATCH_ROW_CAP=3), \
+                mock.patch("app.respond_to_intent", wraps=app_module.respond_to_intent) as respond, \
+                mock.patch("app.run_locally", wraps=app_module.run_locally) as run:
+            RESULT_CACHE.clear()
+            response = self.post({"messages": messages, "execute": True})
+        self.assertEqual(response.status_code, 200)
+        body = response.get_json()
+        self.assertEqual(body["unique_messages"], 2)
+        self.assertEqual(respond.call_count, 2)
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual([reply["message"] for reply in body["responses"]], messages)
+        first = body["responses"][0]
+        self.assertIn("$group", first["response"])
+        # The grouped field is picked at random, so only the cap is fixed
+        self.assertLessEqual(len(first["rows"]), 3)
+        self.assertIn("truncated", first)
+        self.assertEqual(body["responses"][2], first)
+        self.assertEqual(body["responses"][4], first)
+        self.assertNotIn("rows", body["responses"][1])
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.post({"messages": "explore"}).status_code, 400)
+        self.assertEqual(self.post({"messages": ["explore", 1]}).status_code, 400)
+        self.assertEqual(self.post(["explore"]).status_code, 400)
+        with mock.patch.dict(app.config, CHAT_BATCH_MAX_MESSAGES=2):
+            response = self.post({"messages": ["explore"] * 3})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("At most 2", response.get_json()["error"])
+
+
+if __name__ == "__main__":
+    unittest.main()